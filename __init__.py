@@ -70,3 +70,13 @@ class Actionsonyutilities(InterfaceActionBase):
         :param config_widget: The widget returned by :meth:`config_widget`.
         '''
         config_widget.save_settings()
+
+    def cli_main(self, args):
+        '''
+        Run from the command line with: calibre-debug -r "Sony Utilities" -- [options] COMMAND ...
+
+        See cli.py for the commands and options.
+        '''
+        import sys
+        from calibre_plugins.sonyutilities.cli import main
+        sys.exit(main(args[1:]))
@@ -11,32 +11,41 @@ try:    # need to import init_calibre for doctests
 except ImportError:
     pass
 
-import ConfigParser
-import os, threading, time, shutil
-from datetime import datetime, timedelta
+import os, threading, shutil
 from contextlib import closing
 from collections import OrderedDict
+from functools import partial
 try:
     from PyQt5.Qt import QUrl, pyqtSignal, QTimer
 #     from PyQt5.Qt import (Qt, QApplication, QMenu, QToolButton, QStandardItemModel, QStandardItem, QUrl, QModelIndex, QFileDialog)
-    from PyQt5.Qt import (QMenu, QUrl, QModelIndex, QFileDialog)
+    from PyQt5.Qt import (QMenu, QUrl, QFileDialog)
 except ImportError:
     from PyQt4.Qt import QUrl, pyqtSignal, QTimer
-    from PyQt4.Qt import (QMenu, QUrl, QModelIndex, QFileDialog)
+    from PyQt4.Qt import (QMenu, QUrl, QFileDialog)
 
 # import anything we need from this plugin before any other calibre imports
 # this ensures that we don't get a stale version from the plugin zipfile when running tests.
-from calibre_plugins.sonyutilities.dialogs import (
-                    ReaderOptionsDialog, CoverUploadOptionsDialog, RemoveCoverOptionsDialog, AboutDialog, 
-                    UpdateMetadataOptionsDialog, ChangeReadingStatusOptionsDialog, ShowBooksNotInDeviceDatabaseDialog, 
-                    ManageSeriesDeviceDialog, BookmarkOptionsDialog, QueueProgressDialog, CleanImagesDirOptionsDialog, BlockAnalyticsOptionsDialog,
-                    FixDuplicateShelvesDialog, OrderSeriesShelvesDialog, ShowReadingPositionChangesDialog
-                    )
 from calibre_plugins.sonyutilities.common_utils import (set_plugin_icon_resources, get_icon, ProgressBar,
-                                                        SonyDB, convert_sony_date,
+                                                        SonyDB, convert_sony_date, database_version,
+                                                        HelperIndexes, explain_query_plan, annotation_hash,
+                                                        DeviceTaskQueue, LazyModule, get_logger,
+                                                        instrumented, connect_device_database, session_report, ring_buffer_lines,
+                                                        DeviceDatabaseSnapshot, ChangeJournal, pending_change_journals,
+                                                        recover_change_journals,
+                                                        enable_statement_profiler, statement_profiler,
                                                         create_menu_action_unique,  debug_print)
-from calibre_plugins.sonyutilities.book import SeriesBook
 import calibre_plugins.sonyutilities.config as cfg
+from calibre_plugins.sonyutilities.services import (EPUB_FETCH_QUERY, SHELF_STATISTICS_QUERY,
+                                                    CONTENTID_FROM_PATH_QUERY,
+                                                    SHELF_CONTENT_UPDATE_QUERY, HELPER_INDEXES,
+                                                    HELPER_INDEXES_MIN_BOOKS, check_device_database, qhash)
+import calibre_plugins.sonyutilities.services as services
+# The dialogs and the book module (which loads the ebook iterator) are only 
+# imported when first used, rather than when calibre starts
+dialogs = LazyModule('calibre_plugins.sonyutilities.dialogs')
+
+store_log   = get_logger('store')
+shelves_log = get_logger('shelves')
 
 from calibre.devices.prst1.driver import DBPATH 
 from calibre import strftime
@@ -60,23 +69,12 @@ PLUGIN_ICONS = ['images/icon.png', 'images/logo_sony.png', 'images/manage_series
                 'images/lock_delete.png', 'images/lock_open.png', 'images/sort.png',
                 'images/ms_ff.png']
 
-MIMETYPE_SONY = 'application/epub+zip'
-
-BOOKMARK_SEPARATOR = '|@ @|'       # Spaces are included to allow wrapping in the details panel
-
-EPUB_FETCH_QUERY = """
-    SELECT cp.mark,
-           np.percent,
-           books.reading_time,
-           np.client_create_date
-    FROM books
-    LEFT OUTER JOIN current_position cp ON cp.content_id=books._id
-    LEFT OUTER JOIN network_position np ON np.content_id=books._id
-    where books._id = ?
-    """
 SET_FRONT_PAGE_QUERY = """
 select min(reading_time) from (select _id, reading_time from books order by 2 desc limit 4);
 """
+# Milliseconds to wait after a device signal before queuing the on-connect tasks, so that
+# signals arriving together only queue them once.
+CONNECT_TASKS_DELAY = 1000
 
 try:
     debug_print("loading translations")
@@ -85,25 +83,6 @@ except NameError:
     debug_print("exception when loading translations")
     pass # load_translations() added in calibre 1.9
 
-# Implementation of QtQHash for strings. This doesn't seem to be in the Python implemention. 
-def qhash (inputstr):
-    instr = ""
-    if isinstance (inputstr, str):
-        instr = inputstr 
-    elif isinstance (inputstr, unicode):
-        instr = inputstr.encode ("utf8")
-    else:
-        return -1
-
-    h = 0x00000000
-    for i in range (0, len (instr)):
-        h = (h << 4) + ord(instr[i])
-        h ^= (h & 0xf0000000) >> 23
-        h &= 0x0fffffff
-
-    return h
-
-
 class sonyutilitiesAction(InterfaceAction):
 
     name = 'sonyutilities'
@@ -133,6 +112,10 @@ class sonyutilitiesAction(InterfaceAction):
         self.qaction.triggered.connect(self.toolbar_button_clicked)
         self.menu.aboutToShow.connect(self.about_to_show_menu)
         self.menus_lock = threading.RLock()
+        self.connect_tasks = DeviceTaskQueue()
+        self.connect_tasks_pending = False
+        self.menu_state = None
+        self.view_actions = []
 
     def initialization_complete(self):
         # otherwise configured hot keys won't work until the menu's
@@ -174,7 +157,8 @@ class sonyutilitiesAction(InterfaceAction):
         if self.haveSony() and cfg.get_plugin_pref(cfg.COMMON_OPTIONS_STORE_NAME, cfg.KEY_STORE_ON_CONNECT):
             debug_print('About to do auto store')
             self.rebuild_menus()
-            QTimer.singleShot(1000, self.auto_store_current_bookmark)
+            self.connect_tasks.add(('store',), self.auto_store_current_bookmark)
+            QTimer.singleShot(CONNECT_TASKS_DELAY, self.connect_tasks.start)
 
 
     def _on_device_connection_changed(self, is_connected):
@@ -184,6 +168,8 @@ class sonyutilitiesAction(InterfaceAction):
         if not is_connected:
             debug_print('Device disconnected')
             self.current_device_info = None
+            # Any job already started finishes, but nothing more is started for the device
+            self.connect_tasks.clear()
             self.rebuild_menus()
 
 
@@ -194,6 +180,9 @@ class sonyutilitiesAction(InterfaceAction):
         If the device is a Sony, find the database paths (depends on whether an SD card is installed)
         and back up all the databases (if necessary), then store bookmarks for any books you're reading 
         (if STORE_ON_CONNECT is specified in the configuration)
+
+        The backups and store are queued on self.connect_tasks to run one after another as 
+        background jobs, so nothing here waits for them.
         
         """
         #TODO: no idea how to test job submission yet
@@ -203,20 +192,66 @@ class sonyutilitiesAction(InterfaceAction):
         debug_print('Metadata available:', self.current_device_info)
         self.device              = self.get_device()
         self.device_database_path= self._device_database_paths()
-        
-        for location in self.current_device_info.values():
-            if self.haveSony() and cfg.get_plugin_pref(cfg.BACKUP_OPTIONS_STORE_NAME, cfg.KEY_DO_DAILY_BACKUP):
-                debug_print('About to start auto backup')
-                self.auto_backup_device_database(location)
 
-        if self.haveSony() and cfg.get_plugin_pref(cfg.COMMON_OPTIONS_STORE_NAME, cfg.KEY_STORE_ON_CONNECT):
-            debug_print('About to start auto store')
-            self.auto_store_current_bookmark()
+        if not self.connect_tasks_pending:
+            self.connect_tasks_pending = True
+            QTimer.singleShot(CONNECT_TASKS_DELAY, self._queue_connect_tasks)
 
         self.rebuild_menus()
 
 
-    def rebuild_menus(self):
+    def _queue_connect_tasks(self):
+        """
+        Queue the tasks to run when a device connects, with the backups first as the other tasks can write
+        """
+        self.connect_tasks_pending = False
+        if not self.haveSony() or not self.current_device_info:
+            return
+
+        if cfg.get_plugin_pref(cfg.BACKUP_OPTIONS_STORE_NAME, cfg.KEY_DO_DAILY_BACKUP):
+            for location in self.current_device_info.values():
+                debug_print('About to queue auto backup')
+                self.connect_tasks.add(('backup', location['device_store_uuid']), 
+                                       partial(self.auto_backup_device_database, location))
+
+        # Unfinished changes are recovered after the backups, and before anything else writes
+        self.connect_tasks.add(('journal',), self.recover_change_journals)
+
+        if cfg.get_plugin_pref(cfg.COMMON_OPTIONS_STORE_NAME, cfg.KEY_STORE_ON_CONNECT):
+            debug_print('About to queue auto store')
+            self.connect_tasks.add(('store',), self.auto_store_current_bookmark)
+
+        self.connect_tasks.start()
+
+
+    def rebuild_menus(self, force=False):
+        """
+        Bring the menu up to date with the device and the current view
+
+        The menu is only built again when a Sony device is connected or disconnected. When only
+        the view changes, the actions that depend on it are enabled or disabled.
+        """
+        with self.menus_lock:
+            try:
+                self.device = self.gui.device_manager.connected_device
+            except:
+                self.device = None
+            menu_state = (self.haveSony(), self.isDeviceView())
+            if menu_state == self.menu_state and not force:
+                return
+            if self.menu_state is not None and menu_state[0] == self.menu_state[0] and not force:
+                self.menu_state = menu_state
+                self._update_view_actions()
+                return
+            self.menu_state = menu_state
+            self._build_menus()
+
+    def _update_view_actions(self):
+        haveSony, isDeviceView = self.menu_state
+        for ac, is_device_action in self.view_actions:
+            ac.setEnabled(haveSony and isDeviceView == is_device_action)
+
+    def _build_menus(self):
         with self.menus_lock:
             # Show the config dialog
             # The config dialog can also be shown from within
@@ -225,6 +260,7 @@ class sonyutilitiesAction(InterfaceAction):
             do_user_config = self.interface_action_base_plugin.do_user_config
             self.menu.clear()
             self.actions_unique_map = {}
+            self.view_actions = []
 
             self.device   = self.get_device()
             haveSony      = self.haveSony()
@@ -323,6 +359,18 @@ class sonyutilitiesAction(InterfaceAction):
                                                             triggered=self.getAnnotationForSelected,
                                                             enabled=not self.isDeviceView() and haveSony, 
                                                             is_library_action=True)
+            self.exportAnnotationsForSelected_action = self.create_menu_item_ex(self.menu,  _("Export annotations for Selected Books..."), image='bookmarks.png',
+                                                            unique_name='Export annotations for Selected Books',
+                                                            shortcut_name= _("Export annotations for Selected Books"),
+                                                            triggered=self.exportAnnotationsForSelected,
+                                                            enabled=not self.isDeviceView() and haveSony, 
+                                                            is_library_action=True)
+            self.syncAnnotationsForSelected_action = self.create_menu_item_ex(self.menu,  _("Sync annotations to library for Selected Books"), image='bookmarks.png',
+                                                            unique_name='Sync annotations to library for Selected Books',
+                                                            shortcut_name= _("Sync annotations to library for Selected Books"),
+                                                            triggered=self.syncAnnotationsForSelected,
+                                                            enabled=not self.isDeviceView() and haveSony, 
+                                                            is_library_action=True)
             self.menu.addSeparator()
 
             self.show_books_not_in_database_action = self.create_menu_item_ex(self.menu,  _("Show books not in the device database"),
@@ -362,6 +410,13 @@ class sonyutilitiesAction(InterfaceAction):
                                                             enabled=haveSony, 
                                                             is_library_action=True, 
                                                             is_device_action=True)
+            self.advise_device_indexes_action = self.create_menu_item_ex(self.databaseMenu,  _("Check device query plans"),
+                                                            unique_name='Check device query plans',
+                                                            shortcut_name= _("Check device query plans"),
+                                                            triggered=self.advise_device_indexes,
+                                                            enabled=haveSony, 
+                                                            is_library_action=True, 
+                                                            is_device_action=True)
             self.vacuum_device_database_action = self.create_menu_item_ex(self.databaseMenu,  _("Compress the device database"),
                                                             unique_name='Compress the device database',
                                                             shortcut_name= _("Compress the device database"),
@@ -376,6 +431,29 @@ class sonyutilitiesAction(InterfaceAction):
                                                             enabled=haveSony, 
                                                             is_library_action=True, 
                                                             is_device_action=True)
+            self.databaseMenu.addSeparator()
+            self.show_session_report_action = self.create_menu_item_ex(self.databaseMenu,  _("Show session statistics"),
+                                                            unique_name='Show session statistics',
+                                                            shortcut_name= _("Show session statistics"),
+                                                            triggered=self.show_session_report,
+                                                            enabled=True, 
+                                                            is_library_action=True, 
+                                                            is_device_action=True)
+            self.profile_statements_action = self.create_menu_item_ex(self.databaseMenu,  _("Profile SQL statements"),
+                                                            unique_name='Profile SQL statements',
+                                                            shortcut_name= _("Profile SQL statements"),
+                                                            triggered=self.toggle_statement_profiler,
+                                                            is_checked=statement_profiler() is not None,
+                                                            enabled=True, 
+                                                            is_library_action=True, 
+                                                            is_device_action=True)
+            self.export_statement_profile_action = self.create_menu_item_ex(self.databaseMenu,  _("Export SQL statement profile"),
+                                                            unique_name='Export SQL statement profile',
+                                                            shortcut_name= _("Export SQL statement profile"),
+                                                            triggered=self.export_statement_profile,
+                                                            enabled=statement_profiler() is not None, 
+                                                            is_library_action=True, 
+                                                            is_device_action=True)
 
 #            self.menu.addSeparator()
 #            self.get_list_action = self.create_menu_item_ex(self.menu, 'Update TOC for Selected Book',
@@ -439,7 +517,7 @@ class sonyutilitiesAction(InterfaceAction):
         # are not found in the zip file will not be in the returned dictionary.
         
         self.about_text = get_resources('about.txt')
-        AboutDialog(self.gui, self.qaction.icon(), self.version + self.about_text).exec_()
+        dialogs.AboutDialog(self.gui, self.qaction.icon(), self.version + self.about_text).exec_()
         
     def create_menu_item_ex(self, parent_menu, menu_text, image=None, tooltip=None,
                            shortcut=None, triggered=None, is_checked=None, shortcut_name=None,
@@ -448,6 +526,9 @@ class sonyutilitiesAction(InterfaceAction):
                                        shortcut, triggered, is_checked, shortcut_name, unique_name)
         self.actions_unique_map[ac.calibre_shortcut_unique_name] = ac.calibre_shortcut_unique_name
         ac.setEnabled(enabled)
+        # Actions for only one of the views are enabled or disabled when the view changes
+        if is_library_action != is_device_action:
+            self.view_actions.append((ac, is_device_action))
 
         if is_library_action:
             self.library_actions_map[shortcut_name] = ac
@@ -536,7 +617,7 @@ class sonyutilitiesAction(InterfaceAction):
         if len(contentIDs) == 1:
             self.single_contentID = contentIDs[0]
 
-        dlg = ReaderOptionsDialog(self.gui, self)
+        dlg = dialogs.ReaderOptionsDialog(self.gui, self)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             return
@@ -604,7 +685,7 @@ class sonyutilitiesAction(InterfaceAction):
             book.contentIDs = [book.contentID] if book.contentID is not None else self.get_contentIDs_from_id(book.calibre_id)
             book.series_index_string = None
         
-        dlg = UpdateMetadataOptionsDialog(self.gui, self)
+        dlg = dialogs.UpdateMetadataOptionsDialog(self.gui, self)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             return
@@ -633,7 +714,7 @@ class sonyutilitiesAction(InterfaceAction):
         if len(selectedIDs) == 0:
             return
 
-        dlg = BookmarkOptionsDialog(self.gui, self)
+        dlg = dialogs.BookmarkOptionsDialog(self.gui, self)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             return
@@ -645,9 +726,12 @@ class sonyutilitiesAction(InterfaceAction):
             self.restore_current_bookmark()
 
 
-    def auto_store_current_bookmark(self):
+    def auto_store_current_bookmark(self, on_finished=None):
         """
         Start a job to store all the bookmarks for books currently being read
+
+        The books are queued without blocking the calibre window, and on_finished is called 
+        when the job has finished.
         """
         #TODO: no idea how to test job submission yet
         debug_print("start")
@@ -668,7 +752,9 @@ class sonyutilitiesAction(InterfaceAction):
         self.options['allOnDevice']  = True
         
         # it took forever to figure out that this actually calls dialogs.do_books to get the book list...
-        QueueProgressDialog(self.gui, [], None, self.options, self._store_queue_job, db, plugin_action=self)
+        # Keep a reference, as nothing waits for the dialog to finish
+        self.queue_dialog = dialogs.QueueProgressDialog(self.gui, [], None, self.options, partial(self._store_queue_job, on_finished=on_finished), db, 
+                                                plugin_action=self, blocking=False)
 
 
     def backup_device_database(self):
@@ -699,9 +785,11 @@ class sonyutilitiesAction(InterfaceAction):
         source_file = self.device_database_path()
         shutil.copyfile(source_file, backup_file)
 
-    def auto_backup_device_database(self, location, from_menu=False):
+    def auto_backup_device_database(self, location, on_finished=None, from_menu=False):
         """
         Every time a Sony reader is connected, back up its databases (limit of once per day)
+
+        on_finished is called when the backup job has finished, or straight away if there is no backup to do.
         """
         #TODO: no idea how to test job submission yet
         debug_print('start')
@@ -712,9 +800,12 @@ class sonyutilitiesAction(InterfaceAction):
         debug_print('destination directory=', dest_dir)
         if not dest_dir or len(dest_dir) == 0:
             debug_print('destination directory not set, not doing backup')
+            if on_finished is not None:
+                on_finished()
             return
         
-        self._device_database_backup(from_menu  = from_menu,
+        self._device_database_backup(on_finished = on_finished,
+                                     from_menu  = from_menu,
                                      dest       = dest_dir,
                                      copies     = cfg.get_plugin_pref(cfg.BACKUP_OPTIONS_STORE_NAME, cfg.KEY_BACKUP_COPIES_TO_KEEP),
                                      database_file = self.device_database_path[location['prefix']],
@@ -742,7 +833,7 @@ class sonyutilitiesAction(InterfaceAction):
         debug_print("self.options:", self.options)
 
         if self.options[cfg.KEY_BACKGROUND_JOB]:
-            QueueProgressDialog(self.gui, [], None, self.options, self._store_queue_job, self.gui.current_view().model().db, plugin_action=self)
+            dialogs.QueueProgressDialog(self.gui, [], None, self.options, self._store_queue_job, self.gui.current_view().model().db, plugin_action=self)
         else:
             selectedIDs = self._get_selected_ids()
         
@@ -815,7 +906,7 @@ class sonyutilitiesAction(InterfaceAction):
             book.contentIDs = [book.contentID]
         debug_print("books:", books)
 
-        dlg = ChangeReadingStatusOptionsDialog(self.gui, self)
+        dlg = dialogs.ChangeReadingStatusOptionsDialog(self.gui, self)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             return
@@ -889,7 +980,7 @@ class sonyutilitiesAction(InterfaceAction):
 #            else:
 #                debug_print("book.contentID='%s'" % book.contentID)
 
-        dlg = ShowBooksNotInDeviceDatabaseDialog(self.gui, books_not_in_database)
+        dlg = dialogs.ShowBooksNotInDeviceDatabaseDialog(self.gui, books_not_in_database)
         dlg.show()
 
 
@@ -904,7 +995,7 @@ class sonyutilitiesAction(InterfaceAction):
         self.device_path = self.get_device_path()
 
         shelves = self._get_shelf_count()
-        dlg = FixDuplicateShelvesDialog(self.gui, self, shelves)
+        dlg = dialogs.FixDuplicateShelvesDialog(self.gui, self, shelves)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             debug_print("dialog cancelled")
@@ -912,8 +1003,8 @@ class sonyutilitiesAction(InterfaceAction):
         self.options = dlg.options
         debug_print("about to fix shelves - options=%s" % self.options)
 
-        starting_shelves, shelves_removed, finished_shelves = self._remove_duplicate_shelves(shelves, self.options)
-        result_message = _("Update summary:") + "\n\t" + _("Starting number of shelves={0}\n\tShelves removed={1}\n\tTotal shelves={2}").format(starting_shelves, shelves_removed, finished_shelves)
+        starting_shelves, shelves_removed, finished_shelves, shelves_purged = self._remove_duplicate_shelves(shelves, self.options)
+        result_message = _("Update summary:") + "\n\t" + _("Starting number of shelves={0}\n\tShelves removed={1}\n\tShelves purged={2}\n\tTotal shelves={3}").format(starting_shelves, shelves_removed, shelves_purged, finished_shelves)
         info_dialog(self.gui,  _("Sony Utilities") + " - " + _("Duplicate Shelves Fixed"),
                     result_message,
                     show=True)
@@ -930,7 +1021,7 @@ class sonyutilitiesAction(InterfaceAction):
         self.device_path = self.get_device_path()
 
         shelves = []
-        dlg = OrderSeriesShelvesDialog(self.gui, self, shelves)
+        dlg = dialogs.OrderSeriesShelvesDialog(self.gui, self, shelves)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             debug_print("dialog cancelled")
@@ -966,6 +1057,116 @@ class sonyutilitiesAction(InterfaceAction):
         d.exec_()
 
 
+    def advise_device_indexes(self):
+        debug_print("start")
+        self.device = self.get_device()
+        if self.device is None:
+            return error_dialog(self.gui,  _("Cannot check Sony device query plans."),
+                     _("No device connected."),
+                    show=True)
+        self.device_path = self.get_device_path()
+
+        report = []
+        for prefix, database in self.device_database_path.items():
+            report.append(_("Database: {0}").format(database))
+            report.extend(self._query_plan_report(database))
+            report.append('')
+
+        d = ViewLog("Sony Utilities - Device Query Plans", "\n".join(report), parent=self.gui)
+        d.setWindowIcon(self.qaction.icon())
+        d.exec_()
+
+
+    def show_session_report(self):
+        """
+        Show how long each device operation of this session took, and the database work it did
+        """
+        report = [session_report()]
+        if statement_profiler() is not None:
+            report.append('')
+            report.append(_("SQL statements:"))
+            report.append(statement_profiler().report())
+        log_lines = ring_buffer_lines()
+        if log_lines:
+            report.append('')
+            report.append(_("Recent log messages:"))
+            report.extend(log_lines)
+
+        d = ViewLog("Sony Utilities - Session Statistics", "\n".join(report), parent=self.gui)
+        d.setWindowIcon(self.qaction.icon())
+        d.exec_()
+
+    def toggle_statement_profiler(self):
+        """
+        Start profiling the SQL statements run against the device databases, or stop and discard the profile
+        """
+        profiler = enable_statement_profiler(self.profile_statements_action.isChecked())
+        self.export_statement_profile_action.setEnabled(profiler is not None)
+
+    def export_statement_profile(self):
+        profiler = statement_profiler()
+        if profiler is None:
+            return
+
+        fd = FileDialog(parent=self.gui, name='Sony Utilities plugin:choose statement profile destination', 
+                        title= _("Choose Statement Profile Destination"),
+                        filters=[( _("CSV file"), ['csv']), ( _("JSON file"), ['json'])], 
+                        add_all_files_filter=False,
+                        mode=QFileDialog.AnyFile
+                        )
+        if not fd.accepted:
+            return
+        profile_file = fd.get_files()[0]
+
+        if not profile_file:
+            return
+
+        debug_print("statement profile file selected=", profile_file)
+        profiler.export(profile_file)
+
+
+    @instrumented()
+    def _query_plan_report(self, database):
+        """
+        Run 'EXPLAIN QUERY PLAN' for the plugin's queries against the database, and report 
+        the full table scans along with the helper indexes that would be used in bulk operations
+        """
+        queries = [
+                   ("EPUB_FETCH_QUERY",             EPUB_FETCH_QUERY,               (0,)),
+                   ("generate_metadata_query",      self.generate_metadata_query(), ('',)),
+                   ("CONTENTID_FROM_PATH_QUERY",    CONTENTID_FROM_PATH_QUERY,      ('',)),
+                   ("SHELF_STATISTICS_QUERY",       SHELF_STATISTICS_QUERY,         ()),
+                   ("SHELF_CONTENT_UPDATE_QUERY",   SHELF_CONTENT_UPDATE_QUERY,     ('', '', '')),
+                   ]
+        report = []
+        full_scans = 0
+        with closing(connect_device_database(database)) as connection:
+            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+            cursor = connection.cursor()
+            for query_name, query, query_values in queries:
+                report.append("  " + query_name)
+                try:
+                    plan = explain_query_plan(cursor, query, query_values)
+                except sqlite3.OperationalError as e:
+                    report.append("    " + _("Not applicable to this database: {0}").format(e))
+                    continue
+                for detail, full_scan in plan:
+                    if full_scan:
+                        full_scans += 1
+                    report.append("    %s %s" % ('*' if full_scan else ' ', detail))
+            cursor.close()
+
+            missing_indexes = HelperIndexes.missing(connection, HELPER_INDEXES)
+
+        report.append(_("Full table scans (marked *): {0}").format(full_scans))
+        report.append(_("Helper indexes created during bulk operations:"))
+        for name, table, columns in missing_indexes:
+            report.append("    %s ON %s (%s)" % (name, table, ', '.join(columns)))
+        if not missing_indexes:
+            report.append("    " + _("None - the device database already has the indexes needed"))
+        return report
+
+
     def vacuum_device_database(self):
         debug_print("start")
         self.device = self.get_device()
@@ -975,32 +1176,57 @@ class sonyutilitiesAction(InterfaceAction):
                     show=True)
         self.device_path = self.get_device_path()
 
-        uncompressed_db_size = 0
-        for database in self.device_database_path.values():
-            uncompressed_db_size += os.path.getsize(database)
-            vacuum_result = self._vacuum_device_database(database)
-    
-            if vacuum_result == '':
-                compressed_db_size = os.path.getsize(database)
-            else:
-                vacuum_result = _("Result of running 'vacuum' on database on the Sony device:\n\n") + vacuum_result
-    
-                d = ViewLog("Sony Utilities - Compress Device Database", vacuum_result, parent=self.gui)
-                d.setWindowIcon(self.qaction.icon())
-                d.exec_()
-                return
+        from calibre_plugins.sonyutilities.jobs import do_device_database_vacuum
+        vacuum_options = {
+                          'databases': list(self.device_database_path.values()),
+                          'threshold': cfg.get_plugin_pref(cfg.BACKUP_OPTIONS_STORE_NAME, cfg.KEY_VACUUM_THRESHOLD)
+                          }
+        args = [vacuum_options, ]
+        desc = _("Compressing Sony device database")
+        job = self.gui.device_manager.create_job(do_device_database_vacuum, self.Dispatcher(self._vacuum_device_database_completed), description=desc, args=args)
+        job._tdir = None
+        self.gui.status_bar.show_message(_("Sony Utilities") + " - " + desc, 3000)
+
+
+    def _vacuum_device_database_completed(self, job):
+        if job.failed:
+            self.gui.job_exception(job, dialog_title=_("Failed to compress device database"))
+            return
+
+        actions = {
+                   'none':          _("No free space to reclaim"),
+                   'skipped':       _("Free space below the threshold, not compressed"),
+                   'incremental':   _("Free pages released"),
+                   'vacuum':        _("Compressed"),
+                   }
+        result_lines = []
+        for statistics in job.result:
+            result_lines.append(_("{0}:\n\tPages = {1}, free pages = {2} ({3}%)\n\tProjected saving = {4}MB\n\t{5}\n\tOriginal size = {6}MB\n\tCompressed size = {7}MB").format(
+                                statistics['database'],
+                                statistics['page_count'],
+                                statistics['freelist_count'],
+                                "%.1f" % statistics['fragmentation'],
+                                "%.3f" % (statistics['savings'] / 1024 / 1024),
+                                actions[statistics['action']],
+                                "%.3f" % (statistics['size_before'] / 1024 / 1024),
+                                "%.3f" % (statistics['size_after'] / 1024 / 1024)))
+
+        if all(statistics['action'] == 'none' for statistics in job.result):
+            self.gui.status_bar.show_message(_("Sony Utilities") + " - " + _("Compress device database - nothing to do"), 3000)
+            return
 
-        result_message = _("The database on the device has been compressed.\n\tOriginal size = {0}MB\n\tCompressed size = {1}MB").format("%.3f"%(uncompressed_db_size / 1024 / 1024), "%.3f"%(compressed_db_size / 1024 / 1024))
         info_dialog(self.gui,  _("Sony Utilities") + " - " + _("Compress Device Database"),
-                result_message,
+                _("Result of compressing the database on the Sony device:"),
+                det_msg="\n".join(result_lines),
                 show=True)
-        return
 
     def default_options(self):
         options = cfg.METADATA_OPTIONS_DEFAULTS
         return options
 
     def manage_series_on_device(self):
+        from calibre_plugins.sonyutilities.book import SeriesBook
+
         def digits(f):
             return len(str(f).split('.')[1].rstrip('0'))
 
@@ -1023,16 +1249,13 @@ class sonyutilitiesAction(InterfaceAction):
             return
         seriesBooks = [SeriesBook(book, series_columns) for book in books]
         seriesBooks = sorted(seriesBooks, key=lambda k: k.sort_key(sort_by_name=True))
-        debug_print("seriesBooks[0]._mi.__class__=", seriesBooks[0]._mi.__class__)
-        debug_print("seriesBooks[0]._mi.sony_series=", seriesBooks[0]._mi.sony_series)
-        debug_print("seriesBooks[0]._mi.sony_series_number=", seriesBooks[0]._mi.sony_series_number)
         debug_print("books:", seriesBooks)
 
         library_db = self.gui.library_view.model().db
         all_series = library_db.all_series()
         all_series.sort(key=lambda x : sort_key(x[1]))
 
-        d = ManageSeriesDeviceDialog(self.gui, self, seriesBooks, all_series, series_columns)
+        d = dialogs.ManageSeriesDeviceDialog(self.gui, self, seriesBooks, all_series, series_columns)
         d.exec_()
         if d.result() != d.Accepted:
             return
@@ -1042,20 +1265,18 @@ class sonyutilitiesAction(InterfaceAction):
         self.options = self.default_options()
         books = []
         for seriesBook in seriesBooks:
-            debug_print("seriesBook._mi.contentID=", seriesBook._mi.contentID)
             if seriesBook.is_title_changed() or seriesBook.is_pubdate_changed() or seriesBook.is_series_changed():
-                book = seriesBook._mi
+                self.options['title']          = self.options['title'] or seriesBook.is_title_changed()
+                self.options['series']         = self.options['series'] or seriesBook.is_series_changed()
+                self.options['published_date'] = self.options['published_date'] or seriesBook.is_pubdate_changed()
+                debug_print("seriesBook.is_pubdate_changed()=%s"%seriesBook.is_pubdate_changed())
+                book = seriesBook.get_mi_to_persist()
                 book.series_index_string = seriesBook.series_index_string()
                 book.sony_series_number  = seriesBook.series_index_string()
                 book.sony_series         = seriesBook.series_name()
                 book._new_book           = True
                 book.contentIDs          = [book.contentID]
                 books.append(book)
-                self.options['title']          = self.options['title'] or seriesBook.is_title_changed()
-                self.options['series']         = self.options['series'] or seriesBook.is_series_changed()
-                self.options['published_date'] = self.options['published_date'] or seriesBook.is_pubdate_changed()
-                debug_print("seriesBook._mi.__class__=", seriesBook._mi.__class__)
-                debug_print("seriesBook.is_pubdate_changed()=%s"%seriesBook.is_pubdate_changed())
                 debug_print("book.sony_series=", book.sony_series)
                 debug_print("book.sony_series_number=", book.sony_series_number)
                 debug_print("book.series=", book.series)
@@ -1086,6 +1307,8 @@ class sonyutilitiesAction(InterfaceAction):
         return series_columns
 
     def get_selected_books(self, rows, series_columns):
+        from calibre_plugins.sonyutilities.book import SeriesBook
+
         def digits(f):
             return len(str(f).split('.')[1].rstrip('0'))
 
@@ -1120,7 +1343,7 @@ class sonyutilitiesAction(InterfaceAction):
         debug_print("selectedIDs:", selectedIDs)
         books = self._convert_calibre_ids_to_books(self.gui.current_view().model().db, selectedIDs)
         
-        dlg = CoverUploadOptionsDialog(self.gui, self)
+        dlg = dialogs.CoverUploadOptionsDialog(self.gui, self)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             return
@@ -1156,7 +1379,7 @@ class sonyutilitiesAction(InterfaceAction):
         if len(books) == 0:
             return
 
-        dlg = RemoveCoverOptionsDialog(self.gui, self)
+        dlg = dialogs.RemoveCoverOptionsDialog(self.gui, self)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             return
@@ -1193,7 +1416,7 @@ class sonyutilitiesAction(InterfaceAction):
         if len(books) == 0:
             return
 
-        dlg = RemoveCoverOptionsDialog(self.gui, self)
+        dlg = dialogs.RemoveCoverOptionsDialog(self.gui, self)
         dlg.exec_()
         if dlg.result() != dlg.Accepted:
             return
@@ -1221,6 +1444,52 @@ class sonyutilitiesAction(InterfaceAction):
         self._getAnnotationForSelected()
 
 
+    def exportAnnotationsForSelected(self):
+        if len(self.gui.current_view().selectionModel().selectedRows()) == 0:
+            return
+        self.device = self.get_device()
+        if self.device is None:
+            return error_dialog(self.gui,
+                                 _("Cannot export annotations."),
+                                 _("No device connected."),
+                                show=True)
+
+        fd = FileDialog(parent=self.gui, name='Sony Utilities plugin:choose annotations export file', 
+                        title= _("Choose Annotations Export File"),
+                        filters=[( _("HTML"), ['html']), ( _("JSON"), ['json'])], 
+                        add_all_files_filter=False,
+                        mode=QFileDialog.AnyFile
+                        )
+        if not fd.accepted:
+            return
+        export_file = fd.get_files()[0]
+        if not export_file:
+            return
+
+        self._getAnnotationForSelected(export_file=export_file)
+
+
+    def syncAnnotationsForSelected(self):
+        if len(self.gui.current_view().selectionModel().selectedRows()) == 0:
+            return
+        self.device = self.get_device()
+        if self.device is None:
+            return error_dialog(self.gui,
+                                 _("Cannot sync annotations."),
+                                 _("No device connected."),
+                                show=True)
+
+        library_config     = cfg.get_library_config(self.gui.current_db)
+        annotations_column = library_config.get(cfg.KEY_ANNOTATIONS_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_ANNOTATIONS_CUSTOM_COLUMN])
+        if not annotations_column:
+            return error_dialog(self.gui,
+                                 _("Cannot sync annotations."),
+                                 _("No annotations column has been configured. Select one in the plugin configuration."),
+                                show=True)
+
+        self._getAnnotationForSelected(sync_column=annotations_column)
+
+
     def _get_selected_ids(self):
         rows = self.gui.current_view().selectionModel().selectedRows()
         if not rows or len(rows) == 0:
@@ -1346,8 +1615,7 @@ class sonyutilitiesAction(InterfaceAction):
         
         cursor = cursors[prefix]
         
-        query = 'SELECT _id FROM books WHERE file_path = ?'
-        cursor.execute(query, (internal_path,))
+        cursor.execute(CONTENTID_FROM_PATH_QUERY, (internal_path,))
         row = cursor.fetchone()
         ContentID = row[0]
 
@@ -1383,24 +1651,30 @@ class sonyutilitiesAction(InterfaceAction):
         return contentIDs
 
 
-    def _store_queue_job(self, tdir, options, books_to_modify):
+    def _store_queue_job(self, tdir, options, books_to_modify, on_finished=None):
         debug_print("")
         if not books_to_modify:
             # All failed so cleanup our temp directory
-            remove_dir(tdir)
+            try:
+                remove_dir(tdir)
+            finally:
+                if on_finished is not None:
+                    on_finished()
             return
 
 #         cpus = 1# self.gui.device_manager.server.pool_size
         from calibre_plugins.sonyutilities.jobs import do_store_locations
         args = [books_to_modify, options, ]
         desc = _('Storing reading positions for {0} books').format(len(books_to_modify))
-        job = self.gui.device_manager.create_job(do_store_locations, self.Dispatcher(self._store_completed), description=desc, args=args)
+        job = self.gui.device_manager.create_job(do_store_locations, self.Dispatcher(partial(self._store_completed, on_finished=on_finished)), 
+                                                 description=desc, args=args)
         job._tdir = tdir
         self.gui.status_bar.show_message(_('Sony Utilities') + ' - ' + desc, 3000)
 
 
-    def _store_completed(self, job):
-        import pydevd;pydevd.settrace()
+    def _store_completed(self, job, on_finished=None):
+        if on_finished is not None:
+            on_finished()
         if job.failed:
             self.gui.job_exception(job, dialog_title=_('Failed to get reading positions'))
             return
@@ -1421,7 +1695,7 @@ class sonyutilitiesAction(InterfaceAction):
 
             if options[cfg.KEY_PROMPT_TO_STORE]:
                 db = self.gui.current_db
-                dlg = ShowReadingPositionChangesDialog(self.gui, self, job.result, db)
+                dlg = dialogs.ShowReadingPositionChangesDialog(self.gui, self, job.result, db)
                 dlg.exec_()
                 if dlg.result() != dlg.Accepted:
                     debug_print("dialog cancelled")
@@ -1430,7 +1704,7 @@ class sonyutilitiesAction(InterfaceAction):
             self._update_database_columns(modified_epubs_map)
 
 
-    def _device_database_backup(self, **backup_options):
+    def _device_database_backup(self, on_finished=None, **backup_options):
         debug_print('device_information=', backup_options)
         
 #        func = 'arbitrary_n'
@@ -1438,17 +1712,22 @@ class sonyutilitiesAction(InterfaceAction):
         from calibre_plugins.sonyutilities.jobs import do_device_database_backup
         args = [backup_options,  ]
         desc = _("Backing up Sony device database")
-        job = self.gui.device_manager.create_job(do_device_database_backup, self.Dispatcher(self._device_database_backup_completed), description=desc, args=args)
+        job = self.gui.device_manager.create_job(do_device_database_backup, 
+                                                 self.Dispatcher(partial(self._device_database_backup_completed, on_finished=on_finished)), 
+                                                 description=desc, args=args)
         job._tdir = None
         self.gui.status_bar.show_message(_("Sony Utilities") + " - " + desc, 3000)
 
 
-    def _device_database_backup_completed(self, job):
+    def _device_database_backup_completed(self, job, on_finished=None):
+        if on_finished is not None:
+            on_finished()
         if job.failed:
             self.gui.job_exception(job, dialog_title=_("Failed to backup device database"))
             return
 
 
+    @instrumented()
     def _update_database_columns(self, reading_locations):
 #        reading_locations, options = payload
 #        debug_print("reading_locations=", reading_locations)
@@ -1586,12 +1865,10 @@ class sonyutilitiesAction(InterfaceAction):
         self.gui.status_bar.show_message(_('Sony Utilities') + ' - ' + _('Storing reading positions completed - {0} changed.').format(len(reading_locations)), 3000)
 
 
-    def _getAnnotationForSelected(self, *args):
+    def _getAnnotationForSelected(self, export_file=None, sync_column=None):
         # Generate a path_map from selected ids
         def get_ids_from_selected_rows():
             rows = self.gui.library_view.selectionModel().selectedRows()
-            if not rows or len(rows) < 1:
-                rows = xrange(self.gui.library_view.model().rowCount(QModelIndex()))
             ids = map(self.gui.library_view.model().id, rows)
             return ids
 
@@ -1627,8 +1904,6 @@ class sonyutilitiesAction(InterfaceAction):
                     path_map[_id] = dict(path=the_path, fmts=get_formats(_id))
             return path_map
 
-        annotationText = []
-
         if self.gui.current_view() is not self.gui.library_view:
             return error_dialog(self.gui,  _("Use library only"),
                      _("User annotations generated from main library only"),
@@ -1651,39 +1926,79 @@ class sonyutilitiesAction(InterfaceAction):
                      _("None of the books selected were on the device. Annotations can only be copied for books on the device."),
                     show=True)
 
-        from calibre.ebooks.BeautifulSoup import BeautifulSoup, Tag, NavigableString
         from calibre.ebooks.metadata import authors_to_string
+        book_details = {}
+        for id_ in path_map:
+            book_details[id_] = (db.new_api.field_for('title', id_), 
+                                 authors_to_string(db.new_api.field_for('authors', id_)))
+
+        # Hash what is in the column now, so only the changed annotations are sent back
+        sync_hashes = None
+        if sync_column:
+            sync_hashes = {}
+            for id_ in path_map:
+                sync_hashes[id_] = annotation_hash(db.new_api.field_for(sync_column, id_))
+
+        # Fetch the annotations in the device thread, rather than blocking the GUI
+        from calibre_plugins.sonyutilities.jobs import do_fetch_annotations
+        locations = {}
+        for location in self.current_device_info.values():
+            locations[location['prefix']] = (self.device_database_path[location['prefix']], location['device_store_uuid'])
+        # The viewer is opened now, and each batch is added to it as soon as it has been fetched
+        viewer = None
+        show_annotations = None
+        if not sync_column:
+            viewer = ViewLog("Sony Annotation", "", parent=self.gui)
+            viewer.setWindowIcon(self.qaction.icon())
+            viewer.show()
+            show_annotations = self.Dispatcher(partial(self._annotations_fetched, viewer))
+        args = [self.device, path_map, book_details, locations, export_file, sync_hashes, show_annotations]
+        desc = _("Fetching annotations for {0} books").format(len(path_map))
+        job = self.gui.device_manager.create_job(do_fetch_annotations, 
+                                                 self.Dispatcher(partial(self._fetch_annotations_completed, sync_column=sync_column, viewer=viewer)), 
+                                                 description=desc, args=args)
+        job._tdir = None
+        self.gui.status_bar.show_message(_("Sony Utilities") + " - " + desc, 3000)
 
-        # Dispatch to the device get_annotations()
-        debug_print("path_map=", path_map)
-        bookmarked_books = self.device.get_annotations(path_map)
-        debug_print("bookmarked_books=", bookmarked_books)
-
-        for id_ in bookmarked_books.keys():
-            bm = self.device.UserAnnotation(bookmarked_books[id_][0], bookmarked_books[id_][1])
-
-            mi = db.get_metadata(id_, index_is_id=True)
-
-            user_notes_soup = self.device.generate_annotation_html(bm.value)
-            spanTag = Tag(user_notes_soup, 'span')
-            spanTag['style'] = 'font-weight:normal'
-            spanTag.insert(0,NavigableString(
-                "<hr /><b>%(title)s</b> by <b>%(author)s</b>" % \
-                            dict(title=mi.title,
-                            #loc=last_read_location,
-                            author=authors_to_string(mi.authors))))
-            user_notes_soup.insert(0, spanTag)
-            bookmark_html = unicode(user_notes_soup.prettify())
-            debug_print(bookmark_html)
-            annotationText.append(bookmark_html)
-
-        d = ViewLog("Sony Annotation", "\n".join(annotationText), parent=self.gui)
-#        d = ViewLog("Sony Annotation", unicode(j), parent=self.gui)
-        d.setWindowIcon(self.qaction.icon())
-#       d.setWindowIcon(get_icon('bookmarks.png'))
-        d.exec_()
+
+    def _annotations_fetched(self, viewer, viewer_html):
+        if viewer.isVisible():
+            viewer.tb.append("\n".join(viewer_html))
 
 
+    def _fetch_annotations_completed(self, job, sync_column=None, viewer=None):
+        if job.failed:
+            # The viewer was opened before the job ran, don't leave it empty beside the error
+            if viewer is not None:
+                viewer.close()
+            self.gui.job_exception(job, dialog_title=_("Failed to fetch annotations"))
+            return
+        from calibre_plugins.sonyutilities.jobs import ANNOTATION_VIEWER_MAX_BOOKS
+        annotated_books, export_file, changed_annotations = job.result
+        debug_print("annotated_books=%d, export_file=%s" % (annotated_books, export_file))
+        if sync_column:
+            self._sync_annotations(sync_column, changed_annotations)
+            return
+        if export_file is not None:
+            self.gui.status_bar.show_message(_("Sony Utilities") + " - " + 
+                                             _("Annotations for {0} books exported to {1}").format(annotated_books, export_file), 5000)
+        if annotated_books == 0:
+            self._annotations_fetched(viewer, [_("<p>None of the selected books have annotations.</p>")])
+        elif annotated_books > ANNOTATION_VIEWER_MAX_BOOKS:
+            self._annotations_fetched(viewer, [_("<hr /><p>Only the first {0} of {1} books are shown.</p>").format(ANNOTATION_VIEWER_MAX_BOOKS, annotated_books)])
+
+
+    @instrumented()
+    def _sync_annotations(self, sync_column, changed_annotations):
+        debug_print("Updating metadata - for column: %s number of changes=%d" % (sync_column, len(changed_annotations)))
+        if changed_annotations:
+            self.gui.current_db.new_api.set_field(sync_column, changed_annotations)
+            self.gui.iactions['Edit Metadata'].refresh_gui(list(changed_annotations))
+        self.gui.status_bar.show_message(_("Sony Utilities") + " - " + 
+                                         _("Syncing annotations completed - {0} changed.").format(len(changed_annotations)), 5000)
+
+
+    @instrumented()
     def _upload_covers(self, books):
 
         uploaded_covers     = 0
@@ -1705,8 +2020,9 @@ class sonyutilitiesAction(InterfaceAction):
         return total_books, uploaded_covers, not_on_device_books
 
 
+    @instrumented()
     def _remove_covers(self, books):
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
+        with closing(connect_device_database(self.device_database_path())) as connection:
             # return bytestrings if the content cannot the decoded as unicode
             connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
 
@@ -1753,8 +2069,9 @@ class sonyutilitiesAction(InterfaceAction):
         return removed_covers, not_on_device_books, total_books
 
 
+    @instrumented()
     def _test_covers(self, books):
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
+        with closing(connect_device_database(self.device_database_path())) as connection:
             # return bytestrings if the content cannot the decoded as unicode
             connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
 
@@ -1813,27 +2130,11 @@ class sonyutilitiesAction(InterfaceAction):
 
 
     def _get_imageid_set(self):
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-
-            imageId_query = 'SELECT DISTINCT ImageId '       \
-                            'FROM content '         \
-                            'WHERE BookID IS NULL'
-            cursor = connection.cursor()
-
-            imageIDs = []
-            cursor.execute(imageId_query)
-            for row in cursor:
-                imageIDs.append(row[0])
-#                debug_print("row[0]='%s'" % (row[0]))
-            connection.commit()
-
-            cursor.close()
-
-        return set(imageIDs)
+        with self.device_database_snapshot(self.device_database_path()) as database:
+            return services.image_id_set(database)
 
 
+    @instrumented()
     def _check_book_in_database(self, books):
         with closing(SonyDB(self.device_database_path)) as cursors:
             not_on_device_books = []
@@ -1851,86 +2152,50 @@ class sonyutilitiesAction(InterfaceAction):
 
 
     def _get_shelf_count(self):
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-
-            shelves = []
-
-            shelves_query = ("SELECT Name, MIN(CreationDate), MAX(CreationDate), COUNT(*) "
-                            "FROM Shelf "
-                            "WHERE _IsDeleted = 'false' "
-                            "GROUP BY Name")
-
-            cursor = connection.cursor()
-            cursor.execute(shelves_query)
-    #        count_bookshelves = 0
-            for i, row in enumerate(cursor):
-                debug_print("row:", i, row[0], row[1], row[2], row[3])
-                shelves.append([row[0], convert_sony_date(row[1]), convert_sony_date(row[2]), int(row[3]) ])
-    
-            cursor.close()
-        return shelves
+        return services.shelf_count(self.device_database_path())
 
 
+    @instrumented()
     def _get_series_shelf_count(self, order_shelf_type):
         debug_print("order_shelf_type:", order_shelf_type)
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+        shelves = []
+        for shelf in self._get_shelf_statistics():
+            if order_shelf_type == cfg.KEY_ORDER_SHELVES_SERIES:
+                wanted = shelf['is_series']
+            elif order_shelf_type == cfg.KEY_ORDER_SHELVES_AUTHORS:
+                wanted = shelf['is_author']
+            elif order_shelf_type == cfg.KEY_ORDER_SHELVES_OTHER:
+                wanted = not (shelf['is_series'] or shelf['is_author'])
+            else:
+                wanted = True
+            if wanted:
+                shelves.append({'name': shelf['name'], 'count': shelf['count']})
+        debug_print("number of shelves:", len(shelves))
+        return shelves
 
-            shelves = []
-
-            series_query = ("SELECT Name, count(*) "
-                            "FROM Shelf s JOIN ShelfContent sc on name = ShelfName "
-                            "WHERE s._IsDeleted = 'false' "
-                            "AND sc._IsDeleted = 'false' "
-                            "AND EXISTS (SELECT 1 FROM content c WHERE s.Name = c.Series ) "
-                            "GROUP BY Name"
-                            )
-            authors_query = ("SELECT Name, count(*) "
-                            "FROM Shelf s JOIN ShelfContent sc on name = ShelfName "
-                            "WHERE s._IsDeleted = 'false' "
-                            "AND sc._IsDeleted = 'false' "
-                            "AND EXISTS (SELECT 1 FROM content c WHERE s.Name = c.Attribution ) "
-                            "GROUP BY Name"
-                            )
-            other_query = ("SELECT Name, count(*) "
-                            "FROM Shelf s JOIN ShelfContent sc on name = ShelfName "
-                            "WHERE s._IsDeleted = 'false' "
-                            "AND sc._IsDeleted = 'false' "
-                            "AND NOT EXISTS (SELECT 1 FROM content c WHERE s.Name = c.Attribution ) "
-                            "AND NOT EXISTS (SELECT 1 FROM content c WHERE s.Name = c.Series ) "
-                            "GROUP BY Name"
-                            )
-            all_query = ("SELECT Name, count(*) "
-                            "FROM Shelf s JOIN ShelfContent sc on name = ShelfName "
-                            "WHERE s._IsDeleted = 'false' "
-                            "AND sc._IsDeleted = 'false' "
-                            "GROUP BY Name"
-                            )
-
-            shelves_queries= [series_query, authors_query, other_query, all_query]
-            shelves_query = shelves_queries[order_shelf_type]
-            debug_print("shelves_query:", shelves_query)
 
-            cursor = connection.cursor()
-            cursor.execute(shelves_query)
-    #        count_bookshelves = 0
-            for i, row in enumerate(cursor):
-                debug_print("row:", i, row[0], row[1])
-                shelf = {}
-                shelf['name']  = row[0]
-                shelf['count'] = int(row[1])
-                shelves.append(shelf)
+    def _get_shelf_statistics(self):
+        """
+        Return the name, book count and classification (series/author) of every shelf
 
-            cursor.close()
-        debug_print("shelves:", shelves)
+        The statistics are cached against the database version, so switching between shelf
+        types in the Order Series Shelves dialog does not query the device again unless the
+        database has been changed in the meantime.
+        """
+        database = self.device_database_path()
+        version  = (database, database_version(database))
+        cached   = getattr(self, '_shelf_statistics_cache', None)
+        if cached is not None and cached[0] == version:
+            debug_print("using cached shelf statistics")
+            return cached[1]
+
+        with self.device_database_snapshot(database) as local_database:
+            shelves = services.shelf_statistics(local_database)
+        self._shelf_statistics_cache = (version, shelves)
         return shelves
 
 
     def _order_series_shelves(self, shelves, options):
-        
         def urlquote(shelf_name):
             """ Quote URL-unsafe characters, For unsafe characters, need "%xx" rather than the 
             other encoding used for urls.  
@@ -1948,242 +2213,54 @@ class sonyutilitiesAction(InterfaceAction):
                 try:
                     if not char in URL_SAFE:
                         char = ("%%%02x" % ord(char)).upper()
-                        debug_print("unsafe after ord char=", char)
+                        shelves_log.debug("unsafe after ord char=%s", char)
                 except:
                     char = "%%%02x" % ord(char).upper()
                 result.append(char)
             return ''.join(result)
 
 
-        debug_print("shelves:", shelves, " options:", options)
-        import re
         from urllib import quote
 #        from calibre.ebooks.oeb.base import urlquote
-        
-        starting_shelves = 0
-        shelves_ordered  = 0
-        timeDiff         = timedelta(0, 1)
-        sort_descending  = not options[cfg.KEY_SORT_DESCENDING]
-        order_by         = options[cfg.KEY_ORDER_SHELVES_BY]
-        update_config = options[cfg.KEY_SORT_UPDATE_CONFIG]
-        if update_config:
-            sonyConfig, config_file_path = self.get_config_file()
 
-        import sqlite3 
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-            connection.row_factory  = sqlite3.Row
-
-            shelves_query = ("SELECT ShelfName, c.ContentId, c.Title, c.DateCreated, DateModified, Series, SeriesNumber "
-                             "FROM ShelfContent sc JOIN content c on sc.ContentId= c.ContentId "
-                             "WHERE sc._IsDeleted = 'false' "
-                             "AND ShelfName = ? "
-                             "ORDER BY ShelfName, SeriesNumber"
-                            )
-            update_query = ("UPDATE ShelfContent "
-                            "SET DateModified = ? "
-                            "WHERE ShelfName = ? "
-                            "AND ContentID = ? "
-                            )
+        with self.device_database_snapshot(self.device_database_path()) as database:
+            starting_shelves, ordered_shelves = services.order_series_shelves(database, shelves, options,
+                                                                              self.device_timestamp_string(),
+                                                                              journal=self.change_journal('order_series_shelves'))
 
-            cursor = connection.cursor()
-            for shelf in shelves:
-                starting_shelves += 1
-                debug_print("shelf=%s, count=%d" % (shelf['name'], shelf['count']))
-                if shelf['count'] <= 1:
-                    continue
-                shelves_ordered += 1
-                shelf_data = (shelf['name'],)
-                debug_print("shelf_data:", shelf_data)
-                cursor.execute(shelves_query, shelf_data)
-                shelf_dict = {}
-                for i, row in enumerate(cursor):
-                    debug_print("row:", i, row["ShelfName"], row["ContentId"], row['Series'], row["SeriesNumber"])
-                    series_name = row['Series'] if row['Series'] else ''
-                    try:
-                        series_index = float(row["SeriesNumber"]) if row["SeriesNumber"] is not None else None
-                    except:
-                        debug_print("non numeric number")
-                        numbers = re.findall(r"\d*\.?\d+", row["SeriesNumber"])
-                        if len(numbers) > 0:
-                            series_index = float(numbers[0])
-                    debug_print("series_index=", series_index)
-#                    series_index_str = "%10.4f"%series_index if series_index else ''
-#                    sort_str = series_name + series_index_str + row['Title']
-                    if order_by == cfg.KEY_ORDER_SHELVES_PUBLISHED:
-                        sort_key = (row['DateCreated'], row['Title'])
-                    else:
-                        sort_key = (series_name, series_index, row['Title']) if not series_name == '' else (row['Title'])
-                    series_entry = shelf_dict.get(sort_key, None)
-                    if series_entry:
-                        shelf_dict[sort_key].append(row['ContentId'])
+        if options[cfg.KEY_SORT_UPDATE_CONFIG]:
+            sonyConfig, config_file_path = self.get_config_file()
+            for shelf_name in ordered_shelves:
+                try:
+                    shelf_key = quote("LastLibrarySorter_shelf_filterByBookshelf(" + shelf_name + ")")
+                except:
+                    shelves_log.debug("cannot encode shelf name=%r", shelf_name)
+                    if isinstance(shelf_name, unicode):
+                        shelves_log.debug("is unicode")
+                        shelf_key = urlquote(shelf_name)
+                        shelf_key = quote("LastLibrarySorter_shelf_filterByBookshelf(") + shelf_key + quote(")")
                     else:
-                        shelf_dict[sort_key] = [row['ContentId']]
-                debug_print("shelf_dict:", shelf_dict)
-                
-                debug_print("sorted shelf_dict:", sorted(shelf_dict))
-                
-                lastModifiedTime = datetime.fromtimestamp(time.mktime(time.gmtime()))
-                
-                debug_print("lastModifiedTime=", lastModifiedTime, " timeDiff:", timeDiff)
-                for sort_key in sorted(shelf_dict, reverse=sort_descending):
-                    for contentId in shelf_dict[sort_key]:
-                        update_data = (strftime(self.device_timestamp_string(), lastModifiedTime.timetuple()), shelf['name'], contentId)
-                        debug_print("sort_key: ", sort_key,  " update_data:", update_data)
-                        cursor.execute(update_query, update_data)
-                        lastModifiedTime += timeDiff
-                if update_config:
-                    try:
-                        shelf_key = quote("LastLibrarySorter_shelf_filterByBookshelf(" + shelf['name'] + ")")
-                    except:
-                        debug_print("cannot encode shelf name=", shelf['name'])
-                        if isinstance(shelf['name'], unicode):
-                            debug_print("is unicode")
-                            shelf_key = urlquote(shelf['name'])
-                            shelf_key = quote("LastLibrarySorter_shelf_filterByBookshelf(") + shelf_key + quote(")")
-                        else:
-                            debug_print("not unicode")
-                            shelf_key = "LastLibrarySorter_shelf_filterByBookshelf(" + shelf['name'] + ")"
-                    sonyConfig.set('ApplicationPreferences', shelf_key , "sortByDateAddedToShelf()")
-#                    debug_print("set shelf_key=", shelf_key)
+                        shelves_log.debug("not unicode")
+                        shelf_key = "LastLibrarySorter_shelf_filterByBookshelf(" + shelf_name + ")"
+                sonyConfig.set('ApplicationPreferences', shelf_key , "sortByDateAddedToShelf()")
 
-            cursor.close()
-            connection.commit()
-            if update_config:
-                with open(config_file_path, 'wb') as config_file:
-                    debug_print("writing config file")
-                    sonyConfig.write(config_file)
-        debug_print("end")
-        return starting_shelves, shelves_ordered
+            with open(config_file_path, 'wb') as config_file:
+                shelves_log.debug("writing config file")
+                sonyConfig.write(config_file)
+        return starting_shelves, len(ordered_shelves)
 
 
     def _remove_duplicate_shelves(self, shelves, options):
-        debug_print("total shelves=%d: options=%s" % (len(shelves), options))
-        import sqlite3 
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-            connection.row_factory = sqlite3.Row
-
-            starting_shelves    = 0
-            shelves_removed     = 0
-            finished_shelves    = 0
-
-            shelves_update = ("UPDATE Shelf "
-                              "SET _IsDeleted = 'true', "
-                              "LastModified = ? "
-                              "WHERE _IsSynced = 'true' "
-                              "AND Name = ? "
-                              "AND CreationDate <> ?"
-                              )
-            shelves_query = ("SELECT * FROM Shelf "
-                              "WHERE _IsSynced = 'true' "
-                              "AND Name = ? "
-                              "AND CreationDate = ?"
-                              )
-
-            shelves_delete = ("DELETE FROM Shelf "
-                              "WHERE _IsSynced = 'false' "
-                              "AND Name = ? "
-                              "AND CreationDate <> ? "
-                              "AND _IsDeleted = 'true'"
-                              )
-
-            shelves_purge = ("DELETE FROM Shelf "
-                             "WHERE _IsDeleted = 'true'"
-                            )
-
-            purge_shelves = options[cfg.KEY_PURGE_SHELVES]
-            keep_newest   = options[cfg.KEY_KEEP_NEWEST_SHELF]
-
-            cursor = connection.cursor()
-    #        count_bookshelves = 0
-            for shelf in shelves:
-                starting_shelves += shelf[3]
-                finished_shelves += 1
-                if shelf[3] > 1:
-                    debug_print("shelf:", shelf[0], shelf[1], shelf[2], shelf[3])
-                    timestamp = shelf[2] if keep_newest else shelf[1]
-                    shelves_values = (shelf[0], timestamp.strftime(self.device_timestamp_string()))
-
-                    cursor.execute(shelves_query, shelves_values)
-                    for row in cursor:
-                        debug_print("row: ", row['Name'], row['CreationDate'], row['_IsDeleted'], row['_IsSynced'])
-
-                    shelves_update_values = (strftime(self.device_timestamp_string(), time.gmtime()), shelf[0], timestamp.strftime(self.device_timestamp_string()))
-                    debug_print("marking as deleted:", shelves_update_values)
-                    cursor.execute(shelves_update, shelves_update_values)
-                    cursor.execute(shelves_delete, shelves_values)
-                    shelves_removed += shelf[3] - 1
-
-            if purge_shelves:
-                debug_print("purging all shelves marked as deleted")
-                cursor.execute(shelves_purge)
-
-            cursor.close()
-            connection.commit()
-
-        return starting_shelves, shelves_removed, finished_shelves
-
-
-    def _vacuum_device_database(self, database):
-        with closing(sqlite3.connect(database)) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-            cursor = connection.cursor()
-
-            compress_query  = 'VACUUM'
-            compress_result = ''
-            cursor.execute(compress_query)
-            result = cursor.fetchall()
-            if not result is None:
-                debug_print("result=", result)
-                for line in result:
-                    compress_result += '\n' + line[0]
-                    debug_print("result line=", line[0])
-            else:
-                compress_result = _("Execution of '%s' failed") % compress_query
-
-            connection.commit()
-
-            cursor.close()
-
-        return compress_result
+        debug_print("total shelves=%d" % len(shelves))
+        with self.device_database_snapshot(self.device_database_path()) as database:
+            return services.remove_duplicate_shelves(database, options, self.device_timestamp_string(),
+                                                     journal=self.change_journal('remove_duplicate_shelves'))
 
 
     def generate_metadata_query(self):
-        debug_print("self.supports_series=", self.supports_series)
-        test_query = 'SELECT Title,   '\
-                    '    Attribution, '\
-                    '    Description, '\
-                    '    Publisher,   '
-        if self.supports_series:
-            debug_print("supports series is true")
-            test_query += ' Series,       '\
-                          ' SeriesNumber, '\
-                          ' Subtitle, '
-        else:
-            test_query += ' null as Series, '      \
-                          ' null as SeriesNumber,'
-        test_query += ' ReadStatus, '        \
-                      ' DateCreated, '       \
-                      ' Language, '
-        test_query += ' NULL as ISBN, '              \
-                          ' NULL as FeedbackType, '      \
-                          ' NULL as FeedbackTypeSynced, '\
-                          ' NULL as Rating, '            \
-                          ' NULL as DateModified '
-
-        test_query += 'FROM content c1 '
-        if self.supports_ratings:
-            test_query += ' left outer join ratings r on c1.ContentID = r.ContentID '
-
-        test_query += 'WHERE c1.BookId IS NULL '  \
-                      'AND c1.ContentId = ?'
-        debug_print("test_query=%s" % test_query)
-        return test_query
+        return services.metadata_query(self.supports_series, self.supports_ratings)
 
+    @instrumented()
     def _update_metadata(self, books):
         from calibre.ebooks.metadata import authors_to_string
         from calibre.utils.localization import canonicalize_lang, lang_as_iso639_1
@@ -2201,8 +2278,13 @@ class sonyutilitiesAction(InterfaceAction):
         library_db     = self.gui.current_db
         cfg.get_library_config(library_db)
 
-        with closing(SonyDB(self.device_database_path)) as cursors:
+        # Only worth building indexes when there are enough books to outweigh the cost
+        helper_indexes = HELPER_INDEXES if len(books) >= HELPER_INDEXES_MIN_BOOKS else []
+        with self.device_database_snapshot(self.device_database_path) as databases, \
+             closing(HelperIndexes(databases.values(), helper_indexes)), \
+             closing(SonyDB(databases)) as cursors:
             test_query = self.generate_metadata_query()
+            journals   = dict((prefix, self.change_journal('update_metadata', prefix)) for prefix in databases)
             
             for book in books:
 #                device_book_paths = self.get_device_paths_from_id(book.id)
@@ -2211,9 +2293,10 @@ class sonyutilitiesAction(InterfaceAction):
                     if not contentID:
                         contentID = self.get_contentID_from_path(book.path, cursors)
                     if book.path.startswith(self.device._main_prefix):
-                        cursor = cursors(self.device._main_prefix) 
+                        prefix = self.device._main_prefix
                     else:
-                        cursor = cursors(self.device._card_a_prefix) 
+                        prefix = self.device._card_a_prefix
+                    cursor = cursors[prefix].cursor
         
                     count_books += 1
                     query_values = (contentID,)
@@ -2375,12 +2458,12 @@ class sonyutilitiesAction(InterfaceAction):
                         debug_print("update_values= ", update_values)
                         try:
                             if changes_found:
-                                cursor.execute(update_query, update_values)
+                                journals[prefix].execute(update_query, update_values)
 
                             if rating_change_query:
                                 debug_print("rating_change_query=%s" % rating_change_query)
                                 debug_print("rating_values= ", rating_values)
-                                cursor.execute(rating_change_query, rating_values)
+                                journals[prefix].execute(rating_change_query, rating_values)
 
                             updated_books += 1
                         except:
@@ -2389,7 +2472,8 @@ class sonyutilitiesAction(InterfaceAction):
                     else:
                         debug_print("no match for title='%s' contentId='%s'" % (book.title, contentID))
                         not_on_device_books += 1
-                    connection.commit()
+            for prefix, journal in journals.items():
+                journal.apply(cursors[prefix].cursor.connection)
             debug_print("Update summary: Books updated=%d, unchanged books=%d, not on device=%d, Total=%d" % (updated_books, unchanged_books, not_on_device_books, count_books))
 
             cursor.close()
@@ -2398,314 +2482,67 @@ class sonyutilitiesAction(InterfaceAction):
 
 
     def _store_current_bookmark(self, books, options=None):
+        from calibre.ebooks.metadata import authors_to_string
         
         if options:
             self.options = options
 
-        books_with_bookmark    = 0
-        books_without_bookmark = 0
-        count_books            = 0
-        clear_if_unread          = self.options[cfg.KEY_CLEAR_IF_UNREAD]
-        store_if_more_recent     = self.options[cfg.KEY_STORE_IF_MORE_RECENT]
-        do_not_store_if_reopened = self.options[cfg.KEY_DO_NOT_STORE_IF_REOPENED]
-        
-        with closing(sqlite3.connect(self.device_database_path())) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-
-            library_db = self.gui.current_db
-            library_config = cfg.get_library_config(library_db)
-            sony_bookmark_column = library_config.get(cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN])
-            sony_percentRead_column         = library_config.get(cfg.KEY_PERCENT_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN])
-            rating_column                   = library_config.get(cfg.KEY_RATING_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_RATING_CUSTOM_COLUMN])
-            last_read_column                = library_config.get(cfg.KEY_LAST_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_LAST_READ_CUSTOM_COLUMN])
-            if sony_bookmark_column:
-                debug_print("sony_bookmark_column=", sony_bookmark_column)
-#                sony_bookmark_col = custom_cols[sony_bookmark_column]
-#                debug_print("sony_bookmark_col=", sony_bookmark_col)
-                sony_bookmark_col_label = library_db.field_metadata.key_to_label(sony_bookmark_column)
-                debug_print("sony_bookmark_col_label=", sony_bookmark_col_label)
-            if sony_percentRead_column:
-#                sony_percentRead_col = custom_cols[sony_percentRead_column]
-                sony_percentRead_col_label = library_db.field_metadata.key_to_label(sony_percentRead_column)
-
-            rating_col_label = library_db.field_metadata.key_to_label(rating_column) if rating_column else ''
-            if last_read_column:
-#                sony_percentRead_col = custom_cols[sony_percentRead_column]
-                last_read_col_label = library_db.field_metadata.key_to_label(last_read_column)
-
-            debug_print("sony_bookmark_column=", sony_bookmark_column)
-            debug_print("sony_percentRead_column=", sony_percentRead_column) 
-            debug_print("rating_column=", rating_column) 
-            debug_print("rating_col_label=", rating_col_label) 
-            debug_print("last_read_column=", last_read_column) 
-
-#            id_map = {}
-            cursor = connection.cursor()
-            for book in books:
-                count_books += 1
-#                mi = Metadata('Unknown')
-                for contentID in book.contentIDs:
-                    debug_print("contentId='%s'" % (contentID))
-                    fetch_values = (contentID,)
-                    fetch_query = EPUB_FETCH_QUERY
-                    debug_print("fetch_query='%s'" % (fetch_query))
-                    cursor.execute(fetch_query, fetch_values)
-                    result = cursor.fetchone()
-                    
-                    sony_bookmark = None
-                    sony_percentRead         = None
-                    last_read                = None
-                    update_library           = False
-                    if result is not None: 
-                        debug_print("result=", result)
-                        books_with_bookmark += 1
-                        if result[2] == 0 and clear_if_unread:
-                            sony_bookmark = None
-                            sony_percentRead         = None
-                            last_read                = None
-                            update_library           = True
-                        else:
-                            update_library = True
-                            if result[7] == MIMETYPE_SONY:
-                                sony_bookmark = result[0]
-                            else:
-                                sony_bookmark = result[0][len(contentID) + 1:] if result[0] else None
-                    
-                            if result[2] == 1: # or (result[2] == 0 and result[3] > 0):
-                                sony_percentRead = result[3]
-                            elif result[2] == 2:
-                                sony_percentRead = 100
-
-                                
-                            if result[5]:
-                                debug_print("result[5]=", result[5])
-                                last_read = convert_sony_date(result[5])
-                                debug_print("last_read=", last_read)
-
-                            if last_read_column and store_if_more_recent:
-            #                    last_read_col_label['#value#'] = last_read
-                                current_last_read = book.get_user_metadata(last_read_column, True)['#value#']
-                                debug_print("book.get_user_metadata(last_read_column, True)['#value#']=", current_last_read)
-                                debug_print("setting mi.last_read=", last_read)
-                                debug_print("store_if_more_recent - current_last_read < last_read=", current_last_read < last_read)
-                                if current_last_read and last_read:
-                                    update_library &= current_last_read < last_read
-                                elif last_read:
-                                    update_library &= True
-
-                            if sony_percentRead_column and do_not_store_if_reopened:
-                                current_percentRead = book.get_user_metadata(sony_percentRead_column, True)['#value#']
-                                debug_print("do_not_store_if_reopened - current_percentRead=", current_percentRead)
-                                update_library &= current_percentRead < 100
-
-                    elif self.options[cfg.KEY_CLEAR_IF_UNREAD]:
-                        books_with_bookmark += 1
-                        sony_bookmark        = None
-                        sony_percentRead     = None
-                        last_read            = None
-                        update_library       = True
-                    else:
-                        books_without_bookmark += 1
-                        continue
-                    
-                    if update_library:
-                        debug_print("sony_bookmark='%s'" % (sony_bookmark))
-                        debug_print("sony_percentRead=", sony_percentRead)
-                        if sony_bookmark_column:
-                            if sony_bookmark:
-                                new_value = sony_bookmark
-                            else:
-        #                        sony_bookmark_col['#value#'] = None
-                                new_value = None
-                                debug_print("setting bookmark column to None")
-        #                    mi.set_user_metadata(sony_bookmark_column, sony_bookmark_col)
-                            debug_print("on sony=", new_value)
-                            debug_print("in library=", book.get_user_metadata(sony_bookmark_column, True)['#value#'])
-                            debug_print("on sony==in library=", new_value == book.get_user_metadata(sony_bookmark_column, True)['#value#'])
-                            old_value = book.get_user_metadata(sony_bookmark_column, True)['#value#']
-                            if not old_value == new_value: 
-                                library_db.set_custom(book.calibre_id, new_value, label=sony_bookmark_col_label, commit=False)
-    
-                        if sony_percentRead_column:
-        #                    sony_percentRead_col['#value#'] = sony_percentRead
-                            debug_print("setting mi.sony_percentRead=", sony_percentRead)
-                            current_percentRead = book.get_user_metadata(sony_percentRead_column, True)['#value#']
-                            debug_print("percent read - in book=", current_percentRead)
-                            if not current_percentRead == sony_percentRead:
-                                library_db.set_custom(book.calibre_id, sony_percentRead, label=sony_percentRead_col_label, commit=False)
-        #                    mi.set_user_metadata(sony_percentRead_column, sony_percentRead_col)
-    
-                        if last_read_column:
-        #                    last_read_col_label['#value#'] = last_read
-                            current_last_read = book.get_user_metadata(last_read_column, True)['#value#']
-                            debug_print("book.get_user_metadata(last_read_column, True)['#value#']=", current_last_read)
-                            debug_print("setting mi.last_read=", last_read)
-                            debug_print("current_last_read == last_read=", current_last_read == last_read)
-                            if not current_last_read == last_read:
-                                library_db.set_custom(book.calibre_id, last_read, label=last_read_col_label, commit=False)
-        #                    mi.set_user_metadata(last_read_column, last_read_col_label)
-    
-        #                debug_print("mi=", mi)
-        #                id_map[book.calibre_id] = mi
-                    else:
-                        books_with_bookmark    -= 1
-                        books_without_bookmark += 1
+        library_db     = self.gui.current_db
+        library_config = cfg.get_library_config(library_db)
+        sony_bookmark_column    = library_config.get(cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN])
+        sony_percentRead_column = library_config.get(cfg.KEY_PERCENT_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN])
+        last_read_column        = library_config.get(cfg.KEY_LAST_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_LAST_READ_CUSTOM_COLUMN])
+        store_log.debug("sony_bookmark_column=%s sony_percentRead_column=%s last_read_column=%s",
+                        sony_bookmark_column, sony_percentRead_column, last_read_column)
 
-            connection.commit()
-            cursor.close()
-            
-#            edit_metadata_action = self.gui.iactions['Edit Metadata']
-#            edit_metadata_action.apply_metadata_changes(id_map)
-            library_db.commit()
-        
-        return (books_with_bookmark, books_without_bookmark, count_books)
+        book_positions = []
+        for book in books:
+            book_positions.append(dict(
+                id          = book.calibre_id,
+                title       = book.title,
+                authors     = authors_to_string(book.authors),
+                contentIds  = book.contentIDs,
+                paths       = book.paths,
+                bookmark    = book.get_user_metadata(sony_bookmark_column, True)['#value#'] if sony_bookmark_column else None,
+                percentRead = book.get_user_metadata(sony_percentRead_column, True)['#value#'] if sony_percentRead_column else None,
+                last_read   = book.get_user_metadata(last_read_column, True)['#value#'] if last_read_column else None
+            ))
+
+        with self.device_database_snapshot(self.device_database_path) as databases:
+            reading_locations = services.fetch_reading_positions(databases, book_positions, self.options)
+        if reading_locations:
+            self._update_database_columns(reading_locations)
+
+        count_books         = len(books)
+        books_with_bookmark = len(reading_locations)
+        return (books_with_bookmark, count_books - books_with_bookmark, count_books)
 
 
     def _restore_current_bookmark(self, books):
-        updated_books       = 0
-        not_on_device_books = 0
-        count_books         = 0
-
         library_db     = self.gui.current_db
         library_config = cfg.get_library_config(library_db)
-        sony_bookmark_column = library_config.get(cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN])
-        sony_percentRead_column         = library_config.get(cfg.KEY_PERCENT_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN])
-        last_read_column                = library_config.get(cfg.KEY_LAST_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_LAST_READ_CUSTOM_COLUMN])
-
-        chapter_query = 'SELECT c1.bookmark, ' \
-                               'c1.ReadStatus, '          \
-                               'c1.___PercentRead, '      \
-                               'c1.Attribution, '         \
-                               'c1.DateLastRead, '        \
-                               'c1.Title, '               \
-                               'c1.MimeType '
-        chapter_query += 'FROM content c1 '
-        chapter_query += 'WHERE c1.BookId IS NULL '  \
-                      'AND c1.ContentId = ?'
-
-        chapter_update  = 'UPDATE content '                \
-                            'SET bookmark = ? ' \
-                            '  , FirstTimeReading = ? '    \
-                            '  , ReadStatus = ? '          \
-                            '  , ___PercentRead = ? '      \
-                            '  , DateLastRead = ? '        \
-                            'WHERE BookID IS NULL '        \
-                            'AND ContentID = ?'
-
-        with closing(sqlite3.connect(self.device_database_path()
-            )) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-            connection.row_factory = sqlite3.Row
-
-            cursor = connection.cursor()
-
-            for book in books:
-                count_books += 1
-                for contentID in book.contentIDs:
-                    chapter_values = (contentID,)
-                    cursor.execute(chapter_query, chapter_values)
-                    result = cursor.fetchone()
-                    
-                    if result is not None: # and not result[6] == MIMETYPE_SONY:
-                        debug_print("result= ", result)
-                        chapter_update          = 'UPDATE content SET '
-                        chapter_set_clause      = ''
-                        chapter_values          = []
-                        location_update         = 'UPDATE content SET '
-                        location_set_clause     = ''
-                        location_values         = []
-                        
-                        sony_bookmark           = None
-                        sony_percentRead        = None
-    
-                        if sony_bookmark_column:
-                            reading_location_string  = book.get_user_metadata(sony_bookmark_column, True)['#value#']
-                            debug_print("reading_location_string=", reading_location_string)
-                            if reading_location_string:
-                                if result['MimeType'] == MIMETYPE_SONY:
-                                    sony_bookmark = reading_location_string
-                                else:
-                                    reading_location_parts   = reading_location_string.split(BOOKMARK_SEPARATOR)
-                                    sony_bookmark = (contentID + "#" + reading_location_parts[0]) if len(reading_location_parts) > 0 else None
-                            else:
-                                sony_bookmark = None
-                        
-                            if reading_location_string:
-                                chapter_values.append(sony_bookmark)
-                                chapter_set_clause += ', bookmark  = ? '
-                            else:
-                                debug_print("reading_location_string=", reading_location_string)
-
-                        if sony_percentRead_column:
-                            sony_percentRead = book.get_user_metadata(sony_percentRead_column, True)['#value#']
-                            sony_percentRead = sony_percentRead if sony_percentRead else result['___PercentRead']
-                            chapter_values.append(sony_percentRead)
-                            chapter_set_clause += ', ___PercentRead  = ? '
-
-                        if self.options[cfg.KEY_READING_STATUS]:
-                            if sony_percentRead:
-                                debug_print("chapter_values= ", chapter_values)
-                                if sony_percentRead == 100:
-                                    chapter_values.append(2)
-                                    debug_print("chapter_values= ", chapter_values)
-                                else:
-                                    chapter_values.append(1)
-                                    debug_print("chapter_values= ", chapter_values)
-                                chapter_set_clause += ', ReadStatus  = ? '
-                                chapter_values.append('false')
-                                chapter_set_clause += ', FirstTimeReading = ? '
-
-                        last_read = None
-                        if self.options[cfg.KEY_DATE_TO_NOW]:
-                            chapter_values.append(strftime(self.device_timestamp_string(), time.gmtime()))
-                            chapter_set_clause += ', DateLastRead  = ? '
-                        elif last_read_column:
-                            last_read = book.get_user_metadata(last_read_column, True)['#value#']
-                            if last_read is not None:
-                                chapter_values.append(last_read.strftime(self.device_timestamp_string()))
-                                chapter_set_clause += ', DateLastRead  = ? '
+        columns = [('bookmark',    library_config.get(cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN])),
+                   ('percentRead', library_config.get(cfg.KEY_PERCENT_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN])),
+                   ('last_read',   library_config.get(cfg.KEY_LAST_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_LAST_READ_CUSTOM_COLUMN]))]
 
-                        debug_print("found contentId='%s'" % (contentID))
-                        debug_print("sony_bookmark=", sony_bookmark)
-                        debug_print("sony_percentRead=", sony_percentRead)
-                        debug_print("last_read=", last_read)
-#                        debug_print("    result=", result)
-    
-                        if len(chapter_set_clause) > 0:
-                            chapter_update += chapter_set_clause[1:]
-                            chapter_update += 'WHERE ContentID = ? AND BookID IS NULL'
-                            chapter_values.append(contentID)
-                        else:
-                            debug_print("no changes found to selected metadata. No changes being made.")
-                            not_on_device_books += 1
-                            continue
-    
-                        debug_print("chapter_update=%s" % chapter_update)
-                        debug_print("chapter_values= ", chapter_values)
-                        try:
-                            cursor.execute(chapter_update, chapter_values)
-                                
-                            updated_books += 1
-                        except:
-                            debug_print('    Database Exception:  Unable to set bookmark info.')
-                            raise
-                    else:
-                        debug_print("no match for title='%s' contentId='%s'" % (book.title, book.contentID))
-                        not_on_device_books += 1
-                    connection.commit()
-            debug_print("Update summary: Books updated=%d, not on device=%d, Total=%d" % (updated_books, not_on_device_books, count_books))
-
-            cursor.close()
-        
-        return (updated_books, not_on_device_books, count_books)
+        # Only the configured columns are passed, so only those are written to the device
+        book_positions = []
+        for book in books:
+            book_position = dict(title=book.title, contentIds=book.contentIDs)
+            for key, column in columns:
+                if column:
+                    book_position[key] = book.get_user_metadata(column, True)['#value#']
+            book_positions.append(book_position)
 
+        with self.device_database_snapshot(self.device_database_path()) as database:
+            return services.restore_reading_positions(database, book_positions, self.options,
+                                                      self.device_timestamp_string(),
+                                                      journal=self.change_journal('restore_reading_positions'))
 
 
     def fetch_book_fonts(self):
         debug_print("start")
-        with closing(sqlite3.connect(self.device.normalize_path(
+        with closing(connect_device_database(self.device.normalize_path(
             self.device_path + DBPATH))) as connection:
             # return bytestrings if the content cannot the decoded as unicode
             connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
@@ -2750,96 +2587,13 @@ class sonyutilitiesAction(InterfaceAction):
 
 
     def _set_reader_fonts(self, contentIDs, delete=False):
-        debug_print("start")
-        updated_fonts  = 0
-        added_fonts    = 0
-        deleted_fonts  = 0
-        count_books    = 0
-
-        with closing(sqlite3.connect(self.device.normalize_path(
-            self.device_path + DBPATH))) as connection:
-            # return bytestrings if the content cannot the decoded as unicode
-            connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-
-            test_query = 'SELECT 1 '                    \
-                            'FROM content_settings '    \
-                            'WHERE ContentId = ?'
-            delete_query = 'DELETE FROM content_settings '    \
-                            'WHERE ContentId = ?'
-
-            if not delete:
-                font_face       = self.options[cfg.KEY_READING_FONT_FAMILY]
-                justification   = self.options[cfg.KEY_READING_ALIGNMENT].lower()
-                justification   = '' if justification == 'off' else justification
-                font_size       = self.options[cfg.KEY_READING_FONT_SIZE]
-                line_spacing    = self.options[cfg.KEY_READING_LINE_HEIGHT]
-                left_margins    = self.options[cfg.KEY_READING_LEFT_MARGIN]
-                right_margins   = self.options[cfg.KEY_READING_RIGHT_MARGIN]
-               
-                add_query = 'INSERT INTO content_settings ( '   \
-                                '"DateModified", '              \
-                                '"ReadingFontFamily", '         \
-                                '"ReadingFontSize", '           \
-                                '"ReadingAlignment", '          \
-                                '"ReadingLineHeight", '         \
-                                '"ReadingLeftMargin", '         \
-                                '"ReadingRightMargin", '        \
-                                '"ContentID" '                  \
-                                ') '                            \
-                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
-                add_values = (
-                              time.strftime(self.device_timestamp_string(), time.gmtime()), 
-                              font_face, 
-                              font_size, 
-                              justification, 
-                              line_spacing, 
-                              left_margins, 
-                              right_margins, 
-                              )
-                update_query = 'UPDATE content_settings '    \
-                                'SET "DateModified" = ?, '   \
-                                '"ReadingFontFamily" = ?, '  \
-                                '"ReadingFontSize" = ?, '    \
-                                '"ReadingAlignment" = ?, '   \
-                                '"ReadingLineHeight" = ?, '  \
-                                '"ReadingLeftMargin" = ?, '  \
-                                '"ReadingRightMargin" = ? '  \
-                                'WHERE ContentId = ?'
-                update_values = (
-                                 time.strftime(self.device_timestamp_string(), time.gmtime()), 
-                                 font_face, 
-                                 font_size, 
-                                 justification, 
-                                 line_spacing, 
-                                 left_margins, 
-                                 right_margins, 
-                                 )
-
-            cursor = connection.cursor()
-
-            for contentID in contentIDs:
-                test_values = (contentID,)
-                if delete:
-                    cursor.execute(delete_query, test_values)
-                    deleted_fonts += 1
-                else:
-                    cursor.execute(test_query, test_values)
-                    result = cursor.fetchone()
-                    if result is None:
-                        cursor.execute(add_query, add_values + (contentID,))
-                        added_fonts += 1
-                    else:
-                        cursor.execute(update_query, update_values + (contentID,))
-                        updated_fonts += 1
-                connection.commit()
-                count_books += 1
-
-            cursor.close()
-        
-        return updated_fonts, added_fonts, deleted_fonts, count_books
+        with self.device_database_snapshot(self.device.normalize_path(self.device_path + DBPATH)) as database:
+            return services.set_reader_fonts(database, contentIDs, self.options, self.device_timestamp_string(), delete=delete,
+                                             journal=self.change_journal('set_reader_fonts'))
 
 
     def get_config_file(self):
+        import ConfigParser
         config_file_path = self.device.normalize_path(self.device._main_prefix + '.sony/Sony/Sony eReader.conf')
         sonyConfig = ConfigParser.SafeConfigParser(allow_no_value=True)
         sonyConfig.optionxform = str
@@ -2861,6 +2615,48 @@ class sonyutilitiesAction(InterfaceAction):
         with open(config_file_path, 'wb') as config_file:
             sonyConfig.write(config_file)
 
+    def change_journal(self, operation, prefix=None):
+        '''
+        A journal for the changes an operation makes to the database on the main memory, or on the
+        card with the given prefix, saved so that they can be recovered if the reader is unplugged
+        '''
+        prefix = prefix or self.device._main_prefix
+        locations = self.current_device_info.values() if self.current_device_info else []
+        uuids = dict((location['prefix'], location['device_store_uuid']) for location in locations)
+        return ChangeJournal(operation, uuids.get(prefix))
+
+    def recover_change_journals(self, on_finished=None):
+        '''
+        Replay or discard the changes left unfinished when the reader was unplugged part way through an operation
+        '''
+        try:
+            for location in self.current_device_info.values():
+                journals = pending_change_journals([location['device_store_uuid']])
+                if not journals:
+                    continue
+                debug_print("unfinished journals for %s: %d" % (location['location_code'], len(journals)))
+                operations = ', '.join(sorted(set(journal.operation for journal in journals)))
+                replay = question_dialog(self.gui, _("Sony Utilities") + " - " + _("Unfinished changes"),
+                                         _("Changes to the reader's database ({0}) were not finished when it was last connected. "
+                                           "Do you want to make them now? If not, they will be discarded.").format(operations),
+                                         show_copy_button=False)
+                replayed, applied, discarded, failed = recover_change_journals(self.device_database_path[location['prefix']], journals, replay)
+                debug_print("journals replayed=%d, already applied=%d, discarded=%d, failed=%d" % (replayed, applied, discarded, len(failed)))
+                if failed:
+                    error_dialog(self.gui, _("Sony Utilities") + " - " + _("Unfinished changes"),
+                                 _("Some of the unfinished changes to the reader's database could not be made."),
+                                 det_msg='\n'.join('%s: %s' % (journal.operation, error) for journal, error in failed),
+                                 show=True)
+        finally:
+            if on_finished is not None:
+                on_finished()
+
+    def device_database_snapshot(self, databases):
+        '''
+        The databases for one operation to work on: copies on this computer if the option is set
+        '''
+        return DeviceDatabaseSnapshot(databases, enabled=cfg.get_plugin_pref(cfg.COMMON_OPTIONS_STORE_NAME, cfg.KEY_SNAPSHOT_DATABASE))
+
     def _device_database_paths(self):
         dbs = [(location['prefix'],self.device.normalize_path(location['prefix']) + DBPATH) 
                for location in self.current_device_info.values()]
@@ -2887,27 +2683,3 @@ class sonyutilitiesAction(InterfaceAction):
         if not (anchor or anchor == ''):
             url.setFragment(anchor)
         open_url(url)
-
-
-def check_device_database(database_path):
-    with closing(sqlite3.connect(database_path)) as connection:
-        # return bytestrings if the content cannot the decoded as unicode
-        connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-
-        check_query = 'PRAGMA integrity_check'
-        cursor = connection.cursor()
-
-        check_result = ''
-        cursor.execute(check_query)
-        result = cursor.fetchall()
-        if not result is None:
-            for line in result:
-                check_result += '\n' + line[0]
-#                debug_print("_check_device_database - result line=", line[0])
-        else:
-            check_result = _("Execution of '%s' failed") % check_query
-
-        connection.commit()
-        cursor.close()
-
-    return check_result
@@ -14,10 +14,9 @@ try:
 except ImportError:
     pass
 
-from calibre_plugins.sonyutilities.common_utils import debug_print
-from calibre.utils.date import format_date
+from calibre_plugins.sonyutilities.device_database import debug_print
+from calibre.utils.icu import sort_key as icu_sort_key
 from calibre.ebooks.metadata import fmt_sidx
-from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.oeb.iterator.book import EbookIterator as _iterator
 from calibre.ebooks.oeb.parse_utils import parse_html, xpath
 from lxml import etree
@@ -27,66 +26,151 @@ def get_indent_for_index(series_index):
         return 0
     return len(str(series_index).split('.')[1].rstrip('0'))
 
+SERIES_NUMBER_PATTERN    = re.compile(r"\d*\.?\d+")
+SERIES_NUMBER_CACHE_SIZE = 4096
+# An approximate least-recently-used cache, in two generations: when the recent generation
+# is full it replaces the older one, and entries found in the older one are moved back
+_series_number_cache     = [{}, {}]
+
+def parse_series_number(series_number):
+    """
+    Parse a series number as stored on the device, returning a tuple of (index, format, is_valid)
+
+    A plain number has no format. Otherwise the first number found in the text is the index,
+    and the format is the text with that number replaced by "%g", to allow it to be renumbered.
+    Results are cached, as the same few strings repeat across a library.
+
+    >>> from calibre_plugins.sonyutilities.book import parse_series_number
+    >>> print(parse_series_number('3'))
+    (3.0, None, True)
+    >>> index, format, is_valid = parse_series_number('Book 2.5 of 4')
+    >>> print('%s, %s, %s' % (index, format % 7, is_valid))
+    2.5, Book 7 of 4, True
+    >>> print(parse_series_number('Prequel'))
+    (None, None, False)
+    >>> print(parse_series_number(None))
+    (None, None, False)
+
+    """
+    recent, older = _series_number_cache
+    try:
+        return recent[series_number]
+    except KeyError:
+        pass
+    result = older.get(series_number)
+    if result is None:
+        if series_number is None:
+            return (None, None, False)
+        try:
+            result = (float(series_number), None, True)
+        except ValueError:
+            match = SERIES_NUMBER_PATTERN.search(series_number)
+            if match is None:
+                result = (None, None, False)
+            else:
+                result = (float(match.group()), series_number.replace(match.group(), "%g", 1), True)
+    if len(recent) >= SERIES_NUMBER_CACHE_SIZE:
+        _series_number_cache[:] = [{}, recent]
+        recent = _series_number_cache[0]
+    recent[series_number] = result
+    return result
+
+def parse_series_numbers(series_numbers):
+    """
+    Parse a column of series numbers in one pass, returning a list of (index, format, is_valid)
+
+    >>> from calibre_plugins.sonyutilities.book import parse_series_numbers
+    >>> print([index for index, format, is_valid in parse_series_numbers(['1', '1', 'Part 2', None])])
+    [1.0, 1.0, 2.0, None]
+
+    """
+    return [parse_series_number(series_number) for series_number in series_numbers]
+
 class SeriesBook(object):
+    """
+    The series details of a book being edited in the Manage Series dialog
+
+    Only the fields the dialog can edit are tracked. The original values are read from the
+    book's Metadata object, which isn't touched while editing: changes are kept in a small
+    dictionary that is only created when something is first changed, so reverting just
+    discards it, and get_mi_to_persist() writes the changes to the Metadata object.
+
+    >>> from calibre.ebooks.metadata.book.base import Metadata
+    >>> from calibre_plugins.sonyutilities.book import SeriesBook
+    >>> mi = Metadata('Title', ['Author'])
+    >>> mi.series, mi.series_index = 'Series', 2.0
+    >>> mi.sony_series, mi.sony_series_number = 'Series', '2'
+    >>> book = SeriesBook(mi, {})
+    >>> book.set_series_index(3.5)
+    >>> print('%s, %s, %s' % (book.series_index_string(), mi.series_index, book.is_series_changed()))
+    3.5, 2.0, True
+    >>> book.revert_changes()
+    >>> print('%s, %s' % (book.series_index_string(), book.is_series_changed()))
+    2, False
+    >>> book.set_title('New Title')
+    >>> print('%s, %s' % (book.get_mi_to_persist().title, book.is_title_changed()))
+    New Title, False
+
+    """
+    __slots__ = ('_mi', '_changes', '_orig_title', '_orig_pubdate', '_orig_series',
+                 '_orig_series_index', '_orig_series_index_string', '_series_index_format',
+                 '_orig_series_indent', '_series_indents', '_assigned_indexes', '_is_valid_index',
+                 '_sort_keys')
+
     series_column = 'Series'
 
 
     def __init__(self, mi, series_columns):
-        debug_print("SeriesBook:__init__ - mi.series_index=", mi.series_index)
-        self._orig_mi      = Metadata(_('Unknown'), other=mi)
         self._mi           = mi
+        self._changes      = None
         self._orig_title   = mi.title
-        self._orig_pubdate = self._mi.pubdate
-        self._orig_series  = self._mi.sony_series
+        self._orig_pubdate = getattr(mi, 'pubdate', None)
+        self._orig_series  = mi.sony_series
         self.get_series_index()
-        self._series_columns     = series_columns
-        self._assigned_indexes   = { 'Series': None }
-        self._series_indents     = { 'Series': get_indent_for_index(mi.series_index) }
+        # Every series column starts with the same indent. The per-column dictionaries
+        # are only created when an indent or index is set for a column.
+        self._orig_series_indent = get_indent_for_index(mi.series_index)
+        self._series_indents     = None
+        self._assigned_indexes   = None
         self._is_valid_index     = True
-        self._orig_custom_series = {}
-
-        for key in self._series_columns:
-            self._orig_custom_series[key] = mi.get_user_metadata(key, True)
-            self._series_indents[key] = get_indent_for_index(self.series_index(column=key))
-            self._assigned_indexes[key] = None
+        self._sort_keys          = None
 
     def get_series_index(self):
-        self._orig_series_index_string = None
-        self._series_index_format      = None
-        try:
-            debug_print("SeriesBook:get_series_index - self._mi.sony_series_number=%s" % self._mi.sony_series_number)
-            self._orig_series_index = float(self._mi.sony_series_number) if self._mi.sony_series_number is not None else None
-        except:
-            debug_print("SeriesBook:get_series_index - non numeric series - self._mi.sony_series_number=%s" % self._mi.sony_series_number)
-            numbers = re.findall(r"\d*\.?\d+", self._mi.sony_series_number)
-            if len(numbers) > 0:
-                self._orig_series_index        = float(numbers[0])
-                self._orig_series_index_string = self._mi.sony_series_number
-                self._series_index_format      = self._mi.sony_series_number.replace(numbers[0], "%g", 1)
-#            self._orig_series_index = re.findall(r"\d*", self._mi.sony_series_number)
-            debug_print("SeriesBook:get_series_index - self._orig_series_index=", self._orig_series_index)
+        sony_series_number = self._mi.sony_series_number
+        self._orig_series_index, self._series_index_format, is_valid = parse_series_number(sony_series_number)
+        self._orig_series_index_string = sony_series_number if self._series_index_format is not None else None
+
+    def _get(self, field):
+        if self._changes is not None and field in self._changes:
+            return self._changes[field]
+        return getattr(self._mi, field, None)
+
+    def _set(self, field, value):
+        if self._changes is None:
+            self._changes = {}
+        self._changes[field] = value
+        if field == 'pubdate':
+            self._sort_keys = None
 
     def get_mi_to_persist(self):
-        # self._mi will be potentially polluted with changes applied to multiple series columns
-        # Instead return a Metadata object with only changes relevant to the last series column selected.
+        # Write the changes into the Metadata object, which then becomes the new original
         debug_print("SeriesBook:get_mi_to_persist")
+        if self._changes:
+            for field, value in self._changes.iteritems():
+                setattr(self._mi, field, value)
+            self._changes = None
         self._orig_title = self._mi.title
-        if hasattr(self._mi, 'pubdate'):
-            self._orig_pubdate = self._mi.pubdate
+        self._orig_pubdate = getattr(self._mi, 'pubdate', None)
         self._orig_series = self._mi.series
         self._orig_series_index = self._mi.series_index
+        self._sort_keys = None
 
-        return self._orig_mi
+        return self._mi
 
     def revert_changes(self):
         debug_print("SeriesBook:revert_changes")
-        self._mi.title = self._orig_title
-        if hasattr(self._mi, 'pubdate'):
-            self._mi.pubdate = self._orig_pubdate
-        self._mi.series = self._mi.sony_series
-        self._mi.series_index = self._orig_series_index
-
-        return
+        self._changes = None
+        self._sort_keys = None
 
 
     def id(self):
@@ -97,30 +181,30 @@ class SeriesBook(object):
         return self._mi.authors
 
     def title(self):
-        return self._mi.title
+        return self._get('title')
+
+    def orig_title(self):
+        return self._orig_title
 
     def set_title(self, title):
-        self._mi.title = title
+        self._set('title', title)
 
     def is_title_changed(self):
-        return self._mi.title != self._orig_title
+        return self.title() != self._orig_title
 
     def pubdate(self):
-        if hasattr(self._mi, 'pubdate'):
-            return self._mi.pubdate
+        return self._get('pubdate')
 
     def set_pubdate(self, pubdate):
-        self._mi.pubdate = pubdate
+        self._set('pubdate', pubdate)
 
     def is_pubdate_changed(self):
-        if hasattr(self._mi, 'pubdate') and hasattr(self._orig_mi, 'pubdate'):
-            return self._mi.pubdate != self._orig_pubdate
-        return False
+        return self.pubdate() != self._orig_pubdate
 
     def is_series_changed(self):
-        if self._mi.series != self._orig_series:
+        if self.series_name() != self._orig_series:
             return True
-        if self._mi.series_index != self._orig_series_index:
+        if self.series_index() != self._orig_series_index:
             return True
         
         return False
@@ -129,46 +213,50 @@ class SeriesBook(object):
         return self._orig_series
 
     def orig_series_index(self):
-        debug_print("SeriesBook:orig_series_index - self._orig_series_index=", self._orig_series_index)
-        debug_print("SeriesBook:orig_series_index - self._orig_series_index.__class__=", self._orig_series_index.__class__)
         return self._orig_series_index
 
     def orig_series_index_string(self):
-#        debug_print("SeriesBook:orig_series_index - self._orig_series_index=", self._orig_series_index)
-#        debug_print("SeriesBook:orig_series_index - self._orig_series_index.__class__=", self._orig_series_index.__class__)
         if self._orig_series_index_string is not None:
             return self._orig_series_index_string
         
         return fmt_sidx(self._orig_series_index)
 
     def series_name(self):
-        return self._mi.series
+        return self._get('series')
 
     def set_series_name(self, series_name):
-        self._mi.series = series_name
+        self._set('series', series_name)
 
     def series_index(self, column=None):
-        return self._mi.series_index
+        return self._get('series_index')
 
     def series_index_string(self, column=None):
         if self._series_index_format is not None:
-            return self._series_index_format % self._mi.series_index
-        return fmt_sidx(self._mi.series_index)
+            return self._series_index_format % self.series_index()
+        return fmt_sidx(self.series_index())
 
     def set_series_index(self, series_index):
-        self._mi.series_index = series_index
+        self._set('series_index', series_index)
         self.set_series_indent(get_indent_for_index(series_index))
 
     def series_indent(self):
-        return self._series_indents[self.series_column]
+        if self._series_indents is None:
+            return self._orig_series_indent
+        return self._series_indents.get(self.series_column, self._orig_series_indent)
 
     def set_series_indent(self, index):
+        if self._series_indents is None:
+            self._series_indents = {}
         self._series_indents[self.series_column] = index
 
     def assigned_index(self):
-        return self._assigned_indexes[self.series_column]
+        if self._assigned_indexes is None:
+            return None
+        return self._assigned_indexes.get(self.series_column)
 
     def set_assigned_index(self, index):
+        if self._assigned_indexes is None:
+            self._assigned_indexes = {}
         self._assigned_indexes[self.series_column] = index
 
     def is_valid(self):
@@ -178,21 +266,48 @@ class SeriesBook(object):
         self._is_valid_index = is_valid_index
 
     def sort_key(self, sort_by_pubdate=False, sort_by_name=False):
+        """
+        Return a tuple to sort books by pubdate, or by their original series number and name
+
+        Books without a pubdate or series sort first. The keys are computed once, and kept
+        until the pubdate or original series of the book changes.
+
+        >>> from calibre.ebooks.metadata.book.base import Metadata
+        >>> from calibre_plugins.sonyutilities.book import SeriesBook
+        >>> def series_book(title, series, number):
+        ...     mi = Metadata(title, ['Author'])
+        ...     mi.series, mi.series_index = series, None
+        ...     mi.sony_series, mi.sony_series_number = series, number
+        ...     return SeriesBook(mi, {})
+        >>> books = [series_book('b-1', 'b', '1'), series_book('a-999', 'a', '999'), series_book('a-Part 2', 'a', 'Part 2'),
+        ...          series_book('b-1000', 'b', '1000'), series_book('none', None, None)]
+        >>> print(', '.join(book.title() for book in sorted(books, key=lambda k: k.sort_key())))
+        none, b-1, a-Part 2, a-999, b-1000
+        >>> print(', '.join(book.title() for book in sorted(books, key=lambda k: k.sort_key(sort_by_name=True))))
+        none, a-Part 2, a-999, b-1, b-1000
+
+        """
+        cache_key = (sort_by_pubdate, sort_by_name)
+        if self._sort_keys is None:
+            self._sort_keys = {}
+        elif cache_key in self._sort_keys:
+            return self._sort_keys[cache_key]
+
+        key = (0,)
         if sort_by_pubdate:
             pub_date = self.pubdate()
             if pub_date is not None and pub_date.year > 101:
-                return format_date(pub_date, 'yyyyMMdd')
+                key = (1, pub_date.year, pub_date.month, pub_date.day)
         else:
             series = self.orig_series_name()
             series_number = self.orig_series_index() if self.orig_series_index() is not None else -1
-            debug_print("sort_key - series_number=", series_number)
-            debug_print("sort_key - series_number.__class__=", series_number.__class__)
             if series:
                 if sort_by_name:
-                    return '%s%06.2f'% (series, series_number)
+                    key = (1, icu_sort_key(series), series_number)
                 else:
-                    return '%06.2f%s'% (series_number, series)
-        return ''
+                    key = (1, series_number, icu_sort_key(series))
+        self._sort_keys[cache_key] = key
+        return key
 
 class EbookIterator(_iterator):
     def __init__(self, pathtoebook, log=None):
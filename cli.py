@@ -0,0 +1,441 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+from __future__ import (division, absolute_import, print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Derek Broughton <auspex@pointerstop.ca>'
+__docformat__ = 'restructuredtext en'
+'''
+Run the device database operations from the command line, without the calibre GUI
+
+Each target is either the mount point of a reader (or of its SD card), or a books.db copied
+from one. The options are the plugin's saved preferences, overridden by the JSON object given
+with --options, using the same keys as the configuration (e.g. "backupDestDirectory",
+"vacuumFragmentationThreshold", "readingFontFamily", "orderShelvesType").
+
+Changes made to a reader found through its mount point are journaled on the host. The "recover"
+command replays those left unfinished by a reader being unplugged part way through a command,
+or discards them if the options have "replayJournals": false.
+
+With more than one target, each target is processed in its own calibre worker process, up to
+--processes at a time, so a fleet of readers takes about as long as the slowest one. Reading
+positions are read from the library before, and written to it after, the targets are processed.
+
+Progress and results are written to stdout as one JSON object per line, each with an "event"
+of "start", "progress", "result" or "error" for each command, "device" with the wall time and
+operation statistics of each target, and "finished" at the end. The exit status is 1 if any
+command failed on any target.
+
+Run with:
+    calibre-debug -r "Sony Utilities" -- [--options JSON] [--library PATH] [-j N] -t TARGET [-t TARGET ...] COMMAND [COMMAND ...]
+or, from the plugin source directory:
+    calibre-debug -e cli.py -- [--options JSON] [--library PATH] [-j N] -t TARGET [-t TARGET ...] COMMAND [COMMAND ...]
+'''
+
+try:    # need to import init_calibre for doctests
+    import init_calibre
+except ImportError:
+    pass
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import multiprocessing
+import traceback
+from contextlib import closing
+
+import calibre_plugins.sonyutilities.prefs as cfg
+import calibre_plugins.sonyutilities.services as services
+from calibre_plugins.sonyutilities.device_database import (session_operations, connect_device_database, DeviceDatabaseSnapshot,
+                                                           ChangeJournal, pending_change_journals, recover_change_journals)
+
+DBPATH = 'Sony_Reader/database/books.db'
+
+COMMANDS = ['backup', 'recover', 'vacuum', 'check', 'order-shelves', 'fonts', 'store']
+# The commands that work on a copy of the database when the snapshot option is set
+SNAPSHOT_COMMANDS = ['check', 'order-shelves', 'fonts', 'store']
+
+OPTION_STORES = [
+    cfg.COMMON_OPTIONS_STORE_NAME,
+    cfg.BOOKMARK_OPTIONS_STORE_NAME,
+    cfg.READING_OPTIONS_STORE_NAME,
+    cfg.ORDERSERIESSHELVES_OPTIONS_STORE_NAME,
+    cfg.BACKUP_OPTIONS_STORE_NAME,
+    ]
+
+
+class Target():
+    """
+    A reader location to work on: its device prefix (if known) and database path
+    """
+    def __init__(self, path):
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            self.prefix   = os.path.join(path, '')
+            self.database = os.path.join(path, DBPATH)
+        else:
+            self.database = path
+            root = path[:-len(DBPATH)] if path.replace(os.sep, '/').endswith(DBPATH) else None
+            self.prefix   = root if root and os.path.isdir(root) else None
+        if not os.path.isfile(self.database):
+            raise ValueError("No reader database at '%s'" % self.database)
+
+    def drive_info(self):
+        """
+        The location_code, device_store_uuid and device_name calibre wrote when the reader was last connected
+        """
+        if self.prefix:
+            try:
+                with open(os.path.join(self.prefix, '.driveinfo.calibre'), 'rb') as f:
+                    return json.load(f)
+            except (IOError, ValueError):
+                pass
+        return {}
+
+    def change_journal(self, operation):
+        return ChangeJournal(operation, self.drive_info().get('device_store_uuid'))
+
+    def device_books(self):
+        """
+        The books calibre sent to this location, read from the metadata.calibre it keeps there
+        """
+        if not self.prefix:
+            raise ValueError("'%s' is not on a reader, so its books are not known" % self.database)
+        with open(os.path.join(self.prefix, 'metadata.calibre'), 'rb') as f:
+            return json.load(f)
+
+
+class Reporter():
+    """
+    Write each event as a JSON object on its own line of the output
+    """
+    def __init__(self, write=None):
+        if write is not None:
+            self.write = write
+
+    def write(self, line):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        self.write(json.dumps(fields, sort_keys=True, default=unicode))
+
+    def notification(self, command, target):
+        return lambda fraction, message: self.emit('progress', command=command, target=target.database,
+                                                   fraction=fraction, message=message)
+
+
+def load_options(options_argument):
+    """
+    The saved preferences of the option stores, overridden by the JSON given as a string or a file
+    """
+    options = {}
+    for store_name in OPTION_STORES:
+        options.update(cfg.plugin_prefs.defaults[store_name])
+        options.update(cfg.get_plugin_prefs(store_name))
+    if options_argument:
+        if os.path.isfile(options_argument):
+            with open(options_argument, 'rb') as f:
+                options.update(json.load(f))
+        else:
+            options.update(json.loads(options_argument))
+    return options
+
+
+def do_backup(target, options, reporter, library=None):
+    from calibre_plugins.sonyutilities.jobs import do_device_database_backup
+
+    dest = options[cfg.KEY_BACKUP_DEST_DIRECTORY]
+    if not dest:
+        raise ValueError("No backup destination: set %s in the options" % cfg.KEY_BACKUP_DEST_DIRECTORY)
+    drive_info = target.drive_info()
+    backup_options = {
+        'device_name':       drive_info.get('device_name', 'Sony Reader'),
+        'device_store_uuid': drive_info.get('device_store_uuid', ''),
+        'location_code':     drive_info.get('location_code', 'main'),
+        'dest':              dest,
+        'database_file':     target.database,
+        'copies':            options[cfg.KEY_BACKUP_COPIES_TO_KEEP],
+        }
+    return {'backed_up': do_device_database_backup(backup_options, reporter.notification('backup', target))}
+
+
+def do_vacuum(target, options, reporter, library=None):
+    from calibre_plugins.sonyutilities.jobs import do_device_database_vacuum
+
+    vacuum_options = {'databases': [target.database], 'threshold': options[cfg.KEY_VACUUM_THRESHOLD]}
+    return {'databases': do_device_database_vacuum(vacuum_options, reporter.notification('vacuum', target))}
+
+
+def do_recover(target, options, reporter, books=None):
+    uuid = target.drive_info().get('device_store_uuid')
+    journals = pending_change_journals([uuid]) if uuid else []
+    replayed, applied, discarded, failed = recover_change_journals(target.database, journals, options.get('replayJournals', True))
+    return {'replayed': replayed, 'applied': applied, 'discarded': discarded,
+            'failed': [{'journal': journal.id, 'operation': journal.operation, 'error': '%s' % error} for journal, error in failed]}
+
+
+def do_check(target, options, reporter, library=None):
+    messages = services.check_device_database(target.database).split()
+    if messages[:1] != ['ok']:
+        raise ValueError("Integrity check failed: %s" % ' '.join(messages))
+    return {'ok': True}
+
+
+def do_order_shelves(target, options, reporter, library=None):
+    order_shelf_type = options[cfg.KEY_ORDER_SHELVES_TYPE]
+    shelves = []
+    for shelf in services.shelf_statistics(target.database):
+        if order_shelf_type == cfg.KEY_ORDER_SHELVES_SERIES:
+            wanted = shelf['is_series']
+        elif order_shelf_type == cfg.KEY_ORDER_SHELVES_AUTHORS:
+            wanted = shelf['is_author']
+        elif order_shelf_type == cfg.KEY_ORDER_SHELVES_OTHER:
+            wanted = not (shelf['is_series'] or shelf['is_author'])
+        else:
+            wanted = True
+        if wanted:
+            shelves.append({'name': shelf['name'], 'count': shelf['count']})
+    starting_shelves, ordered_shelves = services.order_series_shelves(target.database, shelves, options,
+                                                                      journal=target.change_journal('order_series_shelves'))
+    return {'shelves': starting_shelves, 'ordered': ordered_shelves}
+
+
+def do_fonts(target, options, reporter, library=None):
+    with closing(connect_device_database(target.database)) as connection:
+        contentIDs = [row[0] for row in connection.execute('SELECT _id FROM books')]
+    updated, added, deleted, count_books = services.set_reader_fonts(target.database, contentIDs, options,
+                                                                     journal=target.change_journal('set_reader_fonts'))
+    return {'updated': updated, 'added': added, 'deleted': deleted, 'books': count_books}
+
+
+STORE_COLUMNS = [
+    ('bookmark',    'mark',         cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN),
+    ('percentRead', 'percent',      cfg.KEY_PERCENT_READ_CUSTOM_COLUMN),
+    ('last_read',   'reading_time', cfg.KEY_LAST_READ_CUSTOM_COLUMN),
+    ]
+
+def store_columns(library):
+    """
+    The library's custom column for each value of the reading position, or None if it isn't stored
+    """
+    library_config = cfg.get_library_config(library)
+    return [(key, status_key, library_config.get(config_key, cfg.DEFAULT_LIBRARY_VALUES[config_key]))
+            for key, status_key, config_key in STORE_COLUMNS]
+
+
+def library_books(target, library):
+    """
+    The books from the library that calibre sent to the target, with their stored reading positions
+
+    This reads the library, so it is done before the target is handed to a worker process.
+    """
+    columns = store_columns(library)
+    api = library.new_api
+    all_ids = api.all_book_ids()
+
+    with closing(connect_device_database(target.database)) as connection:
+        content_ids = dict((file_path, content_id) for content_id, file_path in connection.execute('SELECT _id, file_path FROM books'))
+
+    books = {}
+    for device_book in target.device_books():
+        book_id    = device_book.get('application_id')
+        content_id = content_ids.get(device_book['lpath'])
+        if book_id not in all_ids or content_id is None:
+            continue
+        if book_id not in books:
+            book = dict(id=book_id, title=device_book.get('title'), authors=' & '.join(device_book.get('authors', [])),
+                        contentIds=[], paths=[])
+            for key, status_key, column in columns:
+                book[key] = api.field_for(column, book_id) if column else None
+            books[book_id] = book
+        books[book_id]['contentIds'].append(content_id)
+        books[book_id]['paths'].append(target.prefix + device_book['lpath'])
+    return books.values()
+
+
+def write_positions(library, positions):
+    for key, status_key, column in store_columns(library):
+        if column:
+            library.new_api.set_field(column, dict((book_id, status[status_key]) for book_id, status in positions.iteritems()))
+
+
+def do_store(target, options, reporter, books=None):
+    from calibre.utils.logging import Log
+    from calibre_plugins.sonyutilities.book import EbookIterator
+
+    def percent_read(path, mark):
+        return EbookIterator(path, log=Log()).calculate_percent_read(mark)
+
+    if books is None:
+        raise ValueError("Storing reading positions needs the calibre library: use --library")
+    positions = services.fetch_reading_positions({target.prefix: target.database}, books, options, percent_read)
+    return {'books': len(books), 'positions': len(positions)}, positions
+
+
+COMMAND_FUNCTIONS = {
+    'backup':        do_backup,
+    'recover':       do_recover,
+    'vacuum':        do_vacuum,
+    'check':         do_check,
+    'order-shelves': do_order_shelves,
+    'fonts':         do_fonts,
+    'store':         do_store,
+    }
+
+
+def run_target(path, commands, options, books=None, notification=None):
+    """
+    Run the commands in order on one target, and return its report: the wall time, the commands
+    that failed, the statistics of the operations run, and any reading positions to store
+
+    This is run in a worker process for each target when more than one is processed at a time,
+    so the events are passed back through notification, with the JSON line as the message.
+    """
+    reporter = Reporter() if notification is None else Reporter(lambda line: notification(0, line))
+    first_operation = len(session_operations())
+    start = time.time()
+    report = {'target': path, 'failed': [], 'positions': {}}
+    try:
+        target = Target(path)
+        report['target'] = target.database
+    except Exception as e:
+        report['failed'] = list(commands)
+        reporter.emit('error', target=path, error=unicode(e))
+        target = None
+
+    for command in commands if target else []:
+        reporter.emit('start', command=command, target=target.database)
+        try:
+            snapshot = options[cfg.KEY_SNAPSHOT_DATABASE] and command in SNAPSHOT_COMMANDS
+            with DeviceDatabaseSnapshot(target.database, enabled=snapshot) as database:
+                working_target = copy.copy(target)
+                working_target.database = database
+                result = COMMAND_FUNCTIONS[command](working_target, options, reporter, books)
+            if command == 'store':
+                result, report['positions'] = result
+        except Exception as e:
+            report['failed'].append(command)
+            reporter.emit('error', command=command, target=target.database, error=unicode(e),
+                          traceback=traceback.format_exc())
+        else:
+            reporter.emit('result', command=command, target=target.database, result=result)
+
+    report['wall_time']  = time.time() - start
+    report['operations'] = [dict(name=stats.name, wall_time=stats.wall_time, statements=stats.statements,
+                                 rows=stats.rows, commits=stats.commits, bytes_copied=stats.bytes_copied)
+                            for stats in session_operations()[first_operation:]]
+    return report
+
+
+def run_targets_in_parallel(jobs, processes, reporter):
+    """
+    Run each target's commands in a calibre worker process, at most processes at a time, passing
+    on their events as they arrive. Returns the reports in the order the targets finished.
+    """
+    from Queue import Empty
+    from calibre.utils.ipc.server import Server
+    from calibre.utils.ipc.job import ParallelJob
+
+    server = Server(pool_size=processes)
+    for path, args in jobs:
+        job = ParallelJob('arbitrary_n', "Sony Utilities: %s" % path, done=None,
+                          args=['calibre_plugins.sonyutilities.cli', 'run_target', args])
+        job._target_path, job._commands = path, args[1]
+        server.add_job(job)
+
+    reports = []
+    while len(reports) < len(jobs):
+        job = server.changed_jobs_queue.get()
+        job.update(consume_notifications=False)
+        while True:
+            try:
+                _percent, line = job.notifications.get_nowait()
+            except Empty:
+                break
+            reporter.write(line)
+        if not job.is_finished:
+            continue
+        if job.failed or job.result is None:
+            reporter.emit('error', target=job._target_path, error="The worker process failed", details=job.details)
+            reports.append({'target': job._target_path, 'failed': list(job._commands), 'positions': {},
+                            'wall_time': None, 'operations': []})
+        else:
+            reports.append(job.result)
+
+    server.close()
+    return reports
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='calibre-debug -r "Sony Utilities" --',
+                                     description="Run Sony Utilities operations on a reader's database")
+    parser.add_argument('commands', nargs='+', choices=COMMANDS, metavar='COMMAND',
+                        help="one or more of: %s, run in the order given" % ', '.join(COMMANDS))
+    parser.add_argument('-t', '--target', action='append', required=True,
+                        help="a reader's mount point, or a copied books.db; may be repeated")
+    parser.add_argument('--options', help="a JSON object, or a file containing one, overriding the saved preferences")
+    parser.add_argument('--library', help="the calibre library to store reading positions in")
+    parser.add_argument('--snapshot', action='store_true',
+                        help="work on a copy of each database on this computer, and copy it back if it was changed")
+    parser.add_argument('-j', '--processes', type=int, default=0,
+                        help="the number of targets to process at once, each in its own process "
+                             "(default: one per target, up to the number of CPUs)")
+    args = parser.parse_args(args)
+
+    reporter = Reporter()
+    start = time.time()
+    try:
+        options = load_options(args.options)
+        if args.snapshot:
+            options[cfg.KEY_SNAPSHOT_DATABASE] = True
+        library = None
+        if args.library:
+            from calibre.library import db as library_db
+            library = library_db(args.library)
+    except Exception as e:
+        reporter.emit('error', error=unicode(e))
+        return 1
+
+    jobs = []
+    for path in args.target:
+        books = None
+        if library is not None and 'store' in args.commands:
+            try:
+                books = library_books(Target(path), library)
+            except Exception as e:
+                reporter.emit('error', command='store', target=path, error=unicode(e))
+        jobs.append((path, (path, args.commands, options, books)))
+
+    processes = args.processes or min(len(jobs), multiprocessing.cpu_count())
+    if processes > 1 and len(jobs) > 1:
+        reports = run_targets_in_parallel(jobs, processes, reporter)
+    else:
+        reports = [run_target(*job_args) for _path, job_args in jobs]
+
+    devices = []
+    for report in reports:
+        positions = report.pop('positions')
+        if positions:
+            try:
+                write_positions(library, positions)
+            except Exception as e:
+                report['failed'].append('store')
+                reporter.emit('error', command='store', target=report['target'], error=unicode(e),
+                              traceback=traceback.format_exc())
+        report['stored'] = len(positions)
+        reporter.emit('device', **report)
+        devices.append(report)
+
+    failed = [{'command': command, 'target': report['target']} for report in devices for command in report['failed']]
+    reporter.emit('finished', failed=failed, wall_time=time.time() - start,
+                  slowest=max([report['wall_time'] for report in devices] or [0]))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,7 +8,7 @@ __copyright__ = '2012, David Forrester <davidfor@internode.on.net>'\
                 '2014, Derek Broughton <auspex@pointerstop.ca>'
 __docformat__ = 'restructuredtext en'
 
-import os, time
+import os, importlib
 try:
     from PyQt5.Qt import Qt
     from PyQt5.Qt import (QIcon, QPixmap, QLabel, QDialog, QHBoxLayout, QProgressBar,
@@ -22,15 +22,26 @@ except ImportError:
                           QVBoxLayout, QDialogButtonBox, QStyledItemDelegate, QDateTime,
                           QRegExpValidator, QRegExp)
 
-from calibre.constants import iswindows, DEBUG
+from calibre.constants import iswindows
 from calibre.gui2 import gprefs, error_dialog, UNDEFINED_QDATETIME, Application
 from calibre.gui2.actions import menu_action_unique_name
 from calibre.gui2.keyboard import ShortcutConfig
 from calibre.utils.config import config_dir
 from calibre.utils.date import now, format_date, UNDEFINED_DATE
-from calibre import prints
-import sys
-import sqlite3
+
+# The Qt-free database helpers, logging and instrumentation, imported here so existing imports keep working
+from calibre_plugins.sonyutilities.device_database import (debug_print, LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR, LOG_LEVEL_NAMES,
+                                                           Logger, lazy, get_logger, set_log_level, enable_ring_buffer, ring_buffer_lines,
+                                                           Cursor, SonyDB, convert_sony_date, database_version, explain_query_plan,
+                                                           HelperIndexes, annotation_hash, AnnotationCache,
+                                                           OperationStats, record_bytes_copied, instrumented,
+                                                           InstrumentedCursor, InstrumentedConnection, connect_device_database,
+                                                           database_change_counter, DeviceDatabaseSnapshot,
+                                                           JOURNAL_MARKER_TABLE, change_journal_directory, ChangeJournal,
+                                                           pending_change_journals, recover_change_journals,
+                                                           StatementProfile, StatementProfiler, enable_statement_profiler,
+                                                           statement_profiler, session_operations, session_report)
+from calibre_plugins.sonyutilities.prefs import get_library_uuid
 
 # Global definition of our plugin name. Used for common functions that require this.
 plugin_name = None
@@ -38,31 +49,6 @@ plugin_name = None
 # classes if you need any zip images to be displayed on the configuration dialog.
 plugin_icon_resources = {}
 
-BASE_TIME = None
-def debug_print(*args):
-    """
-    Print all args, prefixed by a time stamp and the module/method from which it was called
-    
-    >>> from calibre_plugins.sonyutilities.common_utils import debug_print
-    >>> global DEBUG
-    >>> DEBUG=True
-    
-    Unfortunately, that doesn't seem to actually set DEBUG, and we get nothing...
-    >>> debug_print("test", "message")
-    
-    """
-    #TODO: figure out how to set DEBUG=True in tests
-    if DEBUG:
-        code = sys._getframe(1).f_code
-        method_name = code.co_filename+'::'+code.co_name
-        del code
-    
-        global BASE_TIME
-        if BASE_TIME is None:
-            BASE_TIME = time.time()
-        prints('DEBUG: %6.1f'%(time.time()-BASE_TIME), method_name, '-', *args)
-
-
 
 def set_plugin_icon_resources(name, resources):
     '''
@@ -202,14 +188,6 @@ def create_menu_action_unique(ia, parent_menu, menu_text, image=None, tooltip=No
     return ac
 
 
-def get_library_uuid(db):
-    try:
-        library_uuid = db.library_id
-    except:
-        library_uuid = ''
-    return library_uuid
-
-
 class ImageLabel(QLabel):
 
     def __init__(self, parent, icon_name, size=16):
@@ -566,125 +544,121 @@ class ProgressBar(QDialog):
         self.progressBar.setValue(value)
         self.refresh()
 
-class Cursor():
+
+class DeviceTaskQueue():
     """
-    Given a path to a SQLite database, return an object containing the path and 
-    an open cursor into the database
-    >>> import os
-    >>> from calibre_plugins.sonyutilities.common_utils import Cursor 
-    >>> path1 = os.tempnam() 
-    >>> x = Cursor(path1)
-    >>> print (x.path == path1)
+    Runs the tasks started when a device connects one after another, each as a background job
+
+    Each task is a callable that is passed a function to call when it has finished, which
+    starts the next task. The tasks run in the order they were added, so a backup should
+    be added before any task that writes. A task is not added again while one with the 
+    same key is waiting or running, so a device reconnecting or repeated signals don't 
+    queue the same work twice.
+
+    >>> from calibre_plugins.sonyutilities.common_utils import DeviceTaskQueue
+    >>> queue = DeviceTaskQueue()
+    >>> finish = []
+    >>> def task(name):
+    ...     def run(on_finished):
+    ...         print("running %s" % name)
+    ...         finish.append(on_finished)
+    ...     return run
+    >>> print(queue.add(('backup', 'uuid'), task('backup')))
     True
-    >>> print (x.cursor)
-    <sqlite3.Cursor object at ...
-    
-    Clean up:
-    >>> import subprocess
-    >>> print(subprocess.call("rm -rvf "+path1, shell=True))
-    0
-       
-    """
-    def __init__(self,path):
-        self.path  = path
-        connection = sqlite3.connect(path)
-        # return bytestrings if the content cannot be decoded as unicode
-        connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
-        connection.row_factory  = sqlite3.Row
-        self.cursor = connection.cursor()
-        del connection
-         
-class SonyDB(dict):
-    """
-    Given a dictionary of database paths indexed by database prefix,
-    open cursors for each, and return a dictionary of Cursor objects, indexed by prefix
-      
-    The structure is suitable for using within a "with closing(...) as ..." structure
-    and all cursors will be automatically closed when the end of the "with" block is reached.
-      
-    >>> import subprocess
-    
-    Create a SonyDB object (using empty databases), and check that it has correct structure
-    >>> from calibre_plugins.sonyutilities.common_utils import SonyDB
-    >>> path1 = os.tempnam()
-    >>> path2 = os.tempnam()
-    >>> testdict = {'a': path1, 'b' : path2}
-    >>> obj = SonyDB(testdict)
-    >>> print(obj['a'].path == path1)
+    >>> print(queue.add(('store',), task('store')))
     True
-    >>> print(obj['b'].path == path2)
+    >>> queue.start()
+    running backup
+    >>> print(queue.add(('backup', 'uuid'), task('backup again')))
+    False
+    >>> finish.pop()()
+    running store
+    >>> finish.pop()()
+    >>> print(queue.running)
+    None
+
+    Clearing the queue when the device is disconnected lets the tasks run again on the next
+    connect, and a task from before the disconnect finishing late doesn't start another
+    >>> print(queue.add(('store',), task('store')))
     True
-    >>> print(obj['a'].cursor)
-    <sqlite3.Cursor object ...
-      
-    Try opening the SonyDB and executing queries:
-      
-    >>> from contextlib import closing
-    >>> with closing(SonyDB(testdict)) as db:
-    ...     for prefix in db:
-    ...         print(db[prefix].cursor.execute('PRAGMA integrity_check'))
-    <sqlite3.Cursor object...
-    <sqlite3.Cursor object...
-
-    Since the 'with' block is closed, the cursors will be too
-    >>> db['a'].cursor.execute('PRAGMA integrity_check')
-    Traceback (most recent call last):
-        ...
-    ProgrammingError: Cannot operate on a closed database.
-  
-    Finally write some garbage into one of the 'db' files and execute the queries:
-      
-    >>> with (open(path1,'w')) as stream:
-    ...     stream.write('test')
-    >>> with closing(SonyDB(testdict)) as db:
-    ...     for prefix in db:
-    ...         db[prefix].cursor.execute('PRAGMA integrity_check')
-    Traceback (most recent call last):
-        ...
-    DatabaseError: file is encrypted or is not a database
-          
-    Clean up:
-    >>> print(subprocess.call("rm -rvf %s %s" % (path1, path2), shell=True))
-    0
-       
-    """
-
-    def __init__(self, db):
-        cursors = {}
-        for key in db:
-            cursors[key]= Cursor(db[key]) 
-        super(SonyDB, self).__init__(cursors)
-       
-            
-    def close(self):
-        for key in self.keys():
-            self[key].cursor.connection.commit()
-            self[key].cursor.connection.close()
-
+    >>> queue.start()
+    running store
+    >>> queue.clear()
+    >>> print(queue.add(('store',), task('store after reconnect')))
+    True
+    >>> queue.start()
+    running store after reconnect
+    >>> finish.pop(0)()
+    >>> print(queue.running[0])
+    store
 
-def convert_sony_date(sony_date):
     """
-    Convert an input sony date to a python Datetime
+    def __init__(self):
+        self.tasks   = []
+        self.running = None
+        self.cleared = 0
+
+    def add(self, key, task):
+        if key == self.running or key in [k for k, _t in self.tasks]:
+            debug_print("already queued: ", key)
+            return False
+        self.tasks.append((key, task))
+        return True
+
+    def start(self):
+        if self.running is None:
+            self._run_next()
+
+    def clear(self):
+        self.tasks   = []
+        self.running = None
+        self.cleared += 1
+
+    def _run_next(self):
+        if not self.tasks:
+            self.running = None
+            return
+        key, task = self.tasks.pop(0)
+        self.running = key
+        finished = []
+        cleared  = self.cleared
+        def on_finished():
+            # Only the first call starts the next task, and not if the queue has been cleared since
+            if not finished and cleared == self.cleared:
+                finished.append(True)
+                self._run_next()
+        debug_print("starting: ", key)
+        try:
+            task(on_finished)
+        except Exception as e:
+            debug_print("task failed: ", key, e)
+            on_finished()
+
+
+class LazyModule():
+    """
+    Stands in for a module, which is only imported when one of its attributes is first used
 
-    Sony's dates are unix timestamps multiplied by 1000 
-    - somebody must have felt it was necessary to save those few characters per date
+    This keeps large modules, such as the dialogs, from being loaded with the plugin when 
+    calibre starts.
 
-    Create a timestamp for "2000-11-30"
-    >>> from calibre_plugins.sonyutilities.common_utils import convert_sony_date
-    >>> import time
-    >>> from datetime import datetime
-    >>> tm = time.mktime(time.strptime("2000-11-30 UTC", "%Y-%m-%d %Z"))
-    >>> print(tm)
-    975556800.0
-    >>> print(convert_sony_date(int(tm*1000)))
-    2000-11-30 00:00:00+00:00
+    >>> from calibre_plugins.sonyutilities.common_utils import LazyModule
+    >>> lazy_json = LazyModule('json')
+    >>> print(lazy_json.module is None)
+    True
+    >>> print(lazy_json.dumps([1, 2]))
+    [1, 2]
+    >>> print(lazy_json.module is None)
+    False
 
     """
-    from calibre.utils.date import utc_tz
-    from datetime import datetime
-    if sony_date:
-        converted_date = datetime.fromtimestamp(sony_date/1000).replace(tzinfo=utc_tz)
-    else:
-        converted_date = None
-    return converted_date
-            
\ No newline at end of file
+    def __init__(self, name):
+        self.name   = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found on the instance, so these are the module's
+        if self.module is None:
+            debug_print("importing ", self.name)
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
@@ -7,8 +7,6 @@ __license__   = 'GPL v3'
 __copyright__ = '2014, Derek Broughton <auspex@pointerstop.ca>'
 __docformat__ = 'restructuredtext en'
 
-import copy
-
 try:
     from PyQt5.Qt import (Qt, QWidget, QGridLayout, QLabel, QPushButton, QVBoxLayout, QSpinBox,
                           QGroupBox, QCheckBox, QLineEdit)
@@ -19,200 +17,13 @@ except ImportError:
     from PyQt4 import QtGui
 
 from calibre.gui2 import open_url, choose_dir, error_dialog
-from calibre.utils.config import JSONConfig
 
 # from calibre.customize.zipplugin import load_translations
-from calibre_plugins.sonyutilities.common_utils import (get_library_uuid, CustomColumnComboBox,
-                                     debug_print, KeyboardConfigDialog, KeyComboBox, ImageTitleLayout)
-
-
-PREFS_NAMESPACE = 'sonyutilitiesPlugin'
-PREFS_KEY_SETTINGS = 'settings'
-
-KEY_SCHEMA_VERSION = 'SchemaVersion'
-DEFAULT_SCHEMA_VERSION = 0.1
-
-STORE_LIBRARIES = 'libraries'
-KEY_CURRENT_LOCATION_CUSTOM_COLUMN = 'currentReadingLocationColumn'
-KEY_PERCENT_READ_CUSTOM_COLUMN     = 'precentReadColumn'
-KEY_RATING_CUSTOM_COLUMN           = 'ratingColumn'
-KEY_LAST_READ_CUSTOM_COLUMN        = 'lastReadColumn'
-KEY_STORE_ON_CONNECT               = 'storeOnConnect'
-KEY_PROMPT_TO_STORE                = 'promptToStore'
-KEY_STORE_IF_MORE_RECENT           = 'storeIfMoreRecent'
-KEY_DO_NOT_STORE_IF_REOPENED       = 'doNotStoreIfReopened'
-KEY_DO_UPDATE_CHECK                = 'doFirmwareUpdateCheck'
-KEY_LAST_FIRMWARE_CHECK_TIME       = 'firmwareUpdateCheckLastTime'
-KEY_DO_EARLY_FIRMWARE_CHECK        = 'doEarlyFirmwareUpdate'
-DEFAULT_LIBRARY_VALUES = {
-                          KEY_CURRENT_LOCATION_CUSTOM_COLUMN: '',
-                          KEY_PERCENT_READ_CUSTOM_COLUMN:     '',
-                          KEY_RATING_CUSTOM_COLUMN:           None,
-                          KEY_LAST_READ_CUSTOM_COLUMN:        None,
-                         }
-
-BOOKMARK_OPTIONS_STORE_NAME             = 'BookmarkOptions'
-METADATA_OPTIONS_STORE_NAME             = 'MetadataOptions'
-READING_OPTIONS_STORE_NAME              = 'ReadingOptions'
-COMMON_OPTIONS_STORE_NAME               = 'commonOptionsStore'
-DISMISSTILES_OPTIONS_STORE_NAME         = 'dismissTilesOptionsStore'
-FIXDUPLICATESHELVES_OPTIONS_STORE_NAME  = 'fixDuplicatesOptionsStore'
-ORDERSERIESSHELVES_OPTIONS_STORE_NAME   = 'orderSeriesShelvesOptionsStore'
-UPDATE_OPTIONS_STORE_NAME               = 'updateOptionsStore'
-BACKUP_OPTIONS_STORE_NAME               = 'backupOptionsStore'
-
-KEY_STORE_BOOKMARK          = 'storeBookmarks'
-KEY_DATE_TO_NOW             = 'setDateToNow'
-KEY_CLEAR_IF_UNREAD         = 'clearIfUnread'
-KEY_BACKGROUND_JOB          = 'backgroundJob'
-KEY_SET_TITLE               = 'title'
-KEY_USE_TITLE_SORT          = 'titleSort'
-KEY_SET_AUTHOR              = 'author'
-KEY_USE_AUTHOR_SORT         = 'authourSort'
-KEY_SET_DESCRIPTION         = 'description'
-KEY_SET_PUBLISHER           = 'publisher'
-KEY_SET_SERIES              = 'series'
-KEY_SET_TAGS_IN_SUBTITLE    = 'tagsInSubtitle'
-KEY_USE_PLUGBOARD           = 'usePlugboard'
-KEY_SET_READING_STATUS      = 'setRreadingStatus'
-KEY_READING_STATUS          = 'readingStatus'
-KEY_SET_PUBLISHED_DATE      = 'published_date'
-KEY_SET_ISBN                = 'isbn'
-KEY_SET_NOT_INTERESTED      = 'mark_not_interested'
-KEY_SET_LANGUAGE            = 'language'
-KEY_RESET_POSITION          = 'resetPosition'
-KEY_TILE_OPTIONS            = 'tileOptions'
-KEY_CHANGE_DISMISS_TRIGGER  = 'changeDismissTrigger'
-KEY_CREATE_DISMISS_TRIGGER  = 'createDismissTrigger'
-KEY_DELETE_DISMISS_TRIGGER  = 'deleteDismissTrigger'
-KEY_CREATE_ANALYTICSEVENTS_TRIGGER  = 'createAnalyticsEventsTrigger'
-KEY_DELETE_ANALYTICSEVENTS_TRIGGER  = 'deleteAnalyticsEventsTrigger'
-KEY_TILE_RECENT_NEW             = 'tileRecentBooksNew'
-KEY_TILE_RECENT_FINISHED        = 'tileRecentBooksFinished'
-KEY_TILE_RECENT_IN_THE_CLOUD    = 'tileRecentBooksInTheCLoud'
-
-KEY_READING_FONT_FAMILY     = 'readingFontFamily'
-KEY_READING_ALIGNMENT       = 'readingAlignment'
-KEY_READING_FONT_SIZE       = 'readingFontSize'
-KEY_READING_LINE_HEIGHT     = 'readingLineHeight'
-KEY_READING_LEFT_MARGIN     = 'readingLeftMargin'
-KEY_READING_RIGHT_MARGIN    = 'readingRightMargin'
-KEY_READING_LOCK_MARGINS    = 'lockMargins'
-KEY_UPDATE_CONFIG_FILE      = 'updateConfigFile'
-
-KEY_BUTTON_ACTION_DEVICE    = 'buttonActionDevice'
-KEY_BUTTON_ACTION_LIBRARY   = 'buttonActionLibrary'
-
-KEY_KEEP_NEWEST_SHELF       = 'keepNewestShelf'
-KEY_PURGE_SHELVES           = 'purgeShelves'
-
-KEY_SORT_DESCENDING         = 'sortDescending'
-KEY_SORT_UPDATE_CONFIG      = 'updateConfig'
-
-KEY_ORDER_SHELVES_SERIES    = 0
-KEY_ORDER_SHELVES_AUTHORS   = 1
-KEY_ORDER_SHELVES_OTHER     = 2
-KEY_ORDER_SHELVES_ALL       = 3
-KEY_ORDER_SHELVES_TYPE      = 'orderShelvesType'
-
-KEY_ORDER_SHELVES_BY_SERIES = 0
-KEY_ORDER_SHELVES_PUBLISHED = 1
-KEY_ORDER_SHELVES_BY        = 'orderShelvesBy'
-
-KEY_DO_DAILY_BACKUP         = 'doDailyBackp'
-KEY_BACKUP_COPIES_TO_KEEP   = 'backupCopiesToKeepSpin'
-KEY_BACKUP_DEST_DIRECTORY   = 'backupDestDirectory'
-
-BOOKMARK_OPTIONS_DEFAULTS = {
-                KEY_STORE_BOOKMARK:             True,
-                KEY_READING_STATUS:             True,
-                KEY_DATE_TO_NOW:                True, 
-                KEY_CLEAR_IF_UNREAD:            False, 
-                KEY_BACKGROUND_JOB:             False, 
-                KEY_STORE_IF_MORE_RECENT:       False,
-                KEY_DO_NOT_STORE_IF_REOPENED:   False
-                }
-METADATA_OPTIONS_DEFAULTS = {
-                KEY_SET_TITLE:          False,
-                KEY_SET_AUTHOR:         False,
-                KEY_SET_DESCRIPTION:    False,
-                KEY_SET_PUBLISHER:      False,
-                KEY_SET_SERIES:         False,
-                KEY_SET_READING_STATUS: False,
-                KEY_READING_STATUS:     -1,
-                KEY_SET_PUBLISHED_DATE: False,
-                KEY_SET_ISBN:           False,
-                KEY_SET_NOT_INTERESTED: False,
-                KEY_SET_LANGUAGE:       False,
-                KEY_RESET_POSITION:     False,
-                KEY_USE_PLUGBOARD:      False,
-                KEY_USE_TITLE_SORT:     False,
-                KEY_USE_AUTHOR_SORT:    False,
-                KEY_SET_TAGS_IN_SUBTITLE: False
-                }
-READING_OPTIONS_DEFAULTS = {
-                KEY_READING_FONT_FAMILY:  'Georgia',
-                KEY_READING_ALIGNMENT:    'Off',
-                KEY_READING_FONT_SIZE:    22,
-                KEY_READING_LINE_HEIGHT:  1.3,
-                KEY_READING_LEFT_MARGIN:  3,
-                KEY_READING_RIGHT_MARGIN: 3,
-                KEY_READING_LOCK_MARGINS: False,
-                KEY_UPDATE_CONFIG_FILE:   False,
-                }
-COMMON_OPTIONS_DEFAULTS = {
-                KEY_STORE_ON_CONNECT:           False,
-                KEY_PROMPT_TO_STORE:            True,
-                KEY_STORE_IF_MORE_RECENT:       False,
-                KEY_DO_NOT_STORE_IF_REOPENED:   False,
-                KEY_BUTTON_ACTION_DEVICE:       '',
-                KEY_BUTTON_ACTION_LIBRARY:      '',
-                }
-DISMISSTILES_OPTIONS_DEFAULTS = {
-                KEY_TILE_OPTIONS:               {},
-                KEY_TILE_RECENT_NEW:            False,
-                KEY_TILE_RECENT_FINISHED:       False,
-                KEY_TILE_RECENT_IN_THE_CLOUD:   False
-                }
-
-FIXDUPLICATESHELVES_OPTIONS_DEFAULTS = {
-                KEY_KEEP_NEWEST_SHELF:  True,
-                KEY_PURGE_SHELVES:      False
-                }
-
-ORDERSERIESSHELVES_OPTIONS_DEFAULTS = {
-                KEY_SORT_DESCENDING:    False,
-                KEY_SORT_UPDATE_CONFIG: True,
-                KEY_ORDER_SHELVES_TYPE: KEY_ORDER_SHELVES_SERIES,
-                KEY_ORDER_SHELVES_BY:   KEY_ORDER_SHELVES_BY_SERIES
-                }
-
-UPDATE_OPTIONS_DEFAULTS = {
-                KEY_DO_UPDATE_CHECK: False,
-                KEY_LAST_FIRMWARE_CHECK_TIME: 0,
-                KEY_DO_EARLY_FIRMWARE_CHECK: False
-                }
-
-BACKUP_OPTIONS_DEFAULTS = {
-                KEY_DO_DAILY_BACKUP:        False,
-                KEY_BACKUP_COPIES_TO_KEEP:  5,
-                KEY_BACKUP_DEST_DIRECTORY:  ''
-                }
-
-# This is where all preferences for this plugin will be stored
-plugin_prefs = JSONConfig('plugins/Sony Utilities')
-
-# Set defaults
-plugin_prefs.defaults[BOOKMARK_OPTIONS_STORE_NAME]      = BOOKMARK_OPTIONS_DEFAULTS
-plugin_prefs.defaults[METADATA_OPTIONS_STORE_NAME]      = METADATA_OPTIONS_DEFAULTS
-plugin_prefs.defaults[READING_OPTIONS_STORE_NAME]       = READING_OPTIONS_DEFAULTS
-plugin_prefs.defaults[COMMON_OPTIONS_STORE_NAME]        = COMMON_OPTIONS_DEFAULTS
-plugin_prefs.defaults[DISMISSTILES_OPTIONS_STORE_NAME]  = DISMISSTILES_OPTIONS_DEFAULTS
-plugin_prefs.defaults[FIXDUPLICATESHELVES_OPTIONS_STORE_NAME]  = FIXDUPLICATESHELVES_OPTIONS_DEFAULTS
-plugin_prefs.defaults[ORDERSERIESSHELVES_OPTIONS_STORE_NAME]   = ORDERSERIESSHELVES_OPTIONS_DEFAULTS
-plugin_prefs.defaults[STORE_LIBRARIES]                  = {}
-plugin_prefs.defaults[UPDATE_OPTIONS_STORE_NAME]        = UPDATE_OPTIONS_DEFAULTS
-plugin_prefs.defaults[BACKUP_OPTIONS_STORE_NAME]        = BACKUP_OPTIONS_DEFAULTS
+from calibre_plugins.sonyutilities.common_utils import (CustomColumnComboBox, debug_print,
+                                     KeyboardConfigDialog, KeyComboBox, ImageTitleLayout)
+
+# The option keys and preferences are kept in prefs, which doesn't import Qt
+from calibre_plugins.sonyutilities.prefs import *
 
 
 try:
@@ -223,57 +34,6 @@ except NameError:
     pass # load_translations() added in calibre 1.9
 
 
-def get_plugin_pref(store_name, option):
-    c = plugin_prefs[store_name]
-    default_value = plugin_prefs.defaults[store_name][option]
-    return c.get(option, default_value)
-
-def get_plugin_prefs(store_name):
-    c = plugin_prefs[store_name]
-    return c
-
-def migrate_library_config_if_required(db, library_config):
-    schema_version = library_config.get(KEY_SCHEMA_VERSION, 0)
-    if schema_version == DEFAULT_SCHEMA_VERSION:
-        return
-    # We have changes to be made - mark schema as updated
-    library_config[KEY_SCHEMA_VERSION] = DEFAULT_SCHEMA_VERSION
-
-    # Any migration code in future will exist in here.
-    if schema_version < 0.1:
-        pass
-
-    set_library_config(db, library_config)
-
-
-def get_library_config(db):
-    library_id = get_library_uuid(db)
-    library_config = None
-    # Check whether this is a configuration needing to be migrated from json into database
-    if 'libraries' in plugin_prefs:
-        libraries = plugin_prefs['libraries']
-        if library_id in libraries:
-            # We will migrate this below
-            library_config = libraries[library_id]
-            # Cleanup from json file so we don't ever do this again
-            del libraries[library_id]
-            if len(libraries) == 0:
-                # We have migrated the last library for this user
-                del plugin_prefs['libraries']
-            else:
-                plugin_prefs['libraries'] = libraries
-
-    if library_config is None:
-        library_config = db.prefs.get_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS,
-                                                 copy.deepcopy(DEFAULT_LIBRARY_VALUES))
-#    migrate_library_config_if_required(db, library_config)
-    return library_config
-
-
-def set_library_config(db, library_config):
-    db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS, library_config)
-
-
 class ConfigWidget(QWidget):
 
     def __init__(self, plugin_action):
@@ -298,17 +58,20 @@ class ConfigWidget(QWidget):
         avail_number_columns = self.get_number_custom_columns()
         avail_rating_columns = self.get_rating_custom_columns()
         avail_date_columns   = self.get_date_custom_columns()
+        avail_comments_columns = self.get_comments_custom_columns()
 #        debug_print("avail_rating_columns=", avail_rating_columns)
 #        debug_print("default columns=", self.plugin_action.gui.library_view.model().orig_headers)
         current_Location_column  = library_config.get(KEY_CURRENT_LOCATION_CUSTOM_COLUMN, DEFAULT_LIBRARY_VALUES[KEY_CURRENT_LOCATION_CUSTOM_COLUMN])
         precent_read_column      = library_config.get(KEY_PERCENT_READ_CUSTOM_COLUMN, DEFAULT_LIBRARY_VALUES[KEY_PERCENT_READ_CUSTOM_COLUMN])
         rating_column            = library_config.get(KEY_RATING_CUSTOM_COLUMN, DEFAULT_LIBRARY_VALUES[KEY_RATING_CUSTOM_COLUMN])
         last_read_column         = library_config.get(KEY_LAST_READ_CUSTOM_COLUMN, DEFAULT_LIBRARY_VALUES[KEY_LAST_READ_CUSTOM_COLUMN])
+        annotations_column       = library_config.get(KEY_ANNOTATIONS_CUSTOM_COLUMN, DEFAULT_LIBRARY_VALUES[KEY_ANNOTATIONS_CUSTOM_COLUMN])
 
         store_on_connect         = get_plugin_pref(COMMON_OPTIONS_STORE_NAME, KEY_STORE_ON_CONNECT)
         prompt_to_store          = get_plugin_pref(COMMON_OPTIONS_STORE_NAME, KEY_PROMPT_TO_STORE)
         store_if_more_recent     = get_plugin_pref(COMMON_OPTIONS_STORE_NAME, KEY_STORE_IF_MORE_RECENT)
         do_not_store_if_reopened = get_plugin_pref(COMMON_OPTIONS_STORE_NAME, KEY_DO_NOT_STORE_IF_REOPENED)
+        snapshot_database        = get_plugin_pref(COMMON_OPTIONS_STORE_NAME, KEY_SNAPSHOT_DATABASE)
 
 #         do_check_for_firmware_updates = get_plugin_pref(UPDATE_OPTIONS_STORE_NAME, KEY_DO_UPDATE_CHECK)
 #         do_early_firmware_updates     = get_plugin_pref(UPDATE_OPTIONS_STORE_NAME, KEY_DO_EARLY_FIRMWARE_CHECK)
@@ -317,6 +80,7 @@ class ConfigWidget(QWidget):
         do_daily_backup          = get_plugin_pref(BACKUP_OPTIONS_STORE_NAME, KEY_DO_DAILY_BACKUP)
         dest_directory           = get_plugin_pref(BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_DEST_DIRECTORY)
         copies_to_keep           = get_plugin_pref(BACKUP_OPTIONS_STORE_NAME, KEY_BACKUP_COPIES_TO_KEEP)
+        vacuum_threshold         = get_plugin_pref(BACKUP_OPTIONS_STORE_NAME, KEY_VACUUM_THRESHOLD)
 #        debug_print("current_Location_column=%s, precent_read_column=%s, rating_column=%s" % (current_Location_column, precent_read_column, rating_column))
 
         current_Location_label = QLabel(_('Current Reading Location Column:'), self)
@@ -347,6 +111,13 @@ class ConfigWidget(QWidget):
         options_layout.addWidget(last_read_label, 4, 0, 1, 1)
         options_layout.addWidget(self.last_read_combo, 4, 1, 1, 1)
 
+        annotations_label = QLabel(_('Annotations Column:'), self)
+        annotations_label.setToolTip(_("Column used to store the annotations from the device when they are synced. The column type must be 'Long text, like comments'. Leave this blank if you do not want to sync the annotations."))
+        self.annotations_combo = CustomColumnComboBox(self, avail_comments_columns, annotations_column)
+        annotations_label.setBuddy(self.annotations_combo)
+        options_layout.addWidget(annotations_label, 5, 0, 1, 1)
+        options_layout.addWidget(self.annotations_combo, 5, 1, 1, 1)
+
         auto_store_group = QGroupBox(_('Store on connect'), self)
         layout.addWidget(auto_store_group )
         options_layout = QGridLayout()
@@ -431,6 +202,16 @@ class ConfigWidget(QWidget):
 
         self.do_daily_backp_checkbox_clicked(do_daily_backup)
 
+        vacuum_threshold_label = QLabel(_("Compress when free space exceeds (%):"), self)
+        vacuum_threshold_label.setToolTip(_("The database is only rewritten by 'Compress device database' when at least this percentage of it is unused. Below this, free pages are left for the device to reuse."))
+        self.vacuum_threshold_spin = QSpinBox(self)
+        self.vacuum_threshold_spin.setMinimum(0)
+        self.vacuum_threshold_spin.setMaximum(100)
+        self.vacuum_threshold_spin.setProperty('value', vacuum_threshold)
+        vacuum_threshold_label.setBuddy(self.vacuum_threshold_spin)
+        options_layout.addWidget(vacuum_threshold_label, 2, 0, 1, 2)
+        options_layout.addWidget(self.vacuum_threshold_spin, 2, 2, 1, 1)
+
         other_options_group = QGroupBox(_('Other Options'), self)
         layout.addWidget(other_options_group )
         options_layout = QGridLayout()
@@ -450,6 +231,12 @@ class ConfigWidget(QWidget):
         options_layout.addWidget(device_default_label, 1, 0, 1, 1)
         options_layout.addWidget(self.device_default_combo, 1, 1, 1, 2)
 
+        self.snapshot_database_checkbox = QCheckBox(_("Work on a copy of the device database"), self)
+        self.snapshot_database_checkbox.setToolTip(_("Copy the device database to this computer for each operation, and copy it back "
+                                                     "if it was changed. This is faster than reading the database on the device piece by piece."))
+        self.snapshot_database_checkbox.setCheckState(Qt.Checked if snapshot_database else Qt.Unchecked)
+        options_layout.addWidget(self.snapshot_database_checkbox, 2, 0, 1, 3)
+
         keyboard_shortcuts_button = QPushButton(_('Keyboard shortcuts...'), self)
         keyboard_shortcuts_button.setToolTip(_('Edit the keyboard shortcuts associated with this plugin'))
         keyboard_shortcuts_button.clicked.connect(self.edit_shortcuts)
@@ -497,6 +284,7 @@ class ConfigWidget(QWidget):
         new_prefs[KEY_PROMPT_TO_STORE]          = self.prompt_to_store_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_STORE_IF_MORE_RECENT]     = self.store_if_more_recent_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_DO_NOT_STORE_IF_REOPENED] = self.do_not_store_if_reopened_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_SNAPSHOT_DATABASE]        = self.snapshot_database_checkbox.checkState() == Qt.Checked
         plugin_prefs[COMMON_OPTIONS_STORE_NAME] = new_prefs
 
         new_update_prefs = {}
@@ -509,6 +297,7 @@ class ConfigWidget(QWidget):
         backup_prefs[KEY_DO_DAILY_BACKUP]       = self.do_daily_backp_checkbox.checkState() == Qt.Checked
         backup_prefs[KEY_BACKUP_DEST_DIRECTORY] = unicode(self.dest_directory_edit.text())
         backup_prefs[KEY_BACKUP_COPIES_TO_KEEP] = int(unicode(self.copies_to_keep_spin.value())) if self.copies_to_keep_checkbox.checkState() == Qt.Checked else -1 
+        backup_prefs[KEY_VACUUM_THRESHOLD]      = int(unicode(self.vacuum_threshold_spin.value()))
         plugin_prefs[BACKUP_OPTIONS_STORE_NAME] = backup_prefs
 
         db = self.plugin_action.gui.current_db
@@ -517,6 +306,7 @@ class ConfigWidget(QWidget):
         library_config[KEY_PERCENT_READ_CUSTOM_COLUMN]     = self.percent_read_combo.get_selected_column()
         library_config[KEY_RATING_CUSTOM_COLUMN]           = self.rating_combo.get_selected_column()
         library_config[KEY_LAST_READ_CUSTOM_COLUMN]        = self.last_read_combo.get_selected_column()
+        library_config[KEY_ANNOTATIONS_CUSTOM_COLUMN]      = self.annotations_combo.get_selected_column()
         set_library_config(db, library_config)
 
     def get_number_custom_columns(self):
@@ -538,6 +328,10 @@ class ConfigWidget(QWidget):
         column_types = ['datetime']
         return self.get_custom_columns(column_types)
 
+    def get_comments_custom_columns(self):
+        column_types = ['comments']
+        return self.get_custom_columns(column_types)
+
     def get_custom_columns(self, column_types):
         custom_columns = self.plugin_action.gui.library_view.model().custom_columns
         available_columns = {}
@@ -0,0 +1,1257 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2012, David Forrester <davidfor@internode.on.net>'\
+                '2014, Derek Broughton <auspex@pointerstop.ca>'
+__docformat__ = 'restructuredtext en'
+'''
+The helpers for reading and writing the Sony device databases, and the logging and 
+instrumentation they use
+
+Nothing here imports Qt or calibre.gui2, so the services, the jobs run in worker processes and
+the command line runner can use it without loading the GUI. The widgets and dialogs are in
+common_utils, which imports everything here as well.
+'''
+
+import os, csv, json, time, shutil, struct, hashlib, itertools, threading
+from contextlib import closing
+from collections import deque, OrderedDict
+from functools import wraps
+
+from calibre.constants import DEBUG
+from calibre.utils.config import config_dir
+from calibre import prints
+import sys
+import sqlite3
+
+BASE_TIME = None
+def debug_print(*args):
+    """
+    Print all args, prefixed by a time stamp and the module/method from which it was called
+    
+    >>> from calibre_plugins.sonyutilities.device_database import debug_print
+    >>> global DEBUG
+    >>> DEBUG=True
+    
+    Unfortunately, that doesn't seem to actually set DEBUG, and we get nothing...
+    >>> debug_print("test", "message")
+    
+    """
+    #TODO: figure out how to set DEBUG=True in tests
+    if DEBUG:
+        code = sys._getframe(1).f_code
+        method_name = code.co_filename+'::'+code.co_name
+        del code
+    
+        global BASE_TIME
+        if BASE_TIME is None:
+            BASE_TIME = time.time()
+        prints('DEBUG: %6.1f'%(time.time()-BASE_TIME), method_name, '-', *args)
+    if _ring_buffer is not None:
+        _ring_buffer.append(' '.join(unicode(arg) for arg in args))
+
+
+# Log levels, with the same values as the logging module
+LOG_DEBUG   = 10
+LOG_INFO    = 20
+LOG_WARNING = 30
+LOG_ERROR   = 40
+LOG_LEVEL_NAMES = {'debug': LOG_DEBUG, 'info': LOG_INFO, 'warning': LOG_WARNING, 'error': LOG_ERROR}
+
+_loggers     = {}
+_ring_buffer = None
+
+class Logger():
+    """
+    Logs the messages for one subsystem of the plugin, such as 'store' or 'shelves'
+
+    The message is only formatted, with msg % args, if the level is enabled, so the arguments
+    should be passed separately rather than formatted by the caller. For arguments that 
+    are expensive to produce, pass lazy(function), or check isEnabledFor() first. Messages 
+    are printed when calibre is in debug mode, and kept in the ring buffer if it is enabled.
+    Get loggers with get_logger() rather than creating them.
+
+    >>> from calibre_plugins.sonyutilities.device_database import (get_logger, lazy, set_log_level, 
+    ...                                       enable_ring_buffer, ring_buffer_lines, LOG_DEBUG, LOG_WARNING)
+    >>> log = get_logger('doctest')
+    >>> enable_ring_buffer(2)
+    >>> set_log_level(LOG_WARNING, 'doctest')
+    >>> print(log.isEnabledFor(LOG_DEBUG))
+    False
+    >>> def expensive():
+    ...     print("formatting")
+    ...     return "value"
+    >>> log.debug("not formatted: %s", lazy(expensive))
+    >>> set_log_level(LOG_DEBUG, 'doctest')
+    >>> log.debug("formatted: %s", lazy(expensive))
+    formatting
+    >>> log.warning("number %d", 2)
+    >>> log.info("number %d", 3)
+    >>> print(ring_buffer_lines())
+    [u'WARNING doctest - number 2', u'INFO doctest - number 3']
+    >>> enable_ring_buffer(0)
+
+    """
+    def __init__(self, name, level):
+        self.name  = name
+        self.level = level
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def debug(self, msg, *args):
+        if LOG_DEBUG >= self.level:
+            self._log('DEBUG', msg, args)
+
+    def info(self, msg, *args):
+        if LOG_INFO >= self.level:
+            self._log('INFO', msg, args)
+
+    def warning(self, msg, *args):
+        if LOG_WARNING >= self.level:
+            self._log('WARNING', msg, args)
+
+    def error(self, msg, *args):
+        if LOG_ERROR >= self.level:
+            self._log('ERROR', msg, args)
+
+    def _log(self, level_name, msg, args):
+        if args:
+            msg = msg % args
+        if DEBUG:
+            global BASE_TIME
+            if BASE_TIME is None:
+                BASE_TIME = time.time()
+            prints('%s: %6.1f' % (level_name, time.time() - BASE_TIME), self.name, '-', msg)
+        if _ring_buffer is not None:
+            _ring_buffer.append('%s %s - %s' % (level_name, self.name, msg))
+
+
+class lazy():
+    """
+    A log argument that is only produced, by calling function, when the message is formatted
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def __str__(self):
+        return unicode(self.function()).encode('utf-8')
+
+    def __unicode__(self):
+        return unicode(self.function())
+
+    def __repr__(self):
+        return repr(self.function())
+
+
+def _default_log_levels():
+    """
+    The log levels from the SONYUTILITIES_LOG environment variable, such as "info" or "store=debug,shelves=info"
+    """
+    default = LOG_DEBUG if DEBUG else LOG_WARNING
+    levels  = {}
+    for setting in os.environ.get('SONYUTILITIES_LOG', '').split(','):
+        name, _sep, level = setting.strip().rpartition('=')
+        if level.lower() in LOG_LEVEL_NAMES:
+            if name:
+                levels[name] = LOG_LEVEL_NAMES[level.lower()]
+            else:
+                default = LOG_LEVEL_NAMES[level.lower()]
+    return default, levels
+
+def get_logger(name):
+    if name not in _loggers:
+        default, levels = _default_log_levels()
+        _loggers[name] = Logger(name, levels.get(name, default))
+    return _loggers[name]
+
+def set_log_level(level, name=None):
+    """
+    Set the level of the named logger, or of all loggers if no name is given
+    """
+    for logger in ([get_logger(name)] if name else _loggers.values()):
+        logger.level = level
+
+def enable_ring_buffer(size):
+    """
+    Keep the last size messages in memory, to be dumped after something has gone wrong
+
+    A size of 0 turns the ring buffer off.
+    """
+    global _ring_buffer
+    _ring_buffer = deque(maxlen=size) if size else None
+
+def ring_buffer_lines():
+    return list(_ring_buffer) if _ring_buffer is not None else []
+
+if os.environ.get('SONYUTILITIES_LOG_RING'):
+    enable_ring_buffer(int(os.environ['SONYUTILITIES_LOG_RING']))
+
+
+class Cursor():
+    """
+    Given a path to a SQLite database, return an object containing the path and 
+    an open cursor into the database
+    >>> import os
+    >>> from calibre_plugins.sonyutilities.device_database import Cursor 
+    >>> path1 = os.tempnam() 
+    >>> x = Cursor(path1)
+    >>> print (x.path == path1)
+    True
+    >>> print (x.cursor)
+    <...Cursor object at ...
+    
+    Clean up:
+    >>> import subprocess
+    >>> print(subprocess.call("rm -rvf "+path1, shell=True))
+    0
+       
+    """
+    def __init__(self,path):
+        self.path  = path
+        connection = connect_device_database(path)
+        # return bytestrings if the content cannot be decoded as unicode
+        connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+        connection.row_factory  = sqlite3.Row
+        self.cursor = connection.cursor()
+        del connection
+         
+class SonyDB(dict):
+    """
+    Given a dictionary of database paths indexed by database prefix,
+    open cursors for each, and return a dictionary of Cursor objects, indexed by prefix
+      
+    The structure is suitable for using within a "with closing(...) as ..." structure
+    and all cursors will be automatically closed when the end of the "with" block is reached.
+      
+    >>> import subprocess
+    
+    Create a SonyDB object (using empty databases), and check that it has correct structure
+    >>> from calibre_plugins.sonyutilities.device_database import SonyDB
+    >>> path1 = os.tempnam()
+    >>> path2 = os.tempnam()
+    >>> testdict = {'a': path1, 'b' : path2}
+    >>> obj = SonyDB(testdict)
+    >>> print(obj['a'].path == path1)
+    True
+    >>> print(obj['b'].path == path2)
+    True
+    >>> print(obj['a'].cursor)
+    <...Cursor object ...
+      
+    Try opening the SonyDB and executing queries:
+      
+    >>> from contextlib import closing
+    >>> with closing(SonyDB(testdict)) as db:
+    ...     for prefix in db:
+    ...         print(db[prefix].cursor.execute('PRAGMA integrity_check'))
+    <...Cursor object...
+    <...Cursor object...
+
+    Since the 'with' block is closed, the cursors will be too
+    >>> db['a'].cursor.execute('PRAGMA integrity_check')
+    Traceback (most recent call last):
+        ...
+    ProgrammingError: Cannot operate on a closed database.
+  
+    Finally write some garbage into one of the 'db' files and execute the queries:
+      
+    >>> with (open(path1,'w')) as stream:
+    ...     stream.write('test')
+    >>> with closing(SonyDB(testdict)) as db:
+    ...     for prefix in db:
+    ...         db[prefix].cursor.execute('PRAGMA integrity_check')
+    Traceback (most recent call last):
+        ...
+    DatabaseError: file is encrypted or is not a database
+          
+    Clean up:
+    >>> print(subprocess.call("rm -rvf %s %s" % (path1, path2), shell=True))
+    0
+       
+    """
+
+    def __init__(self, db):
+        cursors = {}
+        for key in db:
+            cursors[key]= Cursor(db[key]) 
+        super(SonyDB, self).__init__(cursors)
+       
+            
+    def close(self):
+        for key in self.keys():
+            self[key].cursor.connection.commit()
+            self[key].cursor.connection.close()
+
+
+def convert_sony_date(sony_date):
+    """
+    Convert an input sony date to a python Datetime
+
+    Sony's dates are unix timestamps multiplied by 1000 
+    - somebody must have felt it was necessary to save those few characters per date
+
+    Create a timestamp for "2000-11-30"
+    >>> from calibre_plugins.sonyutilities.device_database import convert_sony_date
+    >>> import time
+    >>> from datetime import datetime
+    >>> tm = time.mktime(time.strptime("2000-11-30 UTC", "%Y-%m-%d %Z"))
+    >>> print(tm)
+    975556800.0
+    >>> print(convert_sony_date(int(tm*1000)))
+    2000-11-30 00:00:00+00:00
+
+    """
+    from calibre.utils.date import utc_tz
+    from datetime import datetime
+    if sony_date:
+        converted_date = datetime.fromtimestamp(sony_date/1000).replace(tzinfo=utc_tz)
+    else:
+        converted_date = None
+    return converted_date
+            
+
+def database_version(database_path):
+    """
+    Return a value that changes whenever the SQLite database at database_path is modified
+
+    SQLite increments the "file change counter" in the database header (4 bytes at offset 24)
+    every time a transaction modifies the database, so combining that with the file size gives
+    a cheap version stamp that only needs a single short read from the device.
+
+    >>> import os, sqlite3
+    >>> from calibre_plugins.sonyutilities.device_database import database_version
+    >>> path1 = os.tempnam()
+    >>> connection = sqlite3.connect(path1)
+    >>> _ = connection.execute('CREATE TABLE t (x)')
+    >>> connection.commit()
+    >>> version1 = database_version(path1)
+    >>> print(version1 == database_version(path1))
+    True
+    >>> _ = connection.execute('INSERT INTO t VALUES (1)')
+    >>> connection.commit()
+    >>> print(version1 == database_version(path1))
+    False
+
+    Clean up:
+    >>> connection.close()
+    >>> os.remove(path1)
+
+    """
+    import struct
+    with open(database_path, 'rb') as database_file:
+        header = database_file.read(28)
+    change_counter = struct.unpack(b'>I', header[24:28])[0] if len(header) == 28 else None
+    return (change_counter, os.path.getsize(database_path))
+
+
+def explain_query_plan(cursor, query, query_values=()):
+    """
+    Run 'EXPLAIN QUERY PLAN' for the query, and return a list of the plan details,
+    each paired with a flag that is True if that step is a full scan of a table
+
+    >>> import sqlite3
+    >>> from calibre_plugins.sonyutilities.device_database import explain_query_plan
+    >>> cursor = sqlite3.connect(':memory:').cursor()
+    >>> _ = cursor.execute('CREATE TABLE books (_id INTEGER PRIMARY KEY, file_path TEXT)')
+    >>> print([full_scan for detail, full_scan in explain_query_plan(cursor, 'SELECT _id FROM books WHERE file_path = ?', ('a',))])
+    [True]
+    >>> _ = cursor.execute('CREATE INDEX books_file_path ON books (file_path)')
+    >>> print([full_scan for detail, full_scan in explain_query_plan(cursor, 'SELECT _id FROM books WHERE file_path = ?', ('a',))])
+    [False]
+    >>> print([full_scan for detail, full_scan in explain_query_plan(cursor, 'SELECT file_path FROM books WHERE _id = ?', (1,))])
+    [False]
+
+    """
+    cursor.execute('EXPLAIN QUERY PLAN ' + query, query_values)
+    plan = []
+    for row in cursor.fetchall():
+        # The detail is always the last column, whatever version of SQLite is in use
+        detail = row[-1]
+        words  = detail.split()
+        full_scan = (words[0] == 'SCAN'
+                     and ' USING ' not in detail
+                     and words[1] not in ('SUBQUERY', 'CONSTANT'))
+        plan.append((detail, full_scan))
+    return plan
+
+
+class HelperIndexes():
+    """
+    Create plugin-owned indexes in the databases for the duration of a bulk operation
+
+    Each index is given as a tuple of (name, table, columns). An index is only created if
+    the table exists and doesn't already have an index starting with the same column, so
+    that the device schema is left as it shipped once the indexes are dropped again. On the copy
+    in a DeviceDatabaseSnapshot, creating and dropping them isn't counted as a change to write back.
+    Like SonyDB, this is intended to be used within a "with closing(...)" block.
+
+    >>> import os, sqlite3
+    >>> from contextlib import closing
+    >>> from calibre_plugins.sonyutilities.device_database import HelperIndexes
+    >>> path1 = os.tempnam()
+    >>> connection = sqlite3.connect(path1)
+    >>> _ = connection.execute('CREATE TABLE Shelf (Name TEXT, _IsDeleted TEXT)')
+    >>> _ = connection.execute('CREATE TABLE ShelfContent (ShelfName TEXT, ContentId TEXT)')
+    >>> _ = connection.execute('CREATE INDEX shelfcontent_shelfname ON ShelfContent (ShelfName)')
+    >>> connection.commit()
+    >>> def index_names():
+    ...     return sorted(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    >>> indexes = [('sonyutilities_shelf_name', 'Shelf', ('Name', '_IsDeleted')),
+    ...            ('sonyutilities_shelfcontent_shelfname', 'ShelfContent', ('ShelfName',)),
+    ...            ('sonyutilities_books_file_path', 'books', ('file_path',))]
+    
+    Only the index on Shelf is needed: ShelfContent is already indexed and there is no books table
+    >>> with closing(HelperIndexes([path1], indexes)) as helper_indexes:
+    ...     print(', '.join(helper_indexes.created[path1]))
+    ...     print(', '.join(index_names()))
+    sonyutilities_shelf_name
+    shelfcontent_shelfname, sonyutilities_shelf_name
+    >>> print(', '.join(index_names()))
+    shelfcontent_shelfname
+
+    Clean up:
+    >>> connection.close()
+    >>> os.remove(path1)
+
+    """
+    def __init__(self, database_paths, indexes):
+        self.created  = {}
+        self.counters = {}
+        for path in database_paths:
+            self.created[path] = self._create_indexes(path, indexes)
+
+    @staticmethod
+    def missing(connection, indexes):
+        """
+        Return the indexes whose table exists, but which don't have an index on their first column
+        """
+        missing = []
+        for name, table, columns in indexes:
+            if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ? COLLATE NOCASE", (table,)).fetchone():
+                continue
+            existing = connection.execute('PRAGMA index_list(%s)' % table).fetchall()
+            leading_columns = [connection.execute('PRAGMA index_info(%s)' % index[1]).fetchone() for index in existing]
+            # SQLite names are case insensitive, and the Sony schema spells the same column differently in different tables
+            if any(column is not None and column[2].lower() == columns[0].lower() for column in leading_columns):
+                continue
+            missing.append((name, table, columns))
+        return missing
+
+    def _create_indexes(self, path, indexes):
+        created = []
+        counter_before = database_change_counter(path)
+        with closing(connect_device_database(path)) as connection:
+            for name, table, columns in HelperIndexes.missing(connection, indexes):
+                debug_print("creating index %s on %s(%s)" % (name, table, ', '.join(columns)))
+                connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, table, ', '.join(columns)))
+                created.append(name)
+            connection.commit()
+        self.counters[path] = (counter_before, database_change_counter(path))
+        return created
+
+    def close(self):
+        for path, created in self.created.items():
+            if not created:
+                continue
+            counter_before, counter_created = self.counters[path]
+            unchanged = database_change_counter(path) == counter_created
+            with closing(connect_device_database(path)) as connection:
+                for name in created:
+                    debug_print("dropping index %s" % name)
+                    connection.execute('DROP INDEX IF EXISTS %s' % name)
+                connection.commit()
+            snapshot = _snapshot_copies.get(os.path.realpath(path))
+            if snapshot is not None and unchanged:
+                # Nothing else was written while the indexes were there, so the copy is as it was before them
+                snapshot[0].ignore_change(path, counter_before, database_change_counter(path))
+        self.created  = {}
+        self.counters = {}
+
+
+def annotation_hash(html):
+    """
+    Hash the annotations for a book, so that unchanged annotations aren't written to the library
+
+    Returns None when there are no annotations, matching an empty custom column.
+
+    >>> from calibre_plugins.sonyutilities.device_database import annotation_hash
+    >>> print(annotation_hash('<p>note</p>') == annotation_hash(u'<p>note</p>'))
+    True
+    >>> print(annotation_hash('<p>note</p>') == annotation_hash('<p>other note</p>'))
+    False
+    >>> print(annotation_hash(''))
+    None
+
+    """
+    if not html:
+        return None
+    return hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+
+class AnnotationCache():
+    """
+    A store on the host of the annotations HTML for each book, keyed by device UUID and contentID
+
+    Each entry records a marker of the book's annotations in the device database, and
+    is only returned while the marker given is unchanged. Like SonyDB, this is intended 
+    to be used within a "with closing(...)" block.
+
+    >>> import os
+    >>> from contextlib import closing
+    >>> from calibre_plugins.sonyutilities.device_database import AnnotationCache
+    >>> path1 = os.tempnam()
+    >>> with closing(AnnotationCache(path1)) as cache:
+    ...     cache.put('uuid', 5, '2:1400000000000', '<p>note</p>')
+    >>> with closing(AnnotationCache(path1)) as cache:
+    ...     print(cache.get('uuid', 5, '2:1400000000000'))
+    ...     print(cache.get('uuid', 5, '3:1400000000001'))
+    ...     print(cache.get('other', 5, '2:1400000000000'))
+    <p>note</p>
+    None
+    None
+
+    Clean up:
+    >>> os.remove(path1)
+
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS annotations ("
+                                "device_uuid TEXT, "
+                                "content_id TEXT, "
+                                "marker TEXT, "
+                                "html TEXT, "
+                                "PRIMARY KEY (device_uuid, content_id))")
+
+    def get(self, device_uuid, content_id, marker):
+        row = self.connection.execute("SELECT marker, html FROM annotations "
+                                      "WHERE device_uuid = ? AND content_id = ?",
+                                      (device_uuid, content_id)).fetchone()
+        if row is None or row[0] != marker:
+            return None
+        return row[1]
+
+    def put(self, device_uuid, content_id, marker, html):
+        self.connection.execute("INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)",
+                                (device_uuid, content_id, marker, html))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class OperationStats():
+    """
+    What one device operation did: its wall time, the SQLite statements it executed and 
+    their time, the rows they touched, commits, and the bytes it copied
+    """
+    def __init__(self, name):
+        self.name           = name
+        self.wall_time      = 0.0
+        self.statements     = 0
+        self.statement_time = 0.0
+        self.rows           = 0
+        self.commits        = 0
+        self.bytes_copied   = 0
+        # Executions of each statement, only kept while the statement profiler is on
+        self.statement_counts = {}
+
+_operations_lock   = threading.Lock()
+_session_operations = []
+_active_operations = threading.local()
+
+def _current_operations():
+    if not hasattr(_active_operations, 'stack'):
+        _active_operations.stack = []
+    return _active_operations.stack
+
+def _record(statements=0, statement_time=0.0, rows=0, commits=0, bytes_copied=0):
+    # Counted against every operation running in this thread, so that an operation includes those it calls
+    for stats in _current_operations():
+        stats.statements     += statements
+        stats.statement_time += statement_time
+        stats.rows           += rows
+        stats.commits        += commits
+        stats.bytes_copied   += bytes_copied
+
+def record_bytes_copied(count):
+    _record(bytes_copied=count)
+
+
+class instrumented():
+    """
+    Record the statistics of an operation for the session report, used as a context 
+    manager or, without the name, as a method or function decorator
+
+    Only statements executed through connections from connect_device_database are counted.
+
+    >>> from contextlib import closing
+    >>> from calibre_plugins.sonyutilities.device_database import (instrumented, connect_device_database, 
+    ...                                                         session_operations, session_report)
+    >>> @instrumented()
+    ... def create_table(connection):
+    ...     connection.execute('CREATE TABLE t (a)')
+    ...     connection.executemany('INSERT INTO t VALUES (?)', [(1,), (2,), (3,)])
+    ...     connection.commit()
+    >>> with instrumented('instrumented_doctest') as stats:
+    ...     with closing(connect_device_database(':memory:')) as connection:
+    ...         create_table(connection)
+    ...         cursor = connection.cursor()
+    ...         rows = cursor.execute('UPDATE t SET a = a + 1 WHERE a > 1').rowcount
+    >>> print("statements=%d rows=%d commits=%d" % (stats.statements, stats.rows, stats.commits))
+    statements=3 rows=5 commits=1
+    >>> print(", ".join(stats.name for stats in session_operations()[-2:]))
+    create_table, instrumented_doctest
+    >>> print([line for line in session_report().splitlines() if line.startswith('instrumented_doctest ')][0])
+    instrumented_doctest                      1 ...s    ...s          3    ...s         5        1            0
+
+    """
+    def __init__(self, name=None):
+        self.name = name
+
+    def __call__(self, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with instrumented(self.name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        self.stats = OperationStats(self.name)
+        self.start = time.time()
+        _current_operations().append(self.stats)
+        return self.stats
+
+    def __exit__(self, *exc_info):
+        self.stats.wall_time = time.time() - self.start
+        _current_operations().remove(self.stats)
+        if _statement_profiler is not None:
+            _statement_profiler.operation_finished(self.stats)
+        with _operations_lock:
+            _session_operations.append(self.stats)
+        return False
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor that counts and times its statements for the running operations
+    """
+    def execute(self, sql, parameters=()):
+        start  = time.time()
+        result = sqlite3.Cursor.execute(self, sql, parameters)
+        elapsed = time.time() - start
+        _record(statements=1, statement_time=elapsed, rows=max(self.rowcount, 0))
+        if _statement_profiler is not None:
+            _statement_profiler.record(sql, elapsed)
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        start  = time.time()
+        result = sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        elapsed = time.time() - start
+        _record(statements=1, statement_time=elapsed, rows=max(self.rowcount, 0))
+        if _statement_profiler is not None:
+            _statement_profiler.record(sql, elapsed)
+        return result
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    A connection whose cursors are InstrumentedCursors, and whose commits are counted
+    """
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        sqlite3.Connection.commit(self)
+        _record(commits=1)
+
+
+def connect_device_database(path, **kwargs):
+    """
+    Open a device database, with its statements counted for the session report
+    """
+    return sqlite3.connect(path, factory=InstrumentedConnection, **kwargs)
+
+
+def database_change_counter(path):
+    """
+    The file change counter from the SQLite header, which every committed transaction increments
+    """
+    with open(path, 'rb') as f:
+        f.seek(24)
+        header = f.read(4)
+    return struct.unpack(b'>I', header)[0] if len(header) == 4 else None
+
+
+class DeviceDatabaseSnapshot():
+    """
+    Work on copies of the device databases on the host, for the random reads and writes of an
+    operation, rather than on the reader's USB storage
+
+    Used as a context manager, given a database path or a dict of {prefix: database path}, and
+    returns the same with the paths of the copies. Each database is copied in one sequential read
+    while holding a read lock on it. When the operation finishes without an exception, each copy
+    that was changed is checked and copied back next to its database, then renamed over it. If the
+    database on the device was changed in the meantime (its mtime, size or change counter differ,
+    or it has a journal) nothing is written back and an exception is raised. A saved ChangeJournal
+    applied to a copy is only removed once the copy has been written back, so if the write-back
+    fails, or the operation raises an exception, the journal is replayed when the reader is next
+    connected.
+
+    With enabled=False the databases themselves are returned, so callers can use it unconditionally.
+
+    >>> import os
+    >>> from contextlib import closing
+    >>> from calibre_plugins.sonyutilities.device_database import DeviceDatabaseSnapshot, connect_device_database
+    >>> path = os.tempnam()
+    >>> with closing(connect_device_database(path)) as connection:
+    ...     cursor = connection.execute('CREATE TABLE t (a)')
+    >>> with DeviceDatabaseSnapshot(path) as local_path:
+    ...     with closing(connect_device_database(local_path)) as connection:
+    ...         cursor = connection.execute('INSERT INTO t VALUES (1)')
+    ...         connection.commit()
+    ...     print(local_path == path)
+    False
+    >>> with closing(connect_device_database(path)) as connection:
+    ...     print(connection.execute('SELECT COUNT(*) FROM t').fetchone()[0])
+    1
+
+    A change made on the device while the copy is being worked on is not overwritten
+    >>> with DeviceDatabaseSnapshot({'main': path}) as local_paths:
+    ...     for database in (local_paths['main'], path):
+    ...         with closing(connect_device_database(database)) as connection:
+    ...             cursor = connection.execute('INSERT INTO t VALUES (2)')
+    ...             connection.commit()
+    Traceback (most recent call last):
+    ...
+    Exception: ...was changed while a copy of it was being worked on...
+    >>> with closing(connect_device_database(path)) as connection:
+    ...     print(connection.execute('SELECT COUNT(*) FROM t').fetchone()[0])
+    2
+
+    Helper indexes built and dropped again on the copy aren't a change, so there is nothing to write back
+    >>> from calibre_plugins.sonyutilities.device_database import HelperIndexes
+    >>> with DeviceDatabaseSnapshot(path) as local_path:
+    ...     with closing(HelperIndexes([local_path], [('sonyutilities_t_a', 't', ('a',))])) as helper_indexes:
+    ...         print(', '.join(helper_indexes.created[local_path]))
+    ...     with closing(connect_device_database(path)) as connection:
+    ...         cursor = connection.execute('INSERT INTO t VALUES (3)')
+    ...         connection.commit()
+    sonyutilities_t_a
+    >>> os.remove(path)
+
+    """
+    def __init__(self, databases, enabled=True):
+        self.databases = databases
+        self.enabled   = enabled
+        self.snapshots = []
+        self.journals  = []
+        self.tdir      = None
+
+    def _device_state(self, path):
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size, database_change_counter(path))
+
+    def __enter__(self):
+        if not self.enabled:
+            return self.databases
+        from calibre.ptempfile import PersistentTemporaryDirectory
+
+        paths = self.databases.items() if isinstance(self.databases, dict) else [(None, self.databases)]
+        self.tdir = PersistentTemporaryDirectory('_sony_snapshot')
+        local_paths = {}
+        try:
+            with instrumented('database snapshot'):
+                for index, (prefix, path) in enumerate(paths):
+                    local_path = os.path.join(self.tdir, '%d_%s' % (index, os.path.basename(path)))
+                    # A read transaction stops the device committing a change part way through the copy
+                    with closing(sqlite3.connect(path)) as connection:
+                        connection.execute('BEGIN')
+                        connection.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+                        shutil.copyfile(path, local_path)
+                        device_state = self._device_state(path)
+                    record_bytes_copied(os.path.getsize(local_path))
+                    self.snapshots.append((path, local_path, device_state, database_change_counter(local_path)))
+                    local_paths[prefix] = local_path
+        except:
+            shutil.rmtree(self.tdir, ignore_errors=True)
+            raise
+        for path, local_path, _device_state, _local_counter in self.snapshots:
+            _snapshot_copies[os.path.realpath(local_path)] = (self, path)
+        return local_paths if isinstance(self.databases, dict) else local_paths[None]
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self.enabled:
+            return False
+        from calibre.utils.filenames import atomic_rename
+
+        try:
+            if exc_type is not None:
+                return False
+            with instrumented('database write-back'):
+                for path, local_path, device_state, local_counter in self.snapshots:
+                    if database_change_counter(local_path) == local_counter:
+                        continue
+                    if self._device_state(path) != device_state or os.path.exists(path + '-journal'):
+                        raise Exception(_("The device database '%s' was changed while a copy of it was being worked on, "
+                                          "the changes to the copy were not written back") % path)
+                    with closing(sqlite3.connect(local_path)) as connection:
+                        check_result = connection.execute('PRAGMA quick_check').fetchone()[0]
+                    if check_result != 'ok':
+                        raise Exception(check_result)
+                    # Copy next to the original first, so that the swap is a rename on the same filesystem
+                    swap_file = path + '.sonyutilities'
+                    shutil.copyfile(local_path, swap_file)
+                    record_bytes_copied(os.path.getsize(swap_file))
+                    atomic_rename(swap_file, path)
+            self._finish_journals()
+        finally:
+            for _path, local_path, _device_state, _local_counter in self.snapshots:
+                _snapshot_copies.pop(os.path.realpath(local_path), None)
+            shutil.rmtree(self.tdir, ignore_errors=True)
+        return False
+
+    def ignore_change(self, local_path, counter_before, counter_after):
+        '''
+        Don't count the commits that took the copy at local_path from counter_before to counter_after
+        as a change, provided it hadn't already been changed before them
+        '''
+        for index, (path, snapshot_path, device_state, local_counter) in enumerate(self.snapshots):
+            if os.path.realpath(snapshot_path) == os.path.realpath(local_path) and local_counter == counter_before:
+                self.snapshots[index] = (path, snapshot_path, device_state, counter_after)
+
+    def _finish_journals(self):
+        # The changes are only on the device now, so this is when the journals for them can go
+        for path in set(path for path, _journal in self.journals):
+            with closing(sqlite3.connect(path)) as connection:
+                for journal_path, journal in self.journals:
+                    if journal_path == path:
+                        journal.finish(connection)
+
+
+JOURNAL_MARKER_TABLE = 'sonyutilities_journal'
+_journal_ids = itertools.count(1)
+
+# The snapshot copies being worked on, to their DeviceDatabaseSnapshot and the database on the device
+_snapshot_copies = {}
+
+def change_journal_directory():
+    return os.path.join(config_dir, 'plugins', 'Sony Utilities journal')
+
+def _connection_database_path(connection):
+    for _seq, name, path in connection.execute('PRAGMA database_list').fetchall():
+        if name == 'main':
+            return path
+    return None
+
+def _database_unavailable(error, database_path):
+    """
+    Whether an error means the database couldn't be read or written, as when the reader has been
+    unplugged, rather than that a statement was wrong or the database was busy
+    """
+    if isinstance(error, EnvironmentError):
+        return True
+    if isinstance(error, sqlite3.OperationalError):
+        message = unicode(error).lower()
+        if 'disk i/o error' in message or 'unable to open' in message or 'readonly database' in message:
+            return True
+    return bool(database_path) and not os.path.exists(database_path)
+
+
+class ChangeJournal():
+    """
+    The changes an operation plans to make to one device database, made in a single transaction
+
+    The statements are recorded with execute() and executemany() while the operation reads the
+    database, and all made by apply() in one transaction, rather than committing each row. SQLite's
+    own rollback journal makes sure that a transaction interrupted by unplugging the reader leaves
+    nothing changed. When the journal is given the device_store_uuid of the database, it is also
+    saved on the host before it is applied, and the transaction records the journal's id in a marker
+    table, so that recover_change_journals() can tell after the reader is reconnected whether it
+    was applied, and replay or discard it if not.
+
+    >>> import os, tempfile
+    >>> from contextlib import closing
+    >>> from calibre_plugins.sonyutilities.device_database import (ChangeJournal, connect_device_database,
+    ...                                         pending_change_journals, recover_change_journals)
+    >>> path = os.tempnam()
+    >>> directory = tempfile.mkdtemp()
+    >>> with closing(connect_device_database(path)) as connection:
+    ...     cursor = connection.execute('CREATE TABLE t (a)')
+    ...     journal = ChangeJournal('doctest', 'abcdef', directory)
+    ...     journal.executemany('INSERT INTO t VALUES (?)', [(1,), (2,)])
+    ...     print(journal.apply(connection))
+    ...     print(connection.execute('SELECT COUNT(*) FROM t').fetchone()[0])
+    [1, 1]
+    2
+    >>> print(os.listdir(directory))
+    []
+
+    A journal that was saved but not applied is found for the device, and replayed
+    >>> journal = ChangeJournal('doctest', 'abcdef', directory)
+    >>> journal.execute('DELETE FROM t WHERE a = ?', (1,))
+    >>> journal.save()
+    >>> journals = pending_change_journals(['abcdef'], directory)
+    >>> print(", ".join(journal.operation for journal in journals))
+    doctest
+    >>> print(recover_change_journals(path, journals))
+    (1, 0, 0, [])
+    >>> with closing(connect_device_database(path)) as connection:
+    ...     print(connection.execute('SELECT COUNT(*) FROM t').fetchone()[0])
+    ...     print(connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'sonyutilities_journal'").fetchone()[0])
+    1
+    0
+
+    A statement that fails is rolled back, and the journal discarded, as replaying it would fail too
+    >>> journal = ChangeJournal('doctest', 'abcdef', directory)
+    >>> journal.execute('INSERT INTO no_such_table VALUES (?)', (1,))
+    >>> with closing(connect_device_database(path)) as connection:
+    ...     journal.apply(connection)
+    Traceback (most recent call last):
+    ...
+    OperationalError: no such table: no_such_table
+    >>> print(os.listdir(directory))
+    []
+
+    A journal applied to a snapshot copy is kept until the copy has been written back
+    >>> from calibre_plugins.sonyutilities.device_database import DeviceDatabaseSnapshot
+    >>> with DeviceDatabaseSnapshot(path) as local_path:
+    ...     with closing(connect_device_database(local_path)) as connection:
+    ...         journal = ChangeJournal('doctest', 'abcdef', directory)
+    ...         journal.execute('INSERT INTO t VALUES (?)', (3,))
+    ...         print(journal.apply(connection))
+    ...     print(os.listdir(directory) == [journal.id + '.json'])
+    [1]
+    True
+    >>> print(os.listdir(directory))
+    []
+    >>> with closing(connect_device_database(path)) as connection:
+    ...     print(connection.execute('SELECT COUNT(*) FROM t').fetchone()[0])
+    ...     print(connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'sonyutilities_journal'").fetchone()[0])
+    2
+    0
+    >>> os.remove(path); os.rmdir(directory)
+
+    """
+    def __init__(self, operation, device_store_uuid=None, directory=None):
+        self.operation         = operation
+        self.device_store_uuid = device_store_uuid
+        self.statements        = []
+        self.id   = '%s-%s-%d-%d' % (device_store_uuid, time.strftime('%Y%m%d%H%M%S'), os.getpid(), next(_journal_ids))
+        self.path = os.path.join(directory or change_journal_directory(), self.id + '.json') if device_store_uuid else None
+
+    def execute(self, sql, values=()):
+        self.statements.append((sql, list(values)))
+
+    def executemany(self, sql, rows):
+        for values in rows:
+            self.execute(sql, values)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Written to a temporary file and renamed, so a journal is never found half written
+        with open(self.path + '.tmp', 'wb') as f:
+            json.dump({'id': self.id, 'operation': self.operation, 'device_store_uuid': self.device_store_uuid,
+                       'statements': self.statements}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + '.tmp', self.path)
+
+    def apply(self, connection):
+        """
+        Make the changes in one transaction, and return the number of rows each statement changed
+        """
+        if not self.statements:
+            return []
+        database_path = _connection_database_path(connection)
+        if self.path and not os.path.exists(self.path):
+            self.save()
+        cursor    = connection.cursor()
+        rowcounts = []
+        try:
+            if self.path:
+                # Python's sqlite3 commits before a CREATE, so this can't be part of the transaction
+                cursor.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY)' % JOURNAL_MARKER_TABLE)
+                connection.commit()
+                cursor.execute('INSERT INTO %s VALUES (?)' % JOURNAL_MARKER_TABLE, (self.id,))
+            for sql, values in self.statements:
+                cursor.execute(sql, values)
+                rowcounts.append(cursor.rowcount)
+            connection.commit()
+        except:
+            if _database_unavailable(sys.exc_info()[1], database_path):
+                # The reader has most likely gone, so the journal is kept to replay when it's reconnected
+                debug_print("changes not applied, keeping journal:", self.path)
+                raise
+            connection.rollback()
+            self.discard()
+            raise
+        snapshot = _snapshot_copies.get(os.path.realpath(database_path)) if self.path and database_path else None
+        if snapshot is not None:
+            # The changes are only in a copy, so the snapshot finishes the journal once they are on the device
+            snapshot[0].journals.append((snapshot[1], self))
+        else:
+            self.finish(connection)
+        return rowcounts
+
+    def finish(self, connection):
+        # The journal is removed before its marker, so that an applied journal is never replayed
+        self.discard()
+        if self.path:
+            _remove_journal_markers(connection, [self.id])
+
+    def discard(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _remove_journal_markers(connection, ids=None):
+    """
+    Remove the markers of the given journals, or of all journals, and the marker table once it's empty
+    """
+    if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (JOURNAL_MARKER_TABLE,)).fetchone():
+        return
+    if ids is None:
+        connection.execute('DELETE FROM %s' % JOURNAL_MARKER_TABLE)
+    else:
+        connection.executemany('DELETE FROM %s WHERE id = ?' % JOURNAL_MARKER_TABLE, [(id_,) for id_ in ids])
+    connection.commit()
+    if not connection.execute('SELECT 1 FROM %s' % JOURNAL_MARKER_TABLE).fetchone():
+        connection.execute('DROP TABLE %s' % JOURNAL_MARKER_TABLE)
+        connection.commit()
+
+
+def pending_change_journals(device_store_uuids, directory=None):
+    """
+    The journals saved for the given device stores that haven't been removed, oldest first
+    """
+    directory = directory or change_journal_directory()
+    journals  = []
+    if not os.path.isdir(directory):
+        return journals
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name), 'rb') as f:
+            saved = json.load(f)
+        if saved['device_store_uuid'] not in device_store_uuids:
+            continue
+        journal = ChangeJournal(saved['operation'], saved['device_store_uuid'], directory)
+        journal.id         = saved['id']
+        journal.path       = os.path.join(directory, name)
+        journal.statements = saved['statements']
+        journals.append(journal)
+    return journals
+
+
+def recover_change_journals(database_path, journals, replay=True):
+    """
+    Replay, or discard, the journals left for a device database by operations that were interrupted
+
+    A journal whose marker is in the database was applied before the interruption, and is only
+    removed. Each journal is recovered on its own, so one that fails doesn't stop the others.
+    Returns the number of journals replayed, already applied and discarded, and a list of
+    (journal, error) for those that failed.
+    """
+    replayed = applied = discarded = 0
+    failed   = []
+    with closing(connect_device_database(database_path)) as connection:
+        markers = set()
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (JOURNAL_MARKER_TABLE,)).fetchone():
+            markers = set(row[0] for row in connection.execute('SELECT id FROM %s' % JOURNAL_MARKER_TABLE))
+        for journal in journals:
+            try:
+                if journal.id in markers:
+                    journal.discard()
+                    applied += 1
+                elif replay:
+                    journal.apply(connection)
+                    replayed += 1
+                else:
+                    journal.discard()
+                    discarded += 1
+            except Exception as e:
+                debug_print("journal not recovered:", journal.id, e)
+                failed.append((journal, e))
+        _remove_journal_markers(connection)
+    return replayed, applied, discarded, failed
+
+
+class StatementProfile():
+    """
+    The executions of one distinct SQL statement
+    """
+    def __init__(self, sql):
+        self.sql        = sql
+        self.calls      = 0
+        self.total_time = 0.0
+        self.max_time   = 0.0
+        # The most executions in a single run of an operation, and the operations that exceeded the N+1 threshold
+        self.max_per_operation = 0
+        self.n_plus_one = set()
+
+    def as_dict(self):
+        return OrderedDict([('sql', self.sql), ('calls', self.calls), ('total_time', self.total_time),
+                            ('max_time', self.max_time), ('max_per_operation', self.max_per_operation),
+                            ('n_plus_one', ' '.join(sorted(self.n_plus_one)))])
+
+
+class StatementProfiler():
+    """
+    Profile each distinct SQL statement executed through connections from connect_device_database
+
+    A statement executed more than N_PLUS_ONE_THRESHOLD times in one run of an operation is flagged 
+    as an N+1 pattern: a query per book that should be a single query for all of them.
+
+    >>> import os, json
+    >>> from contextlib import closing
+    >>> from calibre_plugins.sonyutilities.device_database import (instrumented, connect_device_database,
+    ...                                                         enable_statement_profiler)
+    >>> profiler = enable_statement_profiler()
+    >>> with instrumented('doctest'):
+    ...     with closing(connect_device_database(':memory:')) as connection:
+    ...         cursor = connection.execute('CREATE TABLE t (a)')
+    ...         cursor = connection.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(200)])
+    ...         for i in range(150):
+    ...             rows = connection.execute('SELECT a   FROM t  WHERE a = ?', (i,)).fetchall()
+    >>> for profile in sorted(profiler.profiles(), key=lambda profile: profile.sql):
+    ...     print("%d %d %s" % (profile.calls, profile.max_per_operation, profile.sql))
+    1 1 CREATE TABLE t (a)
+    1 1 INSERT INTO t VALUES (?)
+    150 150 SELECT a FROM t WHERE a = ?
+    >>> print(", ".join(profile.sql for profile in profiler.n_plus_one()))
+    SELECT a FROM t WHERE a = ?
+    >>> path = os.tempnam()
+    >>> profiler.export(path + '.json')
+    >>> print(json.load(open(path + '.json'))[0]['n_plus_one'])
+    doctest
+    >>> profiler.export(path + '.csv')
+    >>> print(open(path + '.csv').readline().strip())
+    sql,calls,total_time,max_time,max_per_operation,n_plus_one
+    >>> os.remove(path + '.json'); os.remove(path + '.csv')
+    >>> profiler = enable_statement_profiler(False)
+
+    """
+    N_PLUS_ONE_THRESHOLD = 100
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.statements = {}
+
+    def record(self, sql, elapsed):
+        sql = ' '.join(sql.split())
+        with self.lock:
+            if sql not in self.statements:
+                self.statements[sql] = StatementProfile(sql)
+            profile = self.statements[sql]
+            profile.calls      += 1
+            profile.total_time += elapsed
+            profile.max_time    = max(profile.max_time, elapsed)
+        # Counted against every running operation, so a loop calling another operation is found too
+        for stats in _current_operations():
+            stats.statement_counts[sql] = stats.statement_counts.get(sql, 0) + 1
+
+    def operation_finished(self, stats):
+        with self.lock:
+            for sql, count in stats.statement_counts.iteritems():
+                profile = self.statements.get(sql)
+                if profile is None:
+                    continue
+                profile.max_per_operation = max(profile.max_per_operation, count)
+                if count > self.N_PLUS_ONE_THRESHOLD:
+                    profile.n_plus_one.add(stats.name)
+        stats.statement_counts = {}
+
+    def profiles(self):
+        """
+        The statements, those taking the most time first
+        """
+        with self.lock:
+            return sorted(self.statements.values(), key=lambda profile: (-profile.total_time, profile.sql))
+
+    def n_plus_one(self):
+        return [profile for profile in self.profiles() if profile.n_plus_one]
+
+    def report(self):
+        lines = ['%6s %9s %9s %8s  %s' % ('Calls', 'Total', 'Max', 'Per op', 'Statement')]
+        for profile in self.profiles():
+            lines.append('%6d %8.3fs %8.3fs %8d%s %s' % (profile.calls, profile.total_time, profile.max_time,
+                                                     profile.max_per_operation, '!' if profile.n_plus_one else ' ',
+                                                     profile.sql))
+        for profile in self.n_plus_one():
+            lines.append('N+1 in %s: %s' % (', '.join(sorted(profile.n_plus_one)), profile.sql))
+        return '\n'.join(lines)
+
+    def export(self, path):
+        """
+        Write the statements to path, as JSON if it ends in ".json" and otherwise as CSV
+        """
+        rows = [profile.as_dict() for profile in self.profiles()]
+        if path.lower().endswith('.json'):
+            with open(path, 'wb') as f:
+                json.dump(rows, f, indent=2)
+            return
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow([str(field) for field in StatementProfile('').as_dict().keys()])
+            for row in rows:
+                writer.writerow([unicode(value).encode('utf-8') for value in row.values()])
+
+
+_statement_profiler = None
+
+def enable_statement_profiler(enabled=True):
+    """
+    Turn the statement profiler on, starting a new profile, or off. Returns the profiler, or None when off.
+    """
+    global _statement_profiler
+    _statement_profiler = StatementProfiler() if enabled else None
+    return _statement_profiler
+
+def statement_profiler():
+    return _statement_profiler
+
+if os.environ.get('SONYUTILITIES_PROFILE_SQL'):
+    enable_statement_profiler()
+
+
+def session_operations():
+    with _operations_lock:
+        return list(_session_operations)
+
+def session_report():
+    """
+    Summarise the operations of this session by name, in the order each was first run
+    """
+    totals = OrderedDict()
+    for stats in session_operations():
+        if stats.name not in totals:
+            totals[stats.name] = [0, 0.0, 0.0, 0, 0.0, 0, 0, 0]
+        total = totals[stats.name]
+        total[0] += 1
+        total[1] += stats.wall_time
+        total[2]  = max(total[2], stats.wall_time)
+        total[3] += stats.statements
+        total[4] += stats.statement_time
+        total[5] += stats.rows
+        total[6] += stats.commits
+        total[7] += stats.bytes_copied
+    lines = ['%-36s %6s %9s %9s %10s %9s %9s %8s %12s' % 
+             ('Operation', 'Calls', 'Time', 'Max', 'Statements', 'SQL time', 'Rows', 'Commits', 'Bytes')]
+    for name, total in totals.iteritems():
+        lines.append('%-36s %6d %8.3fs %8.3fs %10d %8.3fs %9d %8d %12d' % ((name,) + tuple(total)))
+    return '\n'.join(lines)
@@ -17,14 +17,16 @@ try:
     from PyQt5.Qt import (QDialog, QVBoxLayout, QLabel, QCheckBox, QGridLayout, QRadioButton, QComboBox, QSpinBox,
                           QGroupBox, Qt, QDialogButtonBox, QHBoxLayout, QPixmap, QTableWidget, QAbstractItemView,
                           QProgressDialog, QTimer, QLineEdit, QPushButton, QDoubleSpinBox, QButtonGroup,
-                          QSpacerItem, QToolButton, QTableWidgetItem, QAction, QApplication, QUrl)
+                          QSpacerItem, QToolButton, QTableWidgetItem, QAction, QApplication, QUrl,
+                          QTableView, QAbstractTableModel, QModelIndex, QDateTime, QBrush)
     from PyQt5 import QtWidgets as QtGui
 except ImportError as e:
     debug_print("Error loading QT5: ", e)
     from PyQt4.Qt import (QDialog, QVBoxLayout, QLabel, QCheckBox, QGridLayout, QRadioButton, QComboBox, QSpinBox,
                           QGroupBox, Qt, QDialogButtonBox, QHBoxLayout, QPixmap, QTableWidget, QAbstractItemView,
                           QProgressDialog, QTimer, QLineEdit, QPushButton, QDoubleSpinBox, QButtonGroup,
-                          QSpacerItem, QToolButton, QTableWidgetItem, QAction, QApplication, QUrl)
+                          QSpacerItem, QToolButton, QTableWidgetItem, QAction, QApplication, QUrl,
+                          QTableView, QAbstractTableModel, QModelIndex, QDateTime, QBrush)
     from PyQt4 import QtGui
 
 from calibre.ebooks.metadata import authors_to_string
@@ -56,7 +58,7 @@ else:
         return x.toPyObject()
 
 from calibre_plugins.sonyutilities.common_utils import (SizePersistedDialog, ReadOnlyTableWidgetItem, ImageTitleLayout,
-                     DateDelegate, DateTableWidgetItem, RatingTableWidgetItem, CheckableTableWidgetItem,
+                     DateDelegate, DateTableWidgetItem, RatingTableWidgetItem,
                      get_icon, SonyDB, convert_sony_date)
 #                     debug_print, get_icon, get_library_uuid)
 from calibre_plugins.sonyutilities.book import SeriesBook
@@ -137,8 +139,15 @@ class AuthorTableWidgetItem(ReadOnlyTableWidgetItem):
 
 
 class QueueProgressDialog(QProgressDialog):
+    '''
+    Prepares the list of books to store the reading positions for, then passes it to queue
 
-    def __init__(self, gui, books, tdir, options, queue, db, plugin_action=None):
+    The books are prepared a chunk at a time from the event loop. If blocking is False, the 
+    dialog is not modal, so the calibre window can be used while the books are prepared.
+    '''
+    CHUNK_SIZE = 50
+
+    def __init__(self, gui, books, tdir, options, queue, db, plugin_action=None, blocking=True):
         QProgressDialog.__init__(self, '', '', 0, len(books), gui)
         debug_print("")
         self.setMinimumWidth(500)
@@ -147,11 +156,15 @@ class QueueProgressDialog(QProgressDialog):
         self.plugin_action = plugin_action
         self.gui = gui
         self.i, self.books_to_scan = 0, []
+        self.queued = False
 
         self.options['count_selected_books'] = len(self.books) if self.books else 0
         self.setWindowTitle(_("Queuing books for storing reading position"))
-        QTimer.singleShot(0, self.do_books)
-        self.exec_()
+        QTimer.singleShot(0, partial(self.run_step, self.do_books))
+        if blocking:
+            self.exec_()
+        else:
+            self.setWindowModality(Qt.NonModal)
 
 
     def do_books(self):
@@ -160,16 +173,16 @@ class QueueProgressDialog(QProgressDialog):
         
         library_db              = self.db
         library_config          = cfg.get_library_config(library_db)
-        sony_bookmark_column    = library_config.get(cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN])
-        sony_percentRead_column = library_config.get(cfg.KEY_PERCENT_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN])
-        last_read_column        = library_config.get(cfg.KEY_LAST_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_LAST_READ_CUSTOM_COLUMN])
+        self.sony_bookmark_column    = library_config.get(cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_CURRENT_LOCATION_CUSTOM_COLUMN])
+        self.sony_percentRead_column = library_config.get(cfg.KEY_PERCENT_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN])
+        self.last_read_column        = library_config.get(cfg.KEY_LAST_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_LAST_READ_CUSTOM_COLUMN])
 
-        debug_print("sony_percentRead_column=", sony_percentRead_column)
+        debug_print("sony_percentRead_column=", self.sony_percentRead_column)
         self.setLabelText(_('Preparing the list of books ...'))
         self.setValue(1)
         search_condition = ''
         if self.options[cfg.KEY_DO_NOT_STORE_IF_REOPENED]:
-            search_condition = 'and ({0}:false or {0}:<100)'.format(sony_percentRead_column)
+            search_condition = 'and ({0}:false or {0}:<100)'.format(self.sony_percentRead_column)
         if self.options['allOnDevice']:
             search_condition = 'ondevice:True {0}'.format(search_condition)
             debug_print("search_condition=", search_condition)
@@ -177,11 +190,34 @@ class QueueProgressDialog(QProgressDialog):
         else:
             onDeviceIds = self.plugin_action._get_selected_ids()
 
-        self.books = self.plugin_action._convert_calibre_ids_to_books(library_db, onDeviceIds)
-        self.setRange(0, len(self.books))
-        import pydevd;pydevd.settrace()
+        self.book_ids = list(onDeviceIds)
+        self.books = []
+        self.setRange(0, len(self.book_ids))
+        QTimer.singleShot(0, partial(self.run_step, self.do_next_books))
+
+
+    def run_step(self, step):
+        '''
+        Run one step of preparing the books from a timer. If it fails, no books are queued, so
+        that whoever is waiting for the queue call still gets it.
+        '''
+        try:
+            step()
+        except:
+            self.books_to_scan = []
+            self.do_queue()
+            raise
+
+
+    def do_next_books(self):
+        '''
+        Prepare the next chunk of books, then return to the event loop until the next chunk
+        '''
+        book_ids = self.book_ids[self.i:self.i + self.CHUNK_SIZE]
+        books = self.plugin_action._convert_calibre_ids_to_books(self.db, book_ids)
+        self.books.extend(books)
         with closing(SonyDB(self.plugin_action.device_database_path)) as db:
-            for book in self.books:
+            for book in books:
                 self.i += 1
                 device_book_paths = self.plugin_action.get_device_paths_from_id(book.calibre_id)
     #            debug_print("device_book_paths:", device_book_paths)
@@ -196,23 +232,27 @@ class QueueProgressDialog(QProgressDialog):
                         authors     = authors_to_string(book.authors),
                         contentIds  = book.contentIDs,
                         paths       = device_book_paths,
-                        bookmark    = book.get_user_metadata(sony_bookmark_column, True)['#value#'] if sony_bookmark_column else None,
-                        percentRead = book.get_user_metadata(sony_percentRead_column, True)['#value#'] if sony_percentRead_column else None,
-                        last_read   = book.get_user_metadata(last_read_column, True)['#value#'] if last_read_column else None
+                        bookmark    = book.get_user_metadata(self.sony_bookmark_column, True)['#value#'] if self.sony_bookmark_column else None,
+                        percentRead = book.get_user_metadata(self.sony_percentRead_column, True)['#value#'] if self.sony_percentRead_column else None,
+                        last_read   = book.get_user_metadata(self.last_read_column, True)['#value#'] if self.last_read_column else None
                     )
                     self.books_to_scan.append(data)
                 self.setValue(self.i)
 
+        if self.i < len(self.book_ids):
+            QTimer.singleShot(0, partial(self.run_step, self.do_next_books))
+            return
         debug_print("Finish")
         return self.do_queue()
 
 
     def do_queue(self):
         debug_print("")
-        if self.gui is None:
+        if self.queued:
             # There is a nasty QT bug with the timers/logic above which can
             # result in the do_queue method being called twice
             return
+        self.queued = True
         self.hide()
 
         # Queue a job to process these ePub books
@@ -1248,24 +1288,29 @@ class LockSeriesDialog(SizePersistedDialog):
     def assign_same_value(self):
         return self.assign_same_checkbox.isChecked()
 
+def series_book_status(book):
+    '''
+    The icon and tooltip used to flag the state of a SeriesBook in the series tables
+    '''
+    if not book.is_valid():
+        return 'dialog_warning.png', _("You have conflicting or out of sequence series indexes")
+    elif book.id() is None:
+        return 'add_book.png', _("Empty book added to series")
+    elif book.is_title_changed() or book.is_pubdate_changed() or book.is_series_changed():
+        return 'format-list-ordered.png', _("The book data has been changed")
+    else:
+        return 'ok.png', _("The series data is unchanged")
+
+
 class TitleWidgetItem(QTableWidgetItem):
 
     def __init__(self, book):
         if isinstance(book, SeriesBook):
             QTableWidgetItem.__init__(self, book.title())
             self.title_sort = book.title()
-            if not book.is_valid():
-                self.setIcon(get_icon('dialog_warning.png'))
-                self.setToolTip(_("You have conflicting or out of sequence series indexes"))
-            elif book.id() is None:
-                self.setIcon(get_icon('add_book.png'))
-                self.setToolTip(_("Empty book added to series"))
-            elif book.is_title_changed() or book.is_pubdate_changed() or book.is_series_changed():
-                self.setIcon(get_icon('format-list-ordered.png'))
-                self.setToolTip(_("The book data has been changed"))
-            else:
-                self.setIcon(get_icon('ok.png'))
-                self.setToolTip(_("The series data is unchanged"))
+            icon_name, tooltip = series_book_status(book)
+            self.setIcon(get_icon(icon_name))
+            self.setToolTip(tooltip)
         else:
             QTableWidgetItem.__init__(self, book.title)
             self.title_sort = book.title_sort
@@ -1287,24 +1332,6 @@ class AuthorsTableWidgetItem(ReadOnlyTableWidgetItem):
         return (self.author_sort < other.author_sort)
 
 
-class SeriesTableWidgetItem(ReadOnlyTableWidgetItem):
-
-    def __init__(self, series_name, series_index, is_original=False, assigned_index=None):
-        if series_name:
-            text = '%s [%s]' % (series_name, series_index)
-            text = '%s - %s' % (series_name, series_index)
-#            text = '%s [%s]' % (series_name, fmt_sidx(series_index))
-#            text = '%s - %s' % (series_name, fmt_sidx(series_index))
-        else:
-            text = ''
-        ReadOnlyTableWidgetItem.__init__(self, text)
-        if assigned_index is not None:
-            self.setIcon(get_icon('images/lock.png'))
-            self.setToolTip(_("Value assigned by user"))
-        if is_original:
-            self.setForeground(Qt.darkGray)
-
-
 class SeriesColumnComboBox(QComboBox):
 
     def __init__(self, parent, series_columns):
@@ -1329,10 +1356,151 @@ class SeriesColumnComboBox(QComboBox):
         return self.series_columns.keys()[self.currentIndex() - 1]
 
 
-class SeriesTableWidget(QTableWidget):
+class SeriesTableModel(QAbstractTableModel):
+    '''
+    Presents the list of SeriesBooks being managed, rendering each cell only when the view asks for it
+
+    The model shares the books list with ManageSeriesDeviceDialog, and changes it in place
+    so that both always agree on the order of the books.
+    '''
+    TITLE_COLUMN, AUTHORS_COLUMN, PUBDATE_COLUMN, ORIG_SERIES_COLUMN, SERIES_COLUMN = range(5)
+
+    def __init__(self, parent, books):
+        QAbstractTableModel.__init__(self, parent)
+        self.books = books
+        self.series_header = 'Series'
+        self.icon_cache = {}
+
+    def set_books(self, books):
+        self.beginResetModel()
+        self.books = books
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.books)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 5
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or orientation != Qt.Horizontal:
+            return None
+        if section == self.ORIG_SERIES_COLUMN:
+            return 'Original ' + self.series_header
+        if section == self.SERIES_COLUMN:
+            return 'New ' + self.series_header
+        return ['Title', 'Author(s)', 'PubDate'][section]
+
+    def set_series_header(self, text):
+        self.series_header = text
+        self.headerDataChanged.emit(Qt.Horizontal, self.ORIG_SERIES_COLUMN, self.SERIES_COLUMN)
+
+    def flags(self, index):
+        # Drops are handled by SeriesTableWidget.dropEvent, both onto a book and below the last one
+        if not index.isValid():
+            return Qt.ItemIsDropEnabled
+        flags = Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsDragEnabled | Qt.ItemIsDropEnabled
+        if index.column() in (self.TITLE_COLUMN, self.PUBDATE_COLUMN):
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def supportedDropActions(self):
+        return Qt.MoveAction
+
+    def get_icon(self, icon_name):
+        if icon_name not in self.icon_cache:
+            self.icon_cache[icon_name] = get_icon(icon_name)
+        return self.icon_cache[icon_name]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        book = self.books[index.row()]
+        column = index.column()
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if column == self.TITLE_COLUMN:
+                return book.title()
+            elif column == self.AUTHORS_COLUMN:
+                return ' & '.join(book.authors())
+            elif column == self.PUBDATE_COLUMN:
+                pubdate = book.pubdate()
+                return QDateTime(pubdate) if pubdate is not None else None
+            elif column == self.ORIG_SERIES_COLUMN:
+                return self.series_text(book.orig_series_name(), book.orig_series_index_string())
+            elif column == self.SERIES_COLUMN:
+                return self.series_text(book.series_name(), book.series_index_string())
+        elif role == Qt.DecorationRole:
+            if column == self.TITLE_COLUMN:
+                return self.get_icon(series_book_status(book)[0])
+            elif column == self.SERIES_COLUMN and book.assigned_index() is not None:
+                return self.get_icon('images/lock.png')
+        elif role == Qt.ToolTipRole:
+            if column == self.TITLE_COLUMN:
+                return series_book_status(book)[1]
+            elif column == self.SERIES_COLUMN and book.assigned_index() is not None:
+                return _("Value assigned by user")
+        elif role == Qt.ForegroundRole:
+            if column in (self.AUTHORS_COLUMN, self.ORIG_SERIES_COLUMN):
+                return QBrush(Qt.darkGray)
+        return None
+
+    def series_text(self, series_name, series_index):
+        if series_name:
+            return '%s - %s' % (series_name, series_index)
+        return ''
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        book = self.books[index.row()]
+        column = index.column()
+        if column == self.TITLE_COLUMN:
+            book.set_title(unicode(convert_qvariant(value)).strip())
+        elif column == self.PUBDATE_COLUMN:
+            book.set_pubdate(qt_to_dt(convert_qvariant(value), as_utc=False))
+        else:
+            return False
+        # The title column icon reflects whether the book has been changed
+        self.dataChanged.emit(self.index(index.row(), self.TITLE_COLUMN), index)
+        return True
+
+    def refresh_rows(self, rows):
+        '''
+        Emit dataChanged for each contiguous range of the given rows, rather than for the whole table
+        '''
+        rows = sorted(rows)
+        start = 0
+        while start < len(rows):
+            end = start
+            while end + 1 < len(rows) and rows[end + 1] == rows[end] + 1:
+                end += 1
+            self.dataChanged.emit(self.index(rows[start], 0), self.index(rows[end], self.columnCount() - 1))
+            start = end + 1
+
+    def reorder(self, books):
+        '''
+        Replace the order of the books, keeping the selection and current row with the books that moved
+        '''
+        self.layoutAboutToBeChanged.emit()
+        new_rows = dict((id(book), row) for row, book in enumerate(books))
+        row_map = [new_rows[id(book)] for book in self.books]
+        self.books[:] = books
+        from_indexes = self.persistentIndexList()
+        to_indexes = [self.index(row_map[index.row()], index.column()) for index in from_indexes]
+        self.changePersistentIndexList(from_indexes, to_indexes)
+        self.layoutChanged.emit()
+
+    def remove_row(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.books.pop(row)
+        self.endRemoveRows()
+
+
+class SeriesTableWidget(QTableView):
 
     def __init__(self, parent):
-        QTableWidget.__init__(self, parent)
+        QTableView.__init__(self, parent)
+        self.setModel(SeriesTableModel(self, []))
         self.create_context_menu()
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.setDragEnabled(True)
@@ -1382,18 +1550,11 @@ class SeriesTableWidget(QTableWidget):
             self.addAction(menu_action)
 
     def populate_table(self, books):
-        self.clear()
         self.setAlternatingRowColors(True)
-        self.setRowCount(len(books))
-        header_labels = ['Title', 'Author(s)', 'PubDate', 'Series', 'New Series']
-        self.setColumnCount(len(header_labels))
-        self.setHorizontalHeaderLabels(header_labels)
+        self.model().set_books(books)
         self.verticalHeader().setDefaultSectionSize(24)
         self.horizontalHeader().setStretchLastSection(True)
 
-        for row, book in enumerate(books):
-            self.populate_table_row(row, book)
-
         self.resizeColumnToContents(0)
         self.setMinimumColumnWidth(0, 150)
         self.setColumnWidth(1, 100)
@@ -1411,32 +1572,12 @@ class SeriesTableWidget(QTableWidget):
         if self.columnWidth(col) < minimum:
             self.setColumnWidth(col, minimum)
 
-    def populate_table_row(self, row, book):
-        self.blockSignals(True)
-        self.setItem(row, 0, TitleWidgetItem(book))
-        self.setItem(row, 1, AuthorsTableWidgetItem(book.authors()))
-        self.setItem(row, 2, DateTableWidgetItem(book.pubdate(), is_read_only=False,
-                                                 default_to_today=False, fmt=self.fmt))
-        self.setItem(row, 3, SeriesTableWidgetItem(book.orig_series_name(),
-#                                                   book.orig_series_index(),
-                                                   book.orig_series_index_string(),
-                                                   is_original=True))
-        self.setItem(row, 4, SeriesTableWidgetItem(book.series_name(),
-                                                   book.series_index_string(),
-                                                   assigned_index=book.assigned_index()))
-        self.blockSignals(False)
-
-    def swap_row_widgets(self, src_row, dest_row):
-        self.blockSignals(True)
-        self.insertRow(dest_row)
-        for col in range(self.columnCount()):
-            self.setItem(dest_row, col, self.takeItem(src_row, col))
-        self.removeRow(src_row)
-        self.blockSignals(False)
+    def current_row(self):
+        return self.currentIndex().row()
 
     def select_and_scroll_to_row(self, row):
         self.selectRow(row)
-        self.scrollToItem(self.currentItem())
+        self.scrollTo(self.model().index(row, 0))
 
     def event_has_mods(self, event=None):
         mods = event.modifiers() if event is not None else \
@@ -1450,46 +1591,26 @@ class SeriesTableWidget(QTableWidget):
             self.setDragEnabled(False)
         else:
             self.setDragEnabled(True)
-        return QTableWidget.mousePressEvent(self, event)
+        return QTableView.mousePressEvent(self, event)
 
     def dropEvent(self, event):
-        rows = self.selectionModel().selectedRows()
-        selrows = []
-        for row in rows:
-            selrows.append(row.row())
-        selrows.sort()
+        books = self.model().books
+        selrows = sorted(row.row() for row in self.selectionModel().selectedRows())
         drop_row = self.rowAt(event.pos().y())
         if drop_row == -1:
-            drop_row = self.rowCount() - 1
-        rows_before_drop = [idx for idx in selrows if idx < drop_row]
-        rows_after_drop = [idx for idx in selrows if idx >= drop_row]
-
-        dest_row = drop_row
-        for selrow in rows_after_drop:
-            dest_row += 1
-            self.swap_row_widgets(selrow + 1, dest_row)
-            book = self.parent().books.pop(selrow)
-            self.parent().books.insert(dest_row, book)
-
-        dest_row = drop_row + 1
-        for selrow in reversed(rows_before_drop):
-            self.swap_row_widgets(selrow, dest_row)
-            book = self.parent().books.pop(selrow)
-            self.parent().books.insert(dest_row - 1, book)
-            dest_row = dest_row - 1
+            drop_row = len(books) - 1
+        # The selected books are moved as a block, to follow the book they were dropped on
+        moved_books = [books[row] for row in selrows]
+        other_books = [book for row, book in enumerate(books) if row not in selrows]
+        insert_at = len([row for row in range(drop_row + 1) if row not in selrows])
+        self.model().reorder(other_books[:insert_at] + moved_books + other_books[insert_at:])
 
         event.setDropAction(Qt.CopyAction)
-        # Determine the new row selection
-        self.selectRow(drop_row)
+        event.accept()
         self.parent().renumber_series()
 
     def set_series_column_headers(self, text):
-        item = self.horizontalHeaderItem(3)
-        if item is not None:
-            item.setText('Original '+text)
-        item = self.horizontalHeaderItem(4)
-        if item is not None:
-            item.setText('New '+text)
+        self.model().set_series_header(text)
 
 
 class ManageSeriesDeviceDialog(SizePersistedDialog):
@@ -1582,8 +1703,7 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
         layout.addLayout(table_layout)
 
         self.series_table = SeriesTableWidget(self)
-        self.series_table.itemSelectionChanged.connect(self.item_selection_changed)
-        self.series_table.cellChanged[int,int].connect(self.cell_changed)
+        self.series_table.selectionModel().selectionChanged.connect(self.item_selection_changed)
 
         table_layout.addWidget(self.series_table)
         table_button_layout = QVBoxLayout()
@@ -1721,11 +1841,11 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
         # Go through the books and clean the Sony series from the title
         for book in self.books:
             if remove_series:
-                series_in_title = re.findall(r"\(.*\)", book._orig_title)
+                series_in_title = re.findall(r"\(.*\)", book.orig_title())
                 if len(series_in_title) > 0:
-                    book._mi.title = book._orig_title.replace(series_in_title[len(series_in_title) - 1], "")
+                    book.set_title(book.orig_title().replace(series_in_title[len(series_in_title) - 1], ""))
             else:
-                book._mi.title = book._orig_title
+                book.set_title(book.orig_title())
         # Now renumber the whole series so that anything in between gets changed
         self.renumber_series()
 
@@ -1736,6 +1856,9 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
     def renumber_series(self, display_in_table=True):
         if len(self.books) == 0:
             return
+        # Remember what is displayed for each book, so that only the rows that change are repainted
+        displayed = [(book.title(), book.series_name(), book.series_index(), book.assigned_index(), book.is_valid())
+                     for book in self.books]
         series_name = unicode(self.series_combo.currentText()).strip()
         series_index = float(unicode(self.series_start_number.value()))
         last_series_indent = 0
@@ -1771,8 +1894,9 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
             else:
                 book.set_is_valid(True)
         if display_in_table:
-            for row, book in enumerate(self.books):
-                self.series_table.populate_table_row(row, book)
+            changed_rows = [row for row, book in enumerate(self.books)
+                            if displayed[row] != (book.title(), book.series_name(), book.series_index(), book.assigned_index(), book.is_valid())]
+            self.series_table.model().refresh_rows(changed_rows)
 
     def assign_original_index(self):
         if len(self.books) == 0:
@@ -1829,13 +1953,12 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
         for row in rows:
             selrows.append(row.row())
         selrows.sort()
-        first_sel_row = self.series_table.currentRow()
+        first_sel_row = self.series_table.current_row()
         for row in reversed(selrows):
-            self.books.pop(row)
-            self.series_table.removeRow(row)
-        if first_sel_row < self.series_table.rowCount():
+            self.series_table.model().remove_row(row)
+        if first_sel_row < len(self.books):
             self.series_table.select_and_scroll_to_row(first_sel_row)
-        elif self.series_table.rowCount() > 0:
+        elif len(self.books) > 0:
             self.series_table.select_and_scroll_to_row(first_sel_row - 1)
         self.renumber_series()
 
@@ -1853,14 +1976,15 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
         for row in rows:
             selrows.append(row.row())
         selrows.sort()
+        books = list(self.books)
         for selrow in selrows:
-            self.series_table.swap_row_widgets(selrow - 1, selrow + 1)
-            self.books[selrow-1], self.books[selrow] = self.books[selrow], self.books[selrow-1]
+            books[selrow-1], books[selrow] = books[selrow], books[selrow-1]
+        self.series_table.model().reorder(books)
 
         scroll_to_row = first_sel_row - 1
         if scroll_to_row > 0:
             scroll_to_row = scroll_to_row - 1
-        self.series_table.scrollToItem(self.series_table.item(scroll_to_row, 0))
+        self.series_table.scrollTo(self.series_table.model().index(scroll_to_row, 0))
         self.renumber_series()
 
     def move_rows_down(self):
@@ -1869,7 +1993,7 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
         if len(rows) == 0:
             return
         last_sel_row = rows[-1].row()
-        if last_sel_row == self.series_table.rowCount() - 1:
+        if last_sel_row == len(self.books) - 1:
             return
         # Workaround for strange selection bug in Qt which "alters" the selection
         # in certain circumstances which meant move down only worked properly "once"
@@ -1877,14 +2001,15 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
         for row in rows:
             selrows.append(row.row())
         selrows.sort()
+        books = list(self.books)
         for selrow in reversed(selrows):
-            self.series_table.swap_row_widgets(selrow + 2, selrow)
-            self.books[selrow+1], self.books[selrow] = self.books[selrow], self.books[selrow+1]
+            books[selrow+1], books[selrow] = books[selrow], books[selrow+1]
+        self.series_table.model().reorder(books)
 
         scroll_to_row = last_sel_row + 1
-        if scroll_to_row < self.series_table.rowCount() - 1:
+        if scroll_to_row < len(self.books) - 1:
             scroll_to_row = scroll_to_row + 1
-        self.series_table.scrollToItem(self.series_table.item(scroll_to_row, 0))
+        self.series_table.scrollTo(self.series_table.model().index(scroll_to_row, 0))
         self.renumber_series()
 
     def series_indent_change(self, delta):
@@ -1902,11 +2027,12 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
 
     def sort_by(self, name):
         if name == 'PubDate':
-            self.books = sorted(self.books, key=lambda k: k.sort_key(sort_by_pubdate=True))
+            books = sorted(self.books, key=lambda k: k.sort_key(sort_by_pubdate=True))
         elif name == 'Original Series Name':
-            self.books = sorted(self.books, key=lambda k: k.sort_key(sort_by_name=True))
+            books = sorted(self.books, key=lambda k: k.sort_key(sort_by_name=True))
         else:
-            self.books = sorted(self.books, key=lambda k: k.sort_key())
+            books = sorted(self.books, key=lambda k: k.sort_key())
+        self.series_table.model().reorder(books)
         self.renumber_series()
 
     def search_web(self, name):
@@ -1956,16 +2082,8 @@ class ManageSeriesDeviceDialog(SizePersistedDialog):
                 fn_ln_author = ' '.join(parts).strip()
         return self.convert_to_search_text(fn_ln_author, encoding)
 
-    def cell_changed(self, row, column):
-        book = self.books[row]
-        if column == 0:
-            book.set_title(unicode(self.series_table.item(row, column).text()).strip())
-        elif column == 2:
-            qtdate = convert_qvariant(self.series_table.item(row, column).data(Qt.DisplayRole))
-            book.set_pubdate(qt_to_dt(qtdate, as_utc=False))
-
     def item_selection_changed(self):
-        row = self.series_table.currentRow()
+        row = self.series_table.current_row()
         if row == -1:
             return
         has_assigned_index = False
@@ -2118,14 +2236,9 @@ class ShowReadingPositionChangesDialog(SizePersistedDialog):
     def _ok_clicked(self):
         self.options = {}
 
-        for i in range(len(self.reading_locations)):
-            self.reading_locations_table.selectRow(i)
-            enabled = bool(self.reading_locations_table.item(i, 0).checkState())
-            debug_print("row=%d, enabled=%s", i, enabled)
-            if not enabled:
-                book_id = convert_qvariant(self.reading_locations_table.item(i, 7).data(Qt.DisplayRole))
-                debug_print("row=%d, book_id=%s", i, book_id)
-                del self.reading_locations[book_id]
+        for book_id in self.reading_locations_table.model().disabled_book_ids():
+            debug_print("not storing book_id=%s" % book_id)
+            del self.reading_locations[book_id]
         self.accept()
         return
 
@@ -2134,15 +2247,134 @@ class ShowReadingPositionChangesDialog(SizePersistedDialog):
             self.shelves = sorted(self.shelves, key=lambda k: k.sort_key(sort_by_pubdate=True))
 
 
-class ShowReadingPositionChangesTableWidget(QTableWidget):
+class ReadingPositionChangesModel(QAbstractTableModel):
+    '''
+    Presents the reading position changes, with the library values for all the books fetched in
+    one call for each column rather than reading the metadata of each book
+
+    Sorting reorders the rows in place, and the cells are only rendered when the view asks for them.
+    '''
+    ENABLED_COLUMN, TITLE_COLUMN, AUTHORS_COLUMN, CURRENT_PERCENT_COLUMN, NEW_PERCENT_COLUMN, \
+        CURRENT_DATE_COLUMN, NEW_DATE_COLUMN = range(7)
+    HEADER_LABELS = ['', 'Title', 'Authors(s)', 'Current %', 'New %', 'Current Date', 'New Date']
+
+    def __init__(self, parent, db, sony_percentRead_column, last_read_column):
+        QAbstractTableModel.__init__(self, parent)
+        self.db                      = db
+        self.sony_percentRead_column = sony_percentRead_column
+        self.last_read_column        = last_read_column
+        self.rows = []
+
+    def set_reading_positions(self, reading_positions):
+        self.beginResetModel()
+        book_ids = list(reading_positions.keys())
+        authors  = self.db.new_api.all_field_for('authors', book_ids)
+        author_sort = self.db.new_api.all_field_for('author_sort', book_ids)
+        current_percents = self.db.new_api.all_field_for(self.sony_percentRead_column, book_ids) if self.sony_percentRead_column else {}
+        current_dates    = self.db.new_api.all_field_for(self.last_read_column, book_ids) if self.last_read_column else {}
+
+        self.rows = []
+        for book_id in book_ids:
+            reading_position = reading_positions[book_id]
+            new_percent = 0
+            if reading_position[2] == 1:
+                new_percent = reading_position[3]
+            elif reading_position[2] == 2:
+                new_percent = 100
+            self.rows.append({
+                          'book_id':         book_id,
+                          'enabled':         True,
+                          'title':           reading_position[6],
+                          'authors':         ' & '.join(authors.get(book_id) or ()),
+                          'author_sort':     author_sort.get(book_id) or '',
+                          'current_percent': current_percents.get(book_id),
+                          'new_percent':     new_percent,
+                          'current_date':    current_dates.get(book_id),
+                          'new_date':        convert_sony_date(reading_position[5]),
+                          })
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADER_LABELS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or orientation != Qt.Horizontal:
+            return None
+        return self.HEADER_LABELS[section]
+
+    def flags(self, index):
+        flags = Qt.ItemIsSelectable | Qt.ItemIsEnabled
+        if index.column() == self.ENABLED_COLUMN:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.CheckStateRole and column == self.ENABLED_COLUMN:
+            return Qt.Checked if row['enabled'] else Qt.Unchecked
+        elif role == Qt.DisplayRole:
+            if column == self.TITLE_COLUMN:
+                return row['title']
+            elif column == self.AUTHORS_COLUMN:
+                return row['authors']
+            elif column == self.CURRENT_PERCENT_COLUMN:
+                return row['current_percent']
+            elif column == self.NEW_PERCENT_COLUMN:
+                return row['new_percent']
+            elif column == self.CURRENT_DATE_COLUMN:
+                return QDateTime(row['current_date']) if row['current_date'] else None
+            elif column == self.NEW_DATE_COLUMN:
+                return QDateTime(row['new_date']) if row['new_date'] else None
+        elif role == Qt.TextAlignmentRole:
+            if column in (self.CURRENT_PERCENT_COLUMN, self.NEW_PERCENT_COLUMN):
+                return Qt.AlignRight | Qt.AlignVCenter
+        elif role == Qt.ForegroundRole:
+            if column == self.AUTHORS_COLUMN:
+                return QBrush(Qt.darkGray)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.CheckStateRole or index.column() != self.ENABLED_COLUMN:
+            return False
+        self.rows[index.row()]['enabled'] = convert_qvariant(value) == Qt.Checked
+        self.dataChanged.emit(index, index)
+        return True
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        keys = {
+                self.ENABLED_COLUMN:         lambda row: row['enabled'],
+                self.TITLE_COLUMN:           lambda row: sort_key(row['title'] or ''),
+                self.AUTHORS_COLUMN:         lambda row: sort_key(row['author_sort']),
+                self.CURRENT_PERCENT_COLUMN: lambda row: (row['current_percent'] is None, row['current_percent']),
+                self.NEW_PERCENT_COLUMN:     lambda row: row['new_percent'],
+                self.CURRENT_DATE_COLUMN:    lambda row: (row['current_date'] is None, row['current_date']),
+                self.NEW_DATE_COLUMN:        lambda row: (row['new_date'] is None, row['new_date']),
+                }
+        self.layoutAboutToBeChanged.emit()
+        old_rows = dict((id(row), position) for position, row in enumerate(self.rows))
+        self.rows.sort(key=keys[column], reverse=order == Qt.DescendingOrder)
+        new_rows = dict((old_rows[id(row)], position) for position, row in enumerate(self.rows))
+        from_indexes = self.persistentIndexList()
+        to_indexes = [self.index(new_rows[index.row()], index.column()) for index in from_indexes]
+        self.changePersistentIndexList(from_indexes, to_indexes)
+        self.layoutChanged.emit()
+
+    def disabled_book_ids(self):
+        return [row['book_id'] for row in self.rows if not row['enabled']]
+
+
+class ShowReadingPositionChangesTableWidget(QTableView):
 
     def __init__(self, parent, db):
-        QTableWidget.__init__(self, parent)
+        QTableView.__init__(self, parent)
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.db = db
-#        self.fmt = tweaks['gui_pubdate_display_format']
-#        if self.fmt is None:
-#            self.fmt = 'MMM yyyy'
 
         library_db     = self.db #self.gui.current_db
         library_config = cfg.get_library_config(library_db)
@@ -2150,24 +2382,15 @@ class ShowReadingPositionChangesTableWidget(QTableWidget):
         self.sony_percentRead_column         = library_config.get(cfg.KEY_PERCENT_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_PERCENT_READ_CUSTOM_COLUMN])
         self.rating_column                   = library_config.get(cfg.KEY_RATING_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_RATING_CUSTOM_COLUMN])
         self.last_read_column                = library_config.get(cfg.KEY_LAST_READ_CUSTOM_COLUMN, cfg.DEFAULT_LIBRARY_VALUES[cfg.KEY_LAST_READ_CUSTOM_COLUMN])
+        self.setModel(ReadingPositionChangesModel(self, self.db, self.sony_percentRead_column, self.last_read_column))
 
     def populate_table(self, reading_positions):
-        self.clear()
         self.setAlternatingRowColors(True)
-        self.setRowCount(len(reading_positions))
-        header_labels = ['', 'Title', 'Authors(s)', 'Current %', 'New %', 'Current Date', 'New Date', "Book ID"]
-        self.setColumnCount(len(header_labels))
-        self.setHorizontalHeaderLabels(header_labels)
+        debug_print("number of reading_positions=", len(reading_positions))
+        self.model().set_reading_positions(reading_positions)
         self.verticalHeader().setDefaultSectionSize(24)
         self.horizontalHeader().setStretchLastSection(True)
 
-        debug_print("reading_positions=", reading_positions)
-        row = 0
-        for book_id, reading_position in reading_positions.iteritems():
-#            debug_print("reading_position=", reading_position)
-            self.populate_table_row(row, book_id, reading_position)
-            row += 1
-
         self.resizeColumnToContents(0)
         self.resizeColumnToContents(1)
         self.setMinimumColumnWidth(1, 150)
@@ -2176,7 +2399,6 @@ class ShowReadingPositionChangesTableWidget(QTableWidget):
         self.resizeColumnToContents(4)
         self.resizeColumnToContents(5)
         self.resizeColumnToContents(6)
-        self.hideColumn(7)
         self.setSortingEnabled(True)
 #        self.setMinimumSize(550, 0)
         self.selectRow(0)
@@ -2184,57 +2406,10 @@ class ShowReadingPositionChangesTableWidget(QTableWidget):
         self.setItemDelegateForColumn(5, delegate)
         self.setItemDelegateForColumn(6, delegate)
 
-
     def setMinimumColumnWidth(self, col, minimum):
         if self.columnWidth(col) < minimum:
             self.setColumnWidth(col, minimum)
 
-    def populate_table_row(self, row, book_id, reading_position):
-#        debug_print("shelf:", row, shelf[0], shelf[1], shelf[2], shelf[3])
-        self.blockSignals(True)
-
-        book = self.db.get_metadata(book_id, index_is_id=True, get_cover=False)
-#        debug_print("book_id:", book_id)
-#        debug_print("book:", book)
-#        debug_print("reading_position:", reading_position)
-
-        self.setItem(row, 0, CheckableTableWidgetItem(True))
-
-        titleColumn = QTableWidgetItem(reading_position[6])
-        titleColumn.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-        self.setItem(row, 1, titleColumn)
-
-        authorColumn = AuthorsTableWidgetItem(book.authors, book.author_sort)
-        self.setItem(row, 2, authorColumn)
-
-        current_percentRead = book.get_user_metadata(self.sony_percentRead_column, True)['#value#'] if self.sony_percentRead_column else None
-        current_percent = RatingTableWidgetItem(current_percentRead, is_read_only=True)
-        current_percent.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        self.setItem(row, 3, current_percent)
-        
-#        debug_print("reading_position[4]:", reading_position[4])
-        new_percentRead = 0 
-        if reading_position[2] == 1:
-            new_percentRead = reading_position[3]
-        elif reading_position[2] == 2:
-            new_percentRead = 100
-        new_percent = RatingTableWidgetItem(new_percentRead, is_read_only=True)
-        new_percent.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        self.setItem(row, 4, new_percent)
-        
-        current_last_read = book.get_user_metadata(self.last_read_column, True)['#value#'] if self.last_read_column else None
-        if current_last_read:
-            self.setItem(row, 5, DateTableWidgetItem(current_last_read,
-                                                     is_read_only=True,
-                                                     default_to_today=False))
-        self.setItem(row, 6, DateTableWidgetItem(convert_sony_date(reading_position[5]), 
-                                                 is_read_only=True,
-                                                 default_to_today=False))
-        book_idColumn = RatingTableWidgetItem(book_id)
-        self.setItem(row, 7, book_idColumn)
-#        titleColumn.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-        self.blockSignals(False)
-
 
 class FixDuplicateShelvesDialog(SizePersistedDialog):
 
@@ -2389,6 +2564,7 @@ class OrderSeriesShelvesDialog(SizePersistedDialog):
         self.shelves       = shelves
         self.block_events  = True
         self.help_anchor   = "OrderSeriesShelves"
+        self.shelves_fetched = False
 
         self.options = cfg.get_plugin_prefs(cfg.ORDERSERIESSHELVES_OPTIONS_STORE_NAME)
         self.initialize_controls()
@@ -2535,6 +2711,10 @@ class OrderSeriesShelvesDialog(SizePersistedDialog):
 
     def _order_shelves_type_radio_clicked(self, idx):
         self.order_shelves_type = ORDER_SHELVES_TYPE[idx]
+        # The shelf statistics are cached, so once they have been fetched, switching
+        # the shelf type can refresh the list without going back to the device
+        if self.shelves_fetched:
+            self.fetch_button_clicked()
 
     def _order_shelves_by_radio_clicked(self, idx):
         self.order_shelves_by = ORDER_SHELVES_BY[idx]
@@ -2547,6 +2727,7 @@ class OrderSeriesShelvesDialog(SizePersistedDialog):
 
     def fetch_button_clicked(self):
         self.shelves = self.plugin_action._get_series_shelf_count(self.order_shelves_type)
+        self.shelves_fetched = True
         self.shelves_table.populate_table(self.shelves)
         return
         
@@ -16,23 +16,29 @@ except ImportError:
 import os
 import re
 import shutil
+import sqlite3
 from datetime import datetime
 
 from contextlib import closing
 
 # import anything we need from this plugin before any other calibre imports
 # this ensures that we don't get a stale version from the plugin zipfile when running tests.
-from calibre_plugins.sonyutilities.action import (
-                    EPUB_FETCH_QUERY, 
-                    check_device_database)
-import calibre_plugins.sonyutilities.config as cfg
-from calibre_plugins.sonyutilities.common_utils import debug_print, convert_sony_date, SonyDB
+from calibre_plugins.sonyutilities.services import (
+                    CONTENTID_FROM_PATH_QUERY,
+                    check_device_database,
+                    fetch_reading_positions)
+import calibre_plugins.sonyutilities.prefs as cfg
+from calibre_plugins.sonyutilities.device_database import debug_print, AnnotationCache, annotation_hash
+from calibre_plugins.sonyutilities.device_database import instrumented, connect_device_database, record_bytes_copied
 from calibre_plugins.sonyutilities.book import EbookIterator
 
+from calibre.ptempfile import PersistentTemporaryDirectory
+from calibre.utils.filenames import atomic_rename
 from calibre.utils.ipc.server import Server
 from calibre.utils.ipc.job import ParallelJob
 from calibre.utils.logging import Log
 
+@instrumented()
 def do_device_database_backup(backup_options, notification=lambda x,y:x):
     """
     Sony keeps independent databases on both the internal memory and any external SD cards
@@ -132,6 +138,7 @@ def do_device_database_backup(backup_options, notification=lambda x,y:x):
                     ignore=lambda src,names: [x for x in names if not x.endswith('.db')])
     
     files_backedup  = glob.glob(backup_file_path+'/*.db')
+    record_bytes_copied(sum(os.path.getsize(backup_file) for backup_file in files_backedup))
     num_backups     = float(len(files_backedup))
     
     progress = 0.4
@@ -181,6 +188,151 @@ def do_device_database_backup(backup_options, notification=lambda x,y:x):
     return True
 
 
+@instrumented()
+def do_device_database_vacuum(vacuum_options, notification=lambda x,y:x):
+    """
+    Reclaim the free space in the Sony device databases, without rewriting them unless it's worthwhile
+
+    Every database first has its page_count and freelist_count read, which is all that happens 
+    when there are no free pages. A database created with auto_vacuum=INCREMENTAL has its free 
+    pages released with 'PRAGMA incremental_vacuum'. Otherwise the database is only rewritten 
+    when the free pages are at least the configured percentage of the file: it is vacuumed into a 
+    temporary file on the host, which is checked and then swapped in for the database on the device.
+    
+    Returns a list with a dictionary of statistics and the action taken for each database.
+
+    >>> import os, sqlite3
+    >>> from contextlib import closing
+    >>> from calibre_plugins.sonyutilities.jobs import do_device_database_vacuum
+    
+    Make a database and then delete most of its contents, leaving free pages behind
+    >>> database_file = os.tempnam() + '.db'
+    >>> with closing(sqlite3.connect(database_file)) as connection:
+    ...     _ = connection.execute('CREATE TABLE books (title TEXT)')
+    ...     _ = connection.executemany('INSERT INTO books VALUES (?)', [('x' * 1000,)] * 100)
+    ...     _ = connection.execute('DELETE FROM books WHERE rowid > 10')
+    ...     connection.commit()
+    >>> size_before = os.path.getsize(database_file)
+    
+    With a threshold above the free space nothing is done
+    >>> vacuum_options = {'databases': [database_file], 'threshold': 100}
+    >>> print(do_device_database_vacuum(vacuum_options)[0]['action'])
+    skipped
+    >>> print(os.path.getsize(database_file) == size_before)
+    True
+    
+    Lowering the threshold rewrites the database, which is smaller and keeps its contents
+    >>> vacuum_options['threshold'] = 10
+    >>> result = do_device_database_vacuum(vacuum_options)[0]
+    >>> print(result['action'])
+    vacuum
+    >>> print(os.path.getsize(database_file) < size_before)
+    True
+    >>> print(result['size_after'] == os.path.getsize(database_file))
+    True
+    >>> with closing(sqlite3.connect(database_file)) as connection:
+    ...     print(connection.execute('SELECT COUNT(*) FROM books').fetchone()[0])
+    10
+    
+    Run it again, there are no free pages left so there is nothing to do
+    >>> print(do_device_database_vacuum(vacuum_options)[0]['action'])
+    none
+    >>> os.remove(database_file)
+
+    """
+    debug_print("start")
+    notification(0.01, _("Checking the Sony device databases"))
+    debug_print('vacuum_options=', vacuum_options)
+    databases   = vacuum_options['databases']
+    threshold   = vacuum_options['threshold']
+
+    results = []
+    for i, database_file in enumerate(databases):
+        progress = (i + 0.1) / len(databases)
+        notification(progress, _("Checking free space in the database") + "=%s" % database_file)
+        statistics = _database_page_statistics(database_file)
+        statistics['database']  = database_file
+        statistics['size_before'] = os.path.getsize(database_file)
+        debug_print('statistics=', statistics)
+
+        if statistics['freelist_count'] == 0:
+            statistics['action'] = 'none'
+        elif statistics['auto_vacuum'] == 2:
+            notification(progress, _("Releasing free pages in the database") + "=%s" % database_file)
+            with closing(connect_device_database(database_file)) as connection:
+                # The pragma frees one page per result row, so all of them have to be read
+                connection.execute('PRAGMA incremental_vacuum').fetchall()
+                connection.commit()
+            statistics['action'] = 'incremental'
+        elif statistics['fragmentation'] < threshold:
+            statistics['action'] = 'skipped'
+        else:
+            notification(progress, _("Compressing the database") + "=%s" % database_file)
+            _vacuum_database_file(database_file)
+            statistics['action'] = 'vacuum'
+
+        statistics['size_after'] = os.path.getsize(database_file)
+        debug_print('database=%(database)s, action=%(action)s' % statistics)
+        results.append(statistics)
+
+    notification(1, _("Sony device database compression finished"))
+    return results
+
+
+def _database_page_statistics(database_file):
+    '''
+    Read the page counts from the database header, without scanning any tables
+    '''
+    with closing(connect_device_database(database_file)) as connection:
+        page_size       = connection.execute('PRAGMA page_size').fetchone()[0]
+        page_count      = connection.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count  = connection.execute('PRAGMA freelist_count').fetchone()[0]
+        auto_vacuum     = connection.execute('PRAGMA auto_vacuum').fetchone()[0]
+
+    return {
+            'page_size':        page_size,
+            'page_count':       page_count,
+            'freelist_count':   freelist_count,
+            'auto_vacuum':      auto_vacuum,
+            'fragmentation':    100.0 * freelist_count / page_count if page_count else 0,
+            'savings':          page_size * freelist_count
+            }
+
+
+def _vacuum_database_file(database_file):
+    '''
+    Rewrite the database compactly on the host, then swap it in for the original
+
+    SQLite versions without 'VACUUM INTO' (before 3.27) fall back to vacuuming the database
+    where it is.
+    '''
+    if sqlite3.sqlite_version_info < (3, 27, 0):
+        debug_print('VACUUM INTO is not supported by SQLite %s' % sqlite3.sqlite_version)
+        with closing(connect_device_database(database_file)) as connection:
+            connection.execute('VACUUM')
+        return
+
+    tdir = PersistentTemporaryDirectory('_sony_vacuum')
+    try:
+        vacuum_file = os.path.join(tdir, os.path.basename(database_file))
+        with closing(connect_device_database(database_file)) as connection:
+            connection.execute('VACUUM INTO ?', (vacuum_file,))
+
+        check_result = check_device_database(vacuum_file)
+        if not check_result.split()[0] == 'ok':
+            debug_print('compressed database is corrupt!')
+            raise Exception(check_result)
+
+        # Copy next to the original first, so that the swap is a rename on the same filesystem
+        swap_file = database_file + '.sonyutilities'
+        shutil.copyfile(vacuum_file, swap_file)
+        record_bytes_copied(os.path.getsize(swap_file))
+        atomic_rename(swap_file, database_file)
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+
+@instrumented()
 def do_store_locations(books_to_scan, options, notification=lambda x,y:x):
     '''
     Master job, to launch child jobs to modify each ePub
@@ -240,82 +392,150 @@ def do_store_bookmarks(books, options):
     '''
     Child job, to store location for all the books
     '''
-    
-    debug_print("start")
-    count_books      = 0
-    stored_locations = dict()
-    clear_if_unread          = options[cfg.KEY_CLEAR_IF_UNREAD]
-    store_if_more_recent     = options[cfg.KEY_STORE_IF_MORE_RECENT]
-    do_not_store_if_reopened = options[cfg.KEY_DO_NOT_STORE_IF_REOPENED]
-    device                   = options['action'].device
     import pydevd;pydevd.settrace() # debug
 
-    with closing(SonyDB(options['databases'])) as cursors:
-        count_books += 1
-    
-        debug_print("about to start book loop")
-        for book in books:
-            title   = book['title']
-            authors = book['authors']
-            contentIDs = book['contentIds']
-            debug_print("Current book: %s - %s" %(title, authors))
-            debug_print("contentIds='%s'" % (contentIDs))
-            book_status = None
-            for path_id,contentID in enumerate(contentIDs):
-    #                log("_store_bookmarks - contentId='%s'" % (contentID))
-                debug_print("contentId='%s'" % (contentID))
-                if book['paths'][path_id].startswith(device._main_prefix):
-                    cursor = cursors[device._main_prefix]
-                else:
-                    cursor = cursors[device._card_a_prefix]
-                cursor.execute(EPUB_FETCH_QUERY, (contentID,))
-                
-                # Take the status from the version that is farthest along
-                for row in cursor:
-                    if not book_status \
-                    or row[b'reading_time'] > book_status[b'reading_time'] \
-                    or row[b'percent'] > book_status[b'percent']:
-                        book_status = dict(row)
-                        if not row[b'percent']:
-                            book_status[b'percent'] = EbookIterator(book['paths'][path_id],
-                                                                    log=Log()).calculate_percent_read(row[b'mark'])
-            if not book_status:
-                continue
-    
-            debug_print("book_status=", book_status)
-            book_status['reading_time'] = convert_sony_date(book_status['reading_time'])
-    #             debug_print("last_read=", last_read)
-    
-            reading_position_changed = False
-            if book_status['mark'] is None and clear_if_unread:
-                reading_position_changed    = True
-                book_status['mark']         = None
-                book_status['percent']      = 0
-                book_status['reading_time'] = None
-            else:
-                reading_position_changed = book['bookmark'] != book_status['mark']
-                reading_position_changed |= book['percentRead'] != book_status['percent']
-                reading_position_changed |= book['last_read'] != book_status['reading_time']
-                debug_print("reading_position_changed=", reading_position_changed)
-                if store_if_more_recent:
-                    if book['last_read'] and book_status['reading_time']:
-                        debug_print("current_last_read < last_read=", book['last_read'] < book_status['reading_time'])
-                        reading_position_changed &= book['last_read'] < book_status['reading_time']
-                    elif book_status['reading_time']:
-                        reading_position_changed &= True
-                if do_not_store_if_reopened:
-                    debug_print("book.percentRead=", book['percentRead'])
-                    reading_position_changed &= book['percentRead'] < 100
-    
-            if reading_position_changed:
-                debug_print("position changed for: %s - %s" %(title, authors))
-                stored_locations[book['id']] = book_status
+    def percent_read(path, mark):
+        return EbookIterator(path, log=Log()).calculate_percent_read(mark)
 
-    debug_print("finished book loop")
-    
-    # clean up
-    for cursor in cursor.values():
-        cursor.connection.close()
-    
-    debug_print("finished")
-    return stored_locations
+    return fetch_reading_positions(options['databases'], books, options, percent_read)
+
+
+ANNOTATION_BATCH_SIZE       = 50     # books whose annotations are fetched from the device at once
+ANNOTATION_VIEWER_MAX_BOOKS = 200    # books whose annotations are kept to show in the viewer
+
+# The number of annotations and bookmarks for each book, and when the latest was modified
+ANNOTATION_MARKERS_QUERY = """
+    SELECT content_id, COUNT(*), MAX(modified_date)
+    FROM (SELECT content_id, modified_date FROM annotation
+          UNION ALL
+          SELECT content_id, modified_date FROM bookmark)
+    GROUP BY content_id
+    """
+
+def _annotation_markers(database_path):
+    """
+    Return a marker for the annotations of each book in the database, by content ID
+
+    Returns None if the database doesn't have the annotation tables, in which case the
+    annotations can't be cached.
+    """
+    try:
+        with closing(connect_device_database(database_path)) as connection:
+            return dict((row[0], "%d:%s" % (row[1], row[2])) for row in connection.execute(ANNOTATION_MARKERS_QUERY))
+    except sqlite3.OperationalError as e:
+        debug_print("cannot read annotation markers: ", e)
+        return None
+
+def _annotation_content_ids(locations, path_map):
+    """
+    Find the device location and content ID of each book, so that its annotations can be cached
+    """
+    content_ids = {}
+    for prefix, (database_path, device_uuid) in locations.iteritems():
+        ids = [id_ for id_ in path_map if path_map[id_]['path'].startswith(prefix)]
+        if not ids:
+            continue
+        markers = _annotation_markers(database_path)
+        if markers is None:
+            continue
+        with closing(connect_device_database(database_path)) as connection:
+            for id_ in ids:
+                row = connection.execute(CONTENTID_FROM_PATH_QUERY, (path_map[id_]['path'][len(prefix):],)).fetchone()
+                if row is not None:
+                    content_ids[id_] = (device_uuid, row[0], markers.get(row[0]))
+    return content_ids
+
+@instrumented()
+def do_fetch_annotations(device, path_map, book_details, locations, export_file=None, sync_hashes=None,
+                         show_annotations=None, notification=lambda x,y:x):
+    '''
+    Fetch the annotations for the books in path_map from the device, a batch at a time
+
+    The annotations are cached on the host, keyed by the device UUID and content ID. They are 
+    only fetched from the device for books whose annotations have changed since they were 
+    cached, and not at all for books the device database shows have no annotations.
+    locations maps each device prefix to its database path and UUID.
+
+    The HTML for each book is written to the export file as soon as it is generated, as HTML
+    or, if the file name ends with ".json", as a JSON list. After each batch, the HTML for the
+    batch's books is passed to show_annotations, so the viewer fills in while the rest are
+    fetched. Only the first books are sent to the viewer, so it doesn't grow with the number of books.
+
+    book_details maps each book id to its title and authors, read from the library beforehand 
+    as the library database can't be used from the device thread.
+
+    When syncing to a custom column, sync_hashes maps each book id to the annotation_hash of the
+    column's current value. Only the books whose annotations hash differently are returned, 
+    so that the library is only updated for those.
+    '''
+    import io, json
+    from calibre import prepare_string_for_xml
+    debug_print("start - books=%d, export_file=%s" % (len(path_map), export_file))
+
+    content_ids     = _annotation_content_ids(locations, path_map)
+    export_json     = export_file is not None and export_file.lower().endswith('.json')
+    annotated_books = 0
+    fetched_books   = 0
+    changed_annotations = {}
+    stream = io.open(export_file, 'w', encoding='utf-8') if export_file else None
+    try:
+        with closing(AnnotationCache(cfg.ANNOTATION_CACHE_FILE)) as cache:
+            if stream is not None:
+                stream.write('[\n' if export_json else '<html><body>\n')
+            ids = list(path_map.keys())
+            for start in range(0, len(ids), ANNOTATION_BATCH_SIZE):
+                notification(start / len(ids), _("Fetching annotations"))
+                batch_ids = ids[start:start + ANNOTATION_BATCH_SIZE]
+                annotations = {}
+                to_fetch = {}
+                for id_ in batch_ids:
+                    if id_ not in content_ids:
+                        to_fetch[id_] = path_map[id_]
+                        continue
+                    device_uuid, content_id, marker = content_ids[id_]
+                    if marker is None:
+                        continue    # No annotations on the device
+                    annotations[id_] = cache.get(device_uuid, content_id, marker)
+                    if annotations[id_] is None:
+                        to_fetch[id_] = path_map[id_]
+
+                if to_fetch:
+                    fetched_books += len(to_fetch)
+                    bookmarked_books = device.get_annotations(to_fetch)
+                    for id_, (path, bookmark) in bookmarked_books.iteritems():
+                        bm = device.UserAnnotation(path, bookmark)
+                        annotations[id_] = unicode(device.generate_annotation_html(bm.value))
+                        if id_ in content_ids:
+                            cache.put(*(content_ids[id_] + (annotations[id_],)))
+
+                viewer_html = []
+                for id_ in batch_ids:
+                    if sync_hashes is not None and annotation_hash(annotations.get(id_)) != sync_hashes.get(id_):
+                        changed_annotations[id_] = annotations.get(id_)
+                    if annotations.get(id_) is None:
+                        continue
+                    title, authors = book_details[id_]
+                    book_html = "<hr /><span style=\"font-weight:normal\"><b>%s</b> by <b>%s</b></span>%s" % (
+                                    prepare_string_for_xml(title), 
+                                    prepare_string_for_xml(authors),
+                                    annotations[id_])
+                    if stream is not None:
+                        if export_json:
+                            stream.write((',\n' if annotated_books else '') + 
+                                         unicode(json.dumps({'id': id_, 'title': title, 'authors': authors, 'annotations': book_html})))
+                        else:
+                            stream.write(book_html + '\n')
+                    if annotated_books < ANNOTATION_VIEWER_MAX_BOOKS:
+                        viewer_html.append(book_html)
+                    annotated_books += 1
+                if show_annotations is not None and viewer_html:
+                    show_annotations(viewer_html)
+            if stream is not None:
+                stream.write('\n]\n' if export_json else '</body></html>\n')
+    finally:
+        if stream is not None:
+            stream.close()
+
+    notification(1, _("Fetching annotations finished"))
+    debug_print("finished - annotated_books=%d, fetched from device=%d, changed=%d" % (annotated_books, fetched_books, len(changed_annotations)))
+    return annotated_books, export_file, changed_annotations
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Derek Broughton <auspex@pointerstop.ca>'
+__docformat__ = 'restructuredtext en'
+'''
+The plugin's option keys, their defaults, and reading and writing the saved preferences
+
+This has no Qt imports, so it can be used from the services, the jobs and the command line
+runner. The configuration widget is in config, which imports everything here as well.
+'''
+
+import copy
+import os
+
+from calibre.utils.config import JSONConfig, config_dir
+
+
+PREFS_NAMESPACE = 'sonyutilitiesPlugin'
+PREFS_KEY_SETTINGS = 'settings'
+
+KEY_SCHEMA_VERSION = 'SchemaVersion'
+DEFAULT_SCHEMA_VERSION = 0.1
+
+STORE_LIBRARIES = 'libraries'
+KEY_CURRENT_LOCATION_CUSTOM_COLUMN = 'currentReadingLocationColumn'
+KEY_PERCENT_READ_CUSTOM_COLUMN     = 'precentReadColumn'
+KEY_RATING_CUSTOM_COLUMN           = 'ratingColumn'
+KEY_LAST_READ_CUSTOM_COLUMN        = 'lastReadColumn'
+KEY_ANNOTATIONS_CUSTOM_COLUMN      = 'annotationsColumn'
+KEY_STORE_ON_CONNECT               = 'storeOnConnect'
+KEY_PROMPT_TO_STORE                = 'promptToStore'
+KEY_STORE_IF_MORE_RECENT           = 'storeIfMoreRecent'
+KEY_DO_NOT_STORE_IF_REOPENED       = 'doNotStoreIfReopened'
+KEY_SNAPSHOT_DATABASE              = 'snapshotDeviceDatabase'
+KEY_DO_UPDATE_CHECK                = 'doFirmwareUpdateCheck'
+KEY_LAST_FIRMWARE_CHECK_TIME       = 'firmwareUpdateCheckLastTime'
+KEY_DO_EARLY_FIRMWARE_CHECK        = 'doEarlyFirmwareUpdate'
+DEFAULT_LIBRARY_VALUES = {
+                          KEY_CURRENT_LOCATION_CUSTOM_COLUMN: '',
+                          KEY_PERCENT_READ_CUSTOM_COLUMN:     '',
+                          KEY_RATING_CUSTOM_COLUMN:           None,
+                          KEY_LAST_READ_CUSTOM_COLUMN:        None,
+                          KEY_ANNOTATIONS_CUSTOM_COLUMN:      '',
+                         }
+
+BOOKMARK_OPTIONS_STORE_NAME             = 'BookmarkOptions'
+METADATA_OPTIONS_STORE_NAME             = 'MetadataOptions'
+READING_OPTIONS_STORE_NAME              = 'ReadingOptions'
+COMMON_OPTIONS_STORE_NAME               = 'commonOptionsStore'
+DISMISSTILES_OPTIONS_STORE_NAME         = 'dismissTilesOptionsStore'
+FIXDUPLICATESHELVES_OPTIONS_STORE_NAME  = 'fixDuplicatesOptionsStore'
+ORDERSERIESSHELVES_OPTIONS_STORE_NAME   = 'orderSeriesShelvesOptionsStore'
+UPDATE_OPTIONS_STORE_NAME               = 'updateOptionsStore'
+BACKUP_OPTIONS_STORE_NAME               = 'backupOptionsStore'
+
+KEY_STORE_BOOKMARK          = 'storeBookmarks'
+KEY_DATE_TO_NOW             = 'setDateToNow'
+KEY_CLEAR_IF_UNREAD         = 'clearIfUnread'
+KEY_BACKGROUND_JOB          = 'backgroundJob'
+KEY_SET_TITLE               = 'title'
+KEY_USE_TITLE_SORT          = 'titleSort'
+KEY_SET_AUTHOR              = 'author'
+KEY_USE_AUTHOR_SORT         = 'authourSort'
+KEY_SET_DESCRIPTION         = 'description'
+KEY_SET_PUBLISHER           = 'publisher'
+KEY_SET_SERIES              = 'series'
+KEY_SET_TAGS_IN_SUBTITLE    = 'tagsInSubtitle'
+KEY_USE_PLUGBOARD           = 'usePlugboard'
+KEY_SET_READING_STATUS      = 'setRreadingStatus'
+KEY_READING_STATUS          = 'readingStatus'
+KEY_SET_PUBLISHED_DATE      = 'published_date'
+KEY_SET_ISBN                = 'isbn'
+KEY_SET_NOT_INTERESTED      = 'mark_not_interested'
+KEY_SET_LANGUAGE            = 'language'
+KEY_RESET_POSITION          = 'resetPosition'
+KEY_TILE_OPTIONS            = 'tileOptions'
+KEY_CHANGE_DISMISS_TRIGGER  = 'changeDismissTrigger'
+KEY_CREATE_DISMISS_TRIGGER  = 'createDismissTrigger'
+KEY_DELETE_DISMISS_TRIGGER  = 'deleteDismissTrigger'
+KEY_CREATE_ANALYTICSEVENTS_TRIGGER  = 'createAnalyticsEventsTrigger'
+KEY_DELETE_ANALYTICSEVENTS_TRIGGER  = 'deleteAnalyticsEventsTrigger'
+KEY_TILE_RECENT_NEW             = 'tileRecentBooksNew'
+KEY_TILE_RECENT_FINISHED        = 'tileRecentBooksFinished'
+KEY_TILE_RECENT_IN_THE_CLOUD    = 'tileRecentBooksInTheCLoud'
+
+KEY_READING_FONT_FAMILY     = 'readingFontFamily'
+KEY_READING_ALIGNMENT       = 'readingAlignment'
+KEY_READING_FONT_SIZE       = 'readingFontSize'
+KEY_READING_LINE_HEIGHT     = 'readingLineHeight'
+KEY_READING_LEFT_MARGIN     = 'readingLeftMargin'
+KEY_READING_RIGHT_MARGIN    = 'readingRightMargin'
+KEY_READING_LOCK_MARGINS    = 'lockMargins'
+KEY_UPDATE_CONFIG_FILE      = 'updateConfigFile'
+
+KEY_BUTTON_ACTION_DEVICE    = 'buttonActionDevice'
+KEY_BUTTON_ACTION_LIBRARY   = 'buttonActionLibrary'
+
+KEY_KEEP_NEWEST_SHELF       = 'keepNewestShelf'
+KEY_PURGE_SHELVES           = 'purgeShelves'
+
+KEY_SORT_DESCENDING         = 'sortDescending'
+KEY_SORT_UPDATE_CONFIG      = 'updateConfig'
+
+KEY_ORDER_SHELVES_SERIES    = 0
+KEY_ORDER_SHELVES_AUTHORS   = 1
+KEY_ORDER_SHELVES_OTHER     = 2
+KEY_ORDER_SHELVES_ALL       = 3
+KEY_ORDER_SHELVES_TYPE      = 'orderShelvesType'
+
+KEY_ORDER_SHELVES_BY_SERIES = 0
+KEY_ORDER_SHELVES_PUBLISHED = 1
+KEY_ORDER_SHELVES_BY        = 'orderShelvesBy'
+
+KEY_DO_DAILY_BACKUP         = 'doDailyBackp'
+KEY_BACKUP_COPIES_TO_KEEP   = 'backupCopiesToKeepSpin'
+KEY_BACKUP_DEST_DIRECTORY   = 'backupDestDirectory'
+KEY_VACUUM_THRESHOLD        = 'vacuumFragmentationThreshold'
+
+BOOKMARK_OPTIONS_DEFAULTS = {
+                KEY_STORE_BOOKMARK:             True,
+                KEY_READING_STATUS:             True,
+                KEY_DATE_TO_NOW:                True, 
+                KEY_CLEAR_IF_UNREAD:            False, 
+                KEY_BACKGROUND_JOB:             False, 
+                KEY_STORE_IF_MORE_RECENT:       False,
+                KEY_DO_NOT_STORE_IF_REOPENED:   False
+                }
+METADATA_OPTIONS_DEFAULTS = {
+                KEY_SET_TITLE:          False,
+                KEY_SET_AUTHOR:         False,
+                KEY_SET_DESCRIPTION:    False,
+                KEY_SET_PUBLISHER:      False,
+                KEY_SET_SERIES:         False,
+                KEY_SET_READING_STATUS: False,
+                KEY_READING_STATUS:     -1,
+                KEY_SET_PUBLISHED_DATE: False,
+                KEY_SET_ISBN:           False,
+                KEY_SET_NOT_INTERESTED: False,
+                KEY_SET_LANGUAGE:       False,
+                KEY_RESET_POSITION:     False,
+                KEY_USE_PLUGBOARD:      False,
+                KEY_USE_TITLE_SORT:     False,
+                KEY_USE_AUTHOR_SORT:    False,
+                KEY_SET_TAGS_IN_SUBTITLE: False
+                }
+READING_OPTIONS_DEFAULTS = {
+                KEY_READING_FONT_FAMILY:  'Georgia',
+                KEY_READING_ALIGNMENT:    'Off',
+                KEY_READING_FONT_SIZE:    22,
+                KEY_READING_LINE_HEIGHT:  1.3,
+                KEY_READING_LEFT_MARGIN:  3,
+                KEY_READING_RIGHT_MARGIN: 3,
+                KEY_READING_LOCK_MARGINS: False,
+                KEY_UPDATE_CONFIG_FILE:   False,
+                }
+COMMON_OPTIONS_DEFAULTS = {
+                KEY_STORE_ON_CONNECT:           False,
+                KEY_PROMPT_TO_STORE:            True,
+                KEY_STORE_IF_MORE_RECENT:       False,
+                KEY_DO_NOT_STORE_IF_REOPENED:   False,
+                KEY_BUTTON_ACTION_DEVICE:       '',
+                KEY_BUTTON_ACTION_LIBRARY:      '',
+                KEY_SNAPSHOT_DATABASE:          False,
+                }
+DISMISSTILES_OPTIONS_DEFAULTS = {
+                KEY_TILE_OPTIONS:               {},
+                KEY_TILE_RECENT_NEW:            False,
+                KEY_TILE_RECENT_FINISHED:       False,
+                KEY_TILE_RECENT_IN_THE_CLOUD:   False
+                }
+
+FIXDUPLICATESHELVES_OPTIONS_DEFAULTS = {
+                KEY_KEEP_NEWEST_SHELF:  True,
+                KEY_PURGE_SHELVES:      False
+                }
+
+ORDERSERIESSHELVES_OPTIONS_DEFAULTS = {
+                KEY_SORT_DESCENDING:    False,
+                KEY_SORT_UPDATE_CONFIG: True,
+                KEY_ORDER_SHELVES_TYPE: KEY_ORDER_SHELVES_SERIES,
+                KEY_ORDER_SHELVES_BY:   KEY_ORDER_SHELVES_BY_SERIES
+                }
+
+UPDATE_OPTIONS_DEFAULTS = {
+                KEY_DO_UPDATE_CHECK: False,
+                KEY_LAST_FIRMWARE_CHECK_TIME: 0,
+                KEY_DO_EARLY_FIRMWARE_CHECK: False
+                }
+
+BACKUP_OPTIONS_DEFAULTS = {
+                KEY_DO_DAILY_BACKUP:        False,
+                KEY_BACKUP_COPIES_TO_KEEP:  5,
+                KEY_BACKUP_DEST_DIRECTORY:  '',
+                KEY_VACUUM_THRESHOLD:       20
+                }
+
+# This is where all preferences for this plugin will be stored
+plugin_prefs = JSONConfig('plugins/Sony Utilities')
+
+# Annotations fetched from the device are cached here, see AnnotationCache
+ANNOTATION_CACHE_FILE = os.path.join(config_dir, 'plugins', 'Sony Utilities annotations.db')
+
+# Set defaults
+plugin_prefs.defaults[BOOKMARK_OPTIONS_STORE_NAME]      = BOOKMARK_OPTIONS_DEFAULTS
+plugin_prefs.defaults[METADATA_OPTIONS_STORE_NAME]      = METADATA_OPTIONS_DEFAULTS
+plugin_prefs.defaults[READING_OPTIONS_STORE_NAME]       = READING_OPTIONS_DEFAULTS
+plugin_prefs.defaults[COMMON_OPTIONS_STORE_NAME]        = COMMON_OPTIONS_DEFAULTS
+plugin_prefs.defaults[DISMISSTILES_OPTIONS_STORE_NAME]  = DISMISSTILES_OPTIONS_DEFAULTS
+plugin_prefs.defaults[FIXDUPLICATESHELVES_OPTIONS_STORE_NAME]  = FIXDUPLICATESHELVES_OPTIONS_DEFAULTS
+plugin_prefs.defaults[ORDERSERIESSHELVES_OPTIONS_STORE_NAME]   = ORDERSERIESSHELVES_OPTIONS_DEFAULTS
+plugin_prefs.defaults[STORE_LIBRARIES]                  = {}
+plugin_prefs.defaults[UPDATE_OPTIONS_STORE_NAME]        = UPDATE_OPTIONS_DEFAULTS
+plugin_prefs.defaults[BACKUP_OPTIONS_STORE_NAME]        = BACKUP_OPTIONS_DEFAULTS
+
+
+def get_library_uuid(db):
+    try:
+        library_uuid = db.library_id
+    except:
+        library_uuid = ''
+    return library_uuid
+
+
+def get_plugin_pref(store_name, option):
+    c = plugin_prefs[store_name]
+    default_value = plugin_prefs.defaults[store_name][option]
+    return c.get(option, default_value)
+
+def get_plugin_prefs(store_name):
+    c = plugin_prefs[store_name]
+    return c
+
+def migrate_library_config_if_required(db, library_config):
+    schema_version = library_config.get(KEY_SCHEMA_VERSION, 0)
+    if schema_version == DEFAULT_SCHEMA_VERSION:
+        return
+    # We have changes to be made - mark schema as updated
+    library_config[KEY_SCHEMA_VERSION] = DEFAULT_SCHEMA_VERSION
+
+    # Any migration code in future will exist in here.
+    if schema_version < 0.1:
+        pass
+
+    set_library_config(db, library_config)
+
+
+def get_library_config(db):
+    library_id = get_library_uuid(db)
+    library_config = None
+    # Check whether this is a configuration needing to be migrated from json into database
+    if 'libraries' in plugin_prefs:
+        libraries = plugin_prefs['libraries']
+        if library_id in libraries:
+            # We will migrate this below
+            library_config = libraries[library_id]
+            # Cleanup from json file so we don't ever do this again
+            del libraries[library_id]
+            if len(libraries) == 0:
+                # We have migrated the last library for this user
+                del plugin_prefs['libraries']
+            else:
+                plugin_prefs['libraries'] = libraries
+
+    if library_config is None:
+        library_config = db.prefs.get_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS,
+                                                 copy.deepcopy(DEFAULT_LIBRARY_VALUES))
+#    migrate_library_config_if_required(db, library_config)
+    return library_config
+
+
+def set_library_config(db, library_config):
+    db.prefs.set_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS, library_config)
@@ -0,0 +1,675 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+from __future__ import (division, absolute_import, print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Derek Broughton <auspex@pointerstop.ca>'
+__docformat__ = 'restructuredtext en'
+'''
+The operations on the Sony device databases, without the calibre GUI
+
+Everything here is given the database paths, the device prefixes and the options as plain
+values, and returns plain values, so it can be called from the plugin action, from jobs in
+worker processes, or from scripts with no reader connected. Reading from and writing to the
+calibre library is left to the callers.
+'''
+
+try:    # need to import init_calibre for doctests
+    import init_calibre
+except ImportError:
+    pass
+
+import time
+import sqlite3
+from contextlib import closing
+
+# import anything we need from this plugin before any other calibre imports
+# this ensures that we don't get a stale version from the plugin zipfile when running tests.
+import calibre_plugins.sonyutilities.prefs as cfg
+from calibre_plugins.sonyutilities.device_database import (debug_print, convert_sony_date, SonyDB, HelperIndexes,
+                                                           instrumented, connect_device_database, get_logger, ChangeJournal)
+
+store_log   = get_logger('store')
+shelves_log = get_logger('shelves')
+
+MIMETYPE_SONY = 'application/epub+zip'
+
+BOOKMARK_SEPARATOR = '|@ @|'       # Spaces are included to allow wrapping in the details panel
+
+DEFAULT_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+EPUB_FETCH_QUERY = """
+    SELECT cp.mark,
+           np.percent,
+           books.reading_time,
+           np.client_create_date
+    FROM books
+    LEFT OUTER JOIN current_position cp ON cp.content_id=books._id
+    LEFT OUTER JOIN network_position np ON np.content_id=books._id
+    where books._id = ?
+    """
+# Classify every shelf in a single scan: the DISTINCT Series and Attribution sets are
+# built once and joined, rather than running correlated EXISTS subqueries for each shelf
+SHELF_STATISTICS_QUERY = """
+    SELECT s.Name,
+           COUNT(*),
+           MAX(se.Series IS NOT NULL),
+           MAX(au.Attribution IS NOT NULL)
+    FROM Shelf s
+    JOIN ShelfContent sc ON s.Name = sc.ShelfName
+    LEFT OUTER JOIN (SELECT DISTINCT Series FROM content WHERE Series IS NOT NULL) se
+        ON se.Series = s.Name
+    LEFT OUTER JOIN (SELECT DISTINCT Attribution FROM content WHERE Attribution IS NOT NULL) au
+        ON au.Attribution = s.Name
+    WHERE s._IsDeleted = 'false'
+    AND sc._IsDeleted = 'false'
+    GROUP BY s.Name
+    """
+
+CONTENTID_FROM_PATH_QUERY = """
+    SELECT _id FROM books WHERE file_path = ?
+    """
+SHELF_CONTENT_UPDATE_QUERY = """
+    UPDATE ShelfContent
+    SET DateModified = ?
+    WHERE ShelfName = ?
+    AND ContentID = ?
+    """
+# Indexes the plugin creates for the duration of a bulk operation, as (name, table, columns).
+# They are only created where the device database doesn't already have a usable index.
+HELPER_INDEXES = [
+    ('sonyutilities_content_contentid',     'content',      ('ContentID',)),
+    ('sonyutilities_content_bookid',        'content',      ('BookID',)),
+    ('sonyutilities_shelfcontent_shelfname','ShelfContent', ('ShelfName', 'ContentId')),
+    ('sonyutilities_books_file_path',       'books',        ('file_path',)),
+    ('sonyutilities_shelf_name',            'Shelf',        ('Name', '_IsDeleted')),
+    ]
+HELPER_INDEXES_MIN_BOOKS = 50
+
+
+def metadata_query(supports_series, supports_ratings):
+    """
+    The query the metadata update reads a book's current details from the content table with
+    """
+    debug_print("supports_series=", supports_series)
+    test_query = 'SELECT Title,   '\
+                '    Attribution, '\
+                '    Description, '\
+                '    Publisher,   '
+    if supports_series:
+        debug_print("supports series is true")
+        test_query += ' Series,       '\
+                      ' SeriesNumber, '\
+                      ' Subtitle, '
+    else:
+        test_query += ' null as Series, '      \
+                      ' null as SeriesNumber,'
+    test_query += ' ReadStatus, '        \
+                  ' DateCreated, '       \
+                  ' Language, '
+    test_query += ' NULL as ISBN, '              \
+                      ' NULL as FeedbackType, '      \
+                      ' NULL as FeedbackTypeSynced, '\
+                      ' NULL as Rating, '            \
+                      ' NULL as DateModified '
+
+    test_query += 'FROM content c1 '
+    if supports_ratings:
+        test_query += ' left outer join ratings r on c1.ContentID = r.ContentID '
+
+    test_query += 'WHERE c1.BookId IS NULL '  \
+                  'AND c1.ContentId = ?'
+    debug_print("test_query=%s" % test_query)
+    return test_query
+
+
+def _connect(database_path, row_factory=None):
+    connection = connect_device_database(database_path)
+    # return bytestrings if the content cannot the decoded as unicode
+    connection.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+    if row_factory is not None:
+        connection.row_factory = row_factory
+    return connection
+
+def prefix_for_path(prefixes, path):
+    """
+    The device prefix (the main memory or a card) that a book path is on, or None
+    """
+    matches = [prefix for prefix in prefixes if prefix and path.startswith(prefix)]
+    return max(matches, key=len) if matches else None
+
+
+@instrumented()
+def fetch_reading_positions(databases, books, options, percent_read=None):
+    """
+    Read the reading position of each book from the device, and return those that should be
+    stored in the library, as a dict of {calibre id: status}
+
+    databases maps each device prefix to its database path. Each book is a dict with the id,
+    title, authors, contentIds, paths and the bookmark, percentRead and last_read from the library.
+    percent_read(path, mark) is called for the percentage read when the device hasn't recorded it.
+    """
+    store_log.debug("start")
+    stored_locations = dict()
+    clear_if_unread          = options[cfg.KEY_CLEAR_IF_UNREAD]
+    store_if_more_recent     = options[cfg.KEY_STORE_IF_MORE_RECENT]
+    do_not_store_if_reopened = options[cfg.KEY_DO_NOT_STORE_IF_REOPENED]
+
+    with closing(SonyDB(databases)) as cursors:
+        for book in books:
+            title   = book['title']
+            authors = book['authors']
+            contentIDs = book['contentIds']
+            store_log.debug("Current book: %s - %s, contentIds='%s'", title, authors, contentIDs)
+            book_status = None
+            for path_id, contentID in enumerate(contentIDs):
+                store_log.debug("contentId='%s'", contentID)
+                prefix = prefix_for_path(cursors.keys(), book['paths'][path_id])
+                if prefix is None:
+                    continue
+                cursor = cursors[prefix].cursor
+                cursor.execute(EPUB_FETCH_QUERY, (contentID,))
+
+                # Take the status from the version that is farthest along
+                for row in cursor:
+                    if not book_status \
+                    or row[b'reading_time'] > book_status[b'reading_time'] \
+                    or row[b'percent'] > book_status[b'percent']:
+                        book_status = dict(row)
+                        if not row[b'percent'] and percent_read is not None:
+                            book_status[b'percent'] = percent_read(book['paths'][path_id], row[b'mark'])
+            if not book_status:
+                continue
+
+            store_log.debug("book_status=%s", book_status)
+            book_status['reading_time'] = convert_sony_date(book_status['reading_time'])
+
+            reading_position_changed = False
+            if book_status['mark'] is None and clear_if_unread:
+                reading_position_changed    = True
+                book_status['mark']         = None
+                book_status['percent']      = 0
+                book_status['reading_time'] = None
+            else:
+                reading_position_changed = book['bookmark'] != book_status['mark']
+                reading_position_changed |= book['percentRead'] != book_status['percent']
+                reading_position_changed |= book['last_read'] != book_status['reading_time']
+                store_log.debug("reading_position_changed=%s", reading_position_changed)
+                if store_if_more_recent:
+                    if book['last_read'] and book_status['reading_time']:
+                        store_log.debug("current_last_read < last_read=%s", book['last_read'] < book_status['reading_time'])
+                        reading_position_changed &= book['last_read'] < book_status['reading_time']
+                    elif book_status['reading_time']:
+                        reading_position_changed &= True
+                if do_not_store_if_reopened:
+                    store_log.debug("book.percentRead=%s", book['percentRead'])
+                    reading_position_changed &= book['percentRead'] < 100
+
+            if reading_position_changed:
+                store_log.debug("position changed for: %s - %s", title, authors)
+                stored_locations[book['id']] = book_status
+
+    store_log.debug("finished")
+    return stored_locations
+
+
+@instrumented()
+def restore_reading_positions(database_path, books, options, timestamp_format=DEFAULT_TIMESTAMP_FORMAT, journal=None):
+    """
+    Write the reading positions from the library to the device
+
+    Each book is a dict with the title and contentIds, and the bookmark, percentRead and
+    last_read from the library for those of the columns that are configured.
+    The updates are made in one transaction through journal, or an unsaved ChangeJournal.
+    Returns the number of books updated, the number not on the device, and the total.
+    """
+    journal = journal or ChangeJournal('restore_reading_positions')
+    updated_books       = 0
+    not_on_device_books = 0
+    count_books         = 0
+
+    chapter_query = 'SELECT c1.bookmark, ' \
+                           'c1.ReadStatus, '          \
+                           'c1.___PercentRead, '      \
+                           'c1.Attribution, '         \
+                           'c1.DateLastRead, '        \
+                           'c1.Title, '               \
+                           'c1.MimeType '
+    chapter_query += 'FROM content c1 '
+    chapter_query += 'WHERE c1.BookId IS NULL '  \
+                  'AND c1.ContentId = ?'
+
+    with closing(_connect(database_path, sqlite3.Row)) as connection:
+        cursor = connection.cursor()
+
+        for book in books:
+            count_books += 1
+            for contentID in book['contentIds']:
+                cursor.execute(chapter_query, (contentID,))
+                result = cursor.fetchone()
+
+                if result is None:
+                    debug_print("no match for title='%s' contentId='%s'" % (book['title'], contentID))
+                    not_on_device_books += 1
+                    continue
+
+                chapter_update     = 'UPDATE content SET '
+                chapter_set_clause = ''
+                chapter_values     = []
+                sony_bookmark      = None
+                sony_percentRead   = None
+
+                if 'bookmark' in book:
+                    reading_location_string = book['bookmark']
+                    if reading_location_string:
+                        if result['MimeType'] == MIMETYPE_SONY:
+                            sony_bookmark = reading_location_string
+                        else:
+                            reading_location_parts = reading_location_string.split(BOOKMARK_SEPARATOR)
+                            sony_bookmark = (contentID + "#" + reading_location_parts[0]) if len(reading_location_parts) > 0 else None
+                        chapter_values.append(sony_bookmark)
+                        chapter_set_clause += ', bookmark  = ? '
+
+                if 'percentRead' in book:
+                    sony_percentRead = book['percentRead'] if book['percentRead'] else result['___PercentRead']
+                    chapter_values.append(sony_percentRead)
+                    chapter_set_clause += ', ___PercentRead  = ? '
+
+                if options[cfg.KEY_READING_STATUS] and sony_percentRead:
+                    chapter_values.append(2 if sony_percentRead == 100 else 1)
+                    chapter_set_clause += ', ReadStatus  = ? '
+                    chapter_values.append('false')
+                    chapter_set_clause += ', FirstTimeReading = ? '
+
+                last_read = None
+                if options[cfg.KEY_DATE_TO_NOW]:
+                    chapter_values.append(time.strftime(timestamp_format, time.gmtime()))
+                    chapter_set_clause += ', DateLastRead  = ? '
+                elif book.get('last_read') is not None:
+                    last_read = book['last_read']
+                    chapter_values.append(last_read.strftime(timestamp_format))
+                    chapter_set_clause += ', DateLastRead  = ? '
+
+                debug_print("found contentId='%s'" % (contentID))
+                debug_print("sony_bookmark=", sony_bookmark)
+                debug_print("sony_percentRead=", sony_percentRead)
+                debug_print("last_read=", last_read)
+
+                if len(chapter_set_clause) == 0:
+                    debug_print("no changes found to selected metadata. No changes being made.")
+                    not_on_device_books += 1
+                    continue
+
+                chapter_update += chapter_set_clause[1:]
+                chapter_update += 'WHERE ContentID = ? AND BookID IS NULL'
+                chapter_values.append(contentID)
+                debug_print("chapter_update=%s" % chapter_update)
+                debug_print("chapter_values= ", chapter_values)
+                journal.execute(chapter_update, chapter_values)
+                updated_books += 1
+        try:
+            journal.apply(connection)
+        except:
+            debug_print('    Database Exception:  Unable to set bookmark info.')
+            raise
+        debug_print("Update summary: Books updated=%d, not on device=%d, Total=%d" % (updated_books, not_on_device_books, count_books))
+
+        cursor.close()
+
+    return (updated_books, not_on_device_books, count_books)
+
+
+@instrumented()
+def set_reader_fonts(database_path, contentIDs, options, timestamp_format=DEFAULT_TIMESTAMP_FORMAT, delete=False, journal=None):
+    """
+    Set the reader font settings of each book to those in options, or remove them
+
+    The changes are made in one transaction through journal, or an unsaved ChangeJournal.
+    Returns the number of settings updated, added and deleted, and the number of books.
+
+    >>> import os
+    >>> import calibre_plugins.sonyutilities.prefs as cfg
+    >>> from calibre_plugins.sonyutilities.services import set_reader_fonts
+    >>> from calibre_plugins.sonyutilities.device_database import connect_device_database
+    >>> path = os.tempnam()
+    >>> connection = connect_device_database(path)
+    >>> _ = connection.execute('CREATE TABLE content_settings (ContentID TEXT, DateModified TEXT, '
+    ...                        'ReadingFontFamily TEXT, ReadingFontSize REAL, ReadingAlignment TEXT, '
+    ...                        'ReadingLineHeight REAL, ReadingLeftMargin INTEGER, ReadingRightMargin INTEGER)')
+    >>> _ = connection.execute("INSERT INTO content_settings (ContentID) VALUES ('1')")
+    >>> connection.commit()
+    >>> options = {cfg.KEY_READING_FONT_FAMILY: 'Georgia', cfg.KEY_READING_ALIGNMENT: 'Off',
+    ...            cfg.KEY_READING_FONT_SIZE: 22, cfg.KEY_READING_LINE_HEIGHT: 1.4,
+    ...            cfg.KEY_READING_LEFT_MARGIN: 10, cfg.KEY_READING_RIGHT_MARGIN: 10}
+    >>> print(set_reader_fonts(path, ['1', '2'], options))
+    (1, 1, 0, 2)
+    >>> print(connection.execute("SELECT COUNT(*) FROM content_settings WHERE ReadingFontFamily = 'Georgia'").fetchone()[0])
+    2
+    >>> print(set_reader_fonts(path, ['1'], options, delete=True))
+    (0, 0, 1, 1)
+    >>> connection.close()
+    >>> os.remove(path)
+
+    """
+    debug_print("start")
+    journal = journal or ChangeJournal('set_reader_fonts')
+    updated_fonts  = 0
+    added_fonts    = 0
+    deleted_fonts  = 0
+    count_books    = 0
+
+    with closing(_connect(database_path)) as connection:
+        test_query = 'SELECT 1 '                    \
+                        'FROM content_settings '    \
+                        'WHERE ContentId = ?'
+        delete_query = 'DELETE FROM content_settings '    \
+                        'WHERE ContentId = ?'
+
+        if not delete:
+            font_face       = options[cfg.KEY_READING_FONT_FAMILY]
+            justification   = options[cfg.KEY_READING_ALIGNMENT].lower()
+            justification   = '' if justification == 'off' else justification
+            font_size       = options[cfg.KEY_READING_FONT_SIZE]
+            line_spacing    = options[cfg.KEY_READING_LINE_HEIGHT]
+            left_margins    = options[cfg.KEY_READING_LEFT_MARGIN]
+            right_margins   = options[cfg.KEY_READING_RIGHT_MARGIN]
+
+            add_query = 'INSERT INTO content_settings ( '   \
+                            '"DateModified", '              \
+                            '"ReadingFontFamily", '         \
+                            '"ReadingFontSize", '           \
+                            '"ReadingAlignment", '          \
+                            '"ReadingLineHeight", '         \
+                            '"ReadingLeftMargin", '         \
+                            '"ReadingRightMargin", '        \
+                            '"ContentID" '                  \
+                            ') '                            \
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+            update_query = 'UPDATE content_settings '    \
+                            'SET "DateModified" = ?, '   \
+                            '"ReadingFontFamily" = ?, '  \
+                            '"ReadingFontSize" = ?, '    \
+                            '"ReadingAlignment" = ?, '   \
+                            '"ReadingLineHeight" = ?, '  \
+                            '"ReadingLeftMargin" = ?, '  \
+                            '"ReadingRightMargin" = ? '  \
+                            'WHERE ContentId = ?'
+            values = (
+                      time.strftime(timestamp_format, time.gmtime()),
+                      font_face,
+                      font_size,
+                      justification,
+                      line_spacing,
+                      left_margins,
+                      right_margins,
+                      )
+
+        cursor = connection.cursor()
+
+        for contentID in contentIDs:
+            test_values = (contentID,)
+            if delete:
+                journal.execute(delete_query, test_values)
+                deleted_fonts += 1
+            else:
+                cursor.execute(test_query, test_values)
+                result = cursor.fetchone()
+                if result is None:
+                    journal.execute(add_query, values + (contentID,))
+                    added_fonts += 1
+                else:
+                    journal.execute(update_query, values + (contentID,))
+                    updated_fonts += 1
+            count_books += 1
+
+        cursor.close()
+        journal.apply(connection)
+
+    return updated_fonts, added_fonts, deleted_fonts, count_books
+
+
+# Implementation of QtQHash for strings. This doesn't seem to be in the Python implemention. 
+def qhash (inputstr):
+    instr = ""
+    if isinstance (inputstr, str):
+        instr = inputstr 
+    elif isinstance (inputstr, unicode):
+        instr = inputstr.encode ("utf8")
+    else:
+        return -1
+
+    h = 0x00000000
+    for i in range (0, len (instr)):
+        h = (h << 4) + ord(instr[i])
+        h ^= (h & 0xf0000000) >> 23
+        h &= 0x0fffffff
+
+    return h
+
+
+@instrumented()
+def image_id_set(database_path):
+    """
+    The image ids of all the books on the device
+    """
+    with closing(_connect(database_path)) as connection:
+        imageId_query = 'SELECT DISTINCT ImageId '       \
+                        'FROM content '         \
+                        'WHERE BookID IS NULL'
+        cursor = connection.cursor()
+
+        imageIDs = []
+        cursor.execute(imageId_query)
+        for row in cursor:
+            imageIDs.append(row[0])
+
+        cursor.close()
+
+    return set(imageIDs)
+
+
+@instrumented()
+def shelf_count(database_path):
+    """
+    The name, first and last creation date and number of copies of each shelf
+    """
+    with closing(_connect(database_path)) as connection:
+        shelves = []
+
+        shelves_query = ("SELECT Name, MIN(CreationDate), MAX(CreationDate), COUNT(*) "
+                        "FROM Shelf "
+                        "WHERE _IsDeleted = 'false' "
+                        "GROUP BY Name")
+
+        cursor = connection.cursor()
+        cursor.execute(shelves_query)
+        for i, row in enumerate(cursor):
+            debug_print("row:", i, row[0], row[1], row[2], row[3])
+            shelves.append([row[0], convert_sony_date(row[1]), convert_sony_date(row[2]), int(row[3]) ])
+
+        cursor.close()
+    return shelves
+
+
+@instrumented()
+def shelf_statistics(database_path):
+    """
+    The name, book count and classification (series/author) of every shelf
+    """
+    with closing(_connect(database_path)) as connection:
+        shelves = []
+        cursor = connection.cursor()
+        cursor.execute(SHELF_STATISTICS_QUERY)
+        for row in cursor:
+            shelf = {}
+            shelf['name']      = row[0]
+            shelf['count']     = int(row[1])
+            shelf['is_series'] = bool(row[2])
+            shelf['is_author'] = bool(row[3])
+            shelves.append(shelf)
+
+        cursor.close()
+
+    debug_print("number of shelves:", len(shelves))
+    return shelves
+
+
+@instrumented()
+def order_series_shelves(database_path, shelves, options, timestamp_format=DEFAULT_TIMESTAMP_FORMAT, journal=None):
+    """
+    Order the books on each of the shelves with more than one book, by series or by published date
+
+    The shelf dates are updated in one transaction through journal, or an unsaved ChangeJournal.
+    Returns the number of shelves, and the names of the shelves that were ordered.
+    """
+    from calibre_plugins.sonyutilities.book import parse_series_numbers
+
+    journal = journal or ChangeJournal('order_series_shelves')
+    shelves_log.debug("number of shelves: %d options: %s", len(shelves), options)
+    starting_shelves = len(shelves)
+    sort_descending  = not options[cfg.KEY_SORT_DESCENDING]
+    order_by         = options[cfg.KEY_ORDER_SHELVES_BY]
+
+    shelves_to_order = [shelf for shelf in shelves if shelf['count'] > 1]
+
+    with closing(HelperIndexes([database_path], HELPER_INDEXES)), \
+         closing(_connect(database_path, sqlite3.Row)) as connection:
+        # Fetch the contents of all the selected shelves at once, using a temporary
+        # table of shelf names to avoid a query per shelf
+        shelves_query = ("SELECT ShelfName, c.ContentId, c.Title, c.DateCreated, Series, SeriesNumber "
+                         "FROM ShelfContent sc "
+                         "JOIN content c on sc.ContentId = c.ContentId "
+                         "JOIN temp.sonyutilities_shelves t on t.Name = sc.ShelfName "
+                         "WHERE sc._IsDeleted = 'false' "
+                         "ORDER BY ShelfName"
+                        )
+
+        cursor = connection.cursor()
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS sonyutilities_shelves (Name TEXT PRIMARY KEY)")
+        cursor.execute("DELETE FROM temp.sonyutilities_shelves")
+        cursor.executemany("INSERT OR IGNORE INTO temp.sonyutilities_shelves VALUES (?)",
+                           [(shelf['name'],) for shelf in shelves_to_order])
+
+        shelf_contents = {}
+        cursor.execute(shelves_query)
+        rows = cursor.fetchall()
+        series_numbers = parse_series_numbers([row['SeriesNumber'] for row in rows])
+        for row, (series_index, series_format, series_valid) in zip(rows, series_numbers):
+            if order_by == cfg.KEY_ORDER_SHELVES_PUBLISHED:
+                sort_key = (row['DateCreated'], row['Title'])
+            elif row['Series']:
+                sort_key = (0, row['Series'], series_index, row['Title'])
+            else:
+                # Books that aren't in a series sort after those that are
+                sort_key = (1, row['Title'])
+            shelf_contents.setdefault(row['ShelfName'], []).append((sort_key, row['ContentId']))
+        shelves_log.debug("shelves fetched: %d", len(shelf_contents))
+
+        # The shelf order on the device is by date added, so give each book a timestamp
+        # one second after the one before it
+        start_time  = int(time.time())
+        update_data = []
+        for shelf_name, contents in shelf_contents.iteritems():
+            contents.sort(key=lambda content: content[0], reverse=sort_descending)
+            for offset, (sort_key, contentId) in enumerate(contents):
+                timestamp = time.strftime(timestamp_format, time.gmtime(start_time + offset))
+                update_data.append((timestamp, shelf_name, contentId))
+        shelves_log.debug("number of updates: %d", len(update_data))
+        journal.executemany(SHELF_CONTENT_UPDATE_QUERY, update_data)
+
+        cursor.close()
+        journal.apply(connection)
+    shelves_log.debug("end")
+    return starting_shelves, [shelf['name'] for shelf in shelves_to_order]
+
+
+@instrumented()
+def remove_duplicate_shelves(database_path, options, timestamp_format=DEFAULT_TIMESTAMP_FORMAT, journal=None):
+    """
+    Remove duplicate shelves, keeping either the newest or the oldest shelf of each name
+
+    The shelf to keep is chosen for every name at once by grouping the Shelf table, and the
+    duplicates are then marked as deleted (or deleted, for shelves that were never synced)
+    in one transaction through journal, or an unsaved ChangeJournal.
+    """
+    debug_print("options=%s" % (options,))
+    journal = journal or ChangeJournal('remove_duplicate_shelves')
+    with closing(HelperIndexes([database_path], HELPER_INDEXES)), \
+         closing(_connect(database_path, sqlite3.Row)) as connection:
+        shelves_count = ("SELECT COUNT(*) FROM Shelf "
+                         "WHERE _IsDeleted = 'false'"
+                         )
+        keepers_query = ("SELECT Name, {0}(CreationDate) "
+                         "FROM Shelf "
+                         "WHERE _IsDeleted = 'false' "
+                         "GROUP BY Name "
+                         "HAVING COUNT(*) > 1"
+                         )
+        shelves_update = ("UPDATE Shelf "
+                          "SET _IsDeleted = 'true', "
+                          "LastModified = ? "
+                          "WHERE _IsSynced = 'true' "
+                          "AND _IsDeleted = 'false' "
+                          "AND Name = ? "
+                          "AND CreationDate <> ?"
+                          )
+        shelves_delete = ("DELETE FROM Shelf "
+                          "WHERE _IsSynced = 'false' "
+                          "AND _IsDeleted = 'true' "
+                          "AND Name = ? "
+                          "AND CreationDate <> ?"
+                          )
+        shelves_purge = ("DELETE FROM Shelf "
+                         "WHERE _IsDeleted = 'true'"
+                        )
+
+        purge_shelves = options[cfg.KEY_PURGE_SHELVES]
+        keep_newest   = options[cfg.KEY_KEEP_NEWEST_SHELF]
+
+        cursor = connection.cursor()
+        cursor.execute(shelves_count)
+        starting_shelves = cursor.fetchone()[0]
+
+        cursor.execute(keepers_query.format('MAX' if keep_newest else 'MIN'))
+        keepers = [(row[0], row[1]) for row in cursor.fetchall()]
+        debug_print("shelf names with duplicates:", len(keepers))
+
+        timestamp = time.strftime(timestamp_format, time.gmtime())
+        journal.executemany(shelves_update, [(timestamp, name, creation_date) for name, creation_date in keepers])
+        journal.executemany(shelves_delete, keepers)
+        if purge_shelves:
+            debug_print("purging all shelves marked as deleted")
+            journal.execute(shelves_purge)
+
+        rowcounts = journal.apply(connection)
+        debug_print("shelves marked as deleted:", sum(rowcounts[:len(keepers)]))
+        debug_print("unsynced shelves deleted:", sum(rowcounts[len(keepers):2 * len(keepers)]))
+        shelves_purged = rowcounts[-1] if purge_shelves else 0
+
+        cursor.execute(shelves_count)
+        finished_shelves = cursor.fetchone()[0]
+        shelves_removed  = starting_shelves - finished_shelves
+
+        cursor.close()
+
+    return starting_shelves, shelves_removed, finished_shelves, shelves_purged
+
+
+def check_device_database(database_path):
+    with closing(_connect(database_path)) as connection:
+        check_query = 'PRAGMA integrity_check'
+        cursor = connection.cursor()
+
+        check_result = ''
+        cursor.execute(check_query)
+        result = cursor.fetchall()
+        if not result is None:
+            for line in result:
+                check_result += '\n' + line[0]
+        else:
+            check_result = _("Execution of '%s' failed") % check_query
+
+        connection.commit()
+        cursor.close()
+
+    return check_result
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Derek Broughton <auspex@pointerstop.ca>'
+__docformat__ = 'restructuredtext en'
+'''
+Time the plugin's device operations against a synthetic PRS-T1 device, without a reader
+or the calibre GUI.
+
+For each scale a device tree is generated in a temporary directory: Sony_Reader/database/books.db
+with the books, current_position and network_position tables the reader uses and the content,
+Shelf, ShelfContent and content_settings tables the plugin queries, an EPUB file for every book
+and a .sony-images tree with a cover for every book.
+
+Storing and restoring reading positions, reader font settings, shelf ordering and cover scans
+call the plugin's services, and backups its job. Updating metadata needs calibre's library and
+device objects, so its statement pattern is replayed: the current details of each book are read
+with the plugin's query, the update for each book is recorded in a change journal, and the
+journal is applied once.
+
+The timings and statement counts are written as JSON. Given the results of an earlier run, the
+change in each timing is printed for comparison.
+
+Run with: calibre-debug tests/benchmark_device.py [--books 1000,10000,50000] [--output results.json]
+                                                  [--baseline previous.json] [--keep directory]
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import closing
+from datetime import datetime
+
+try:
+    import init_calibre # must be imported to be able to import sonyutilities
+except ImportError:
+    pass
+
+import calibre_plugins.sonyutilities.prefs as cfg
+import calibre_plugins.sonyutilities.services as services
+from calibre_plugins.sonyutilities.device_database import (instrumented, connect_device_database, HelperIndexes,
+                                                           ChangeJournal)
+from calibre_plugins.sonyutilities.services import MIMETYPE_SONY, HELPER_INDEXES, qhash
+from calibre_plugins.sonyutilities.jobs import do_device_database_backup
+
+DATABASE_PATH    = 'Sony_Reader/database/books.db'
+BOOKS_PATH       = 'Sony_Reader/media/books'
+IMAGES_PATH      = '.sony-images'
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+BOOKS_PER_SERIES = 8
+BOOKS_PER_AUTHOR = 20
+
+SCHEMA = """
+    CREATE TABLE books (_id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, author TEXT, kana_title TEXT,
+        kana_author TEXT, title_key TEXT, author_key TEXT, source_id INTEGER, added_date INTEGER,
+        modified_date INTEGER, reading_time INTEGER, purchased_date INTEGER, file_path TEXT,
+        file_name TEXT, file_size INTEGER, thumbnail TEXT, mime_type TEXT, corrupted INTEGER,
+        prevent_delete INTEGER);
+    CREATE TABLE current_position (_id INTEGER PRIMARY KEY AUTOINCREMENT, content_id INTEGER,
+        content_type INTEGER, mark TEXT, added_date INTEGER, modified_date INTEGER);
+    CREATE TABLE network_position (_id INTEGER PRIMARY KEY AUTOINCREMENT, content_id INTEGER,
+        content_type INTEGER, mark TEXT, percent INTEGER, client_create_date INTEGER,
+        added_date INTEGER, modified_date INTEGER);
+    CREATE INDEX current_position_content_id ON current_position (content_id);
+    CREATE INDEX network_position_content_id ON network_position (content_id);
+    CREATE TABLE content (ContentID TEXT, BookID TEXT, Title TEXT, Attribution TEXT, Description TEXT,
+        Publisher TEXT, Series TEXT, SeriesNumber TEXT, Subtitle TEXT, ReadStatus INTEGER,
+        DateCreated TEXT, DateLastRead TEXT, Language TEXT, bookmark TEXT, ___PercentRead INTEGER,
+        FirstTimeReading TEXT, MimeType TEXT, ImageId TEXT);
+    CREATE TABLE Shelf (CreationDate TEXT, Id TEXT, InternalName TEXT, LastModified TEXT, Name TEXT,
+        Type TEXT, _IsDeleted TEXT, _IsVisible TEXT, _IsSynced TEXT);
+    CREATE TABLE ShelfContent (ShelfName TEXT, ContentId TEXT, DateModified TEXT, _IsDeleted TEXT,
+        _IsSynced TEXT);
+    CREATE TABLE content_settings (ContentID TEXT, ContentType INTEGER, DateModified TEXT,
+        ReadingFontFamily TEXT, ReadingFontSize REAL, ReadingAlignment TEXT, ReadingLineHeight REAL,
+        ReadingLeftMargin INTEGER, ReadingRightMargin INTEGER);
+    """
+
+CONTAINER_XML = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+"""
+CONTENT_OPF = """<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>%(title)s</dc:title><dc:creator>%(author)s</dc:creator><dc:identifier id="id">%(id)s</dc:identifier>
+  </metadata>
+  <manifest><item id="text" href="text.html" media-type="application/xhtml+xml"/></manifest>
+  <spine><itemref idref="text"/></spine>
+</package>
+"""
+TEXT_HTML = """<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%(title)s</title></head>
+<body><p>%(title)s</p></body></html>
+"""
+
+# The statement _update_metadata records for each book when the title and series are updated
+METADATA_UPDATE_QUERY = ("UPDATE content SET Title  = ? , Series  = ? , SeriesNumber   = ? "
+                         "WHERE ContentID = ? AND BookID IS NULL")
+
+
+class FixtureDevice():
+    """
+    The generated device, with the attributes the metadata query is built from
+    """
+    def __init__(self, root):
+        self.root             = root
+        self.prefix           = os.path.join(root, '')
+        self.database         = os.path.join(root, DATABASE_PATH)
+        self.supports_series  = True
+        self.supports_ratings = False
+
+    def books(self):
+        """
+        The books on the device, as the library would pass them to the services
+        """
+        with closing(sqlite3.connect(self.database)) as connection:
+            rows = connection.execute('SELECT _id, title, author, file_path FROM books').fetchall()
+        return [dict(id=book_id, title=title, authors=author, contentIds=[book_id],
+                     paths=[self.prefix + file_path], bookmark=None, percentRead=None, last_read=None)
+                for book_id, title, author, file_path in rows]
+
+
+def write_epub(path, book):
+    with zipfile.ZipFile(path, 'w') as epub:
+        epub.writestr('mimetype', MIMETYPE_SONY, zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml', CONTAINER_XML, zipfile.ZIP_DEFLATED)
+        epub.writestr('content.opf', (CONTENT_OPF % book).encode('utf-8'), zipfile.ZIP_DEFLATED)
+        epub.writestr('text.html', (TEXT_HTML % book).encode('utf-8'), zipfile.ZIP_DEFLATED)
+
+def cover_directory(root, image_id):
+    hash1 = qhash(image_id)
+    return os.path.join(root, IMAGES_PATH, "%s" % (hash1 & 0xff), "%s" % ((hash1 & 0xff00) >> 8))
+
+def build_fixture(root, count):
+    """
+    Generate a PRS-T1 device tree with count books under root
+    """
+    random.seed(count)
+    os.makedirs(os.path.dirname(os.path.join(root, DATABASE_PATH)))
+    os.makedirs(os.path.join(root, BOOKS_PATH))
+    now_ms = int(time.time() * 1000)
+
+    books, positions, network_positions, content, settings = [], [], [], [], []
+    shelves, shelf_content = {}, []
+    for i in xrange(1, count + 1):
+        author    = 'Author %d' % (i // BOOKS_PER_AUTHOR)
+        series    = 'Series %d' % (i // BOOKS_PER_SERIES) if i % 3 else None
+        file_path = '%s/book_%06d.epub' % (BOOKS_PATH, i)
+        book      = {'id': i, 'title': 'Book %d' % i, 'author': author}
+        write_epub(os.path.join(root, file_path), book)
+
+        reading_time = now_ms - random.randint(0, 365 * 24 * 3600) * 1000 if i % 4 else None
+        books.append((i, book['title'], author, reading_time, file_path, os.path.basename(file_path),
+                      MIMETYPE_SONY, now_ms))
+        if reading_time:
+            positions.append((i, 'epubcfi(/6/2!/4/%d)' % (i % 50), reading_time))
+            network_positions.append((i, 'epubcfi(/6/2!/4/%d)' % (i % 50), random.randint(1, 100), reading_time))
+
+        image_id = 'file____mnt_onboard_%s' % file_path.replace('/', '_')
+        content.append(('%d' % i, book['title'], author, series, '%d' % (i % BOOKS_PER_SERIES + 1) if series else None,
+                        time.strftime(TIMESTAMP_FORMAT, time.gmtime(1300000000 + i * 3600)), MIMETYPE_SONY, image_id))
+        cover_dir = cover_directory(root, image_id)
+        if not os.path.isdir(cover_dir):
+            os.makedirs(cover_dir)
+        with open(os.path.join(cover_dir, image_id + ' - N3_LIBRARY_FULL.parsed'), 'wb') as cover:
+            cover.write(b'\0' * 256)
+
+        if i % 10 == 0:
+            settings.append(('%d' % i, 'Georgia', 22.0, 'justify', 1.4, 10, 10))
+        for shelf_name in ([series, author] if series else [author]):
+            shelves.setdefault(shelf_name, time.strftime(TIMESTAMP_FORMAT, time.gmtime(1300000000 + i)))
+            shelf_content.append((shelf_name, '%d' % i, shelves[shelf_name]))
+
+    with sqlite3.connect(os.path.join(root, DATABASE_PATH)) as connection:
+        connection.executescript(SCHEMA)
+        connection.executemany("INSERT INTO books (_id, title, author, reading_time, file_path, file_name, "
+                               "mime_type, added_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", books)
+        connection.executemany("INSERT INTO current_position (content_id, content_type, mark, modified_date) "
+                               "VALUES (?, 0, ?, ?)", positions)
+        connection.executemany("INSERT INTO network_position (content_id, content_type, mark, percent, "
+                               "client_create_date) VALUES (?, 0, ?, ?, ?)", network_positions)
+        connection.executemany("INSERT INTO content (ContentID, BookID, Title, Attribution, Series, SeriesNumber, "
+                               "DateCreated, MimeType, ImageId, ReadStatus, ___PercentRead) "
+                               "VALUES (?, NULL, ?, ?, ?, ?, ?, ?, ?, 0, 0)", content)
+        connection.executemany("INSERT INTO content_settings (ContentID, ContentType, ReadingFontFamily, "
+                               "ReadingFontSize, ReadingAlignment, ReadingLineHeight, ReadingLeftMargin, "
+                               "ReadingRightMargin) VALUES (?, 6, ?, ?, ?, ?, ?, ?)", settings)
+        connection.executemany("INSERT INTO Shelf (Name, InternalName, CreationDate, LastModified, _IsDeleted, "
+                               "_IsVisible, _IsSynced) VALUES (?, ?, ?, ?, 'false', 'true', 'false')",
+                               [(name, name, created, created) for name, created in shelves.iteritems()])
+        connection.executemany("INSERT INTO ShelfContent (ShelfName, ContentId, DateModified, _IsDeleted, "
+                               "_IsSynced) VALUES (?, ?, ?, 'false', 'false')", shelf_content)
+    return FixtureDevice(root)
+
+
+def store_positions(device):
+    options = {cfg.KEY_CLEAR_IF_UNREAD:          False,
+               cfg.KEY_STORE_IF_MORE_RECENT:     False,
+               cfg.KEY_DO_NOT_STORE_IF_REOPENED: False}
+    books = device.books()
+    with instrumented('store') as stats:
+        services.fetch_reading_positions({device.prefix: device.database}, books, options)
+    return stats
+
+def restore_positions(device):
+    options = {cfg.KEY_READING_STATUS: True,
+               cfg.KEY_DATE_TO_NOW:    False}
+    books = device.books()
+    for i, book in enumerate(books):
+        book.update(contentIds=['%d' % book['id']], bookmark='epubcfi(/6/2!/4/%d)' % (i % 50),
+                    percentRead=i % 100, last_read=datetime.utcnow())
+    with instrumented('restore') as stats:
+        services.restore_reading_positions(device.database, books, options, TIMESTAMP_FORMAT)
+    return stats
+
+def set_reader_fonts(device):
+    options = {cfg.KEY_READING_FONT_FAMILY:  'Georgia',
+               cfg.KEY_READING_ALIGNMENT:    'Justify',
+               cfg.KEY_READING_FONT_SIZE:    22,
+               cfg.KEY_READING_LINE_HEIGHT:  1.4,
+               cfg.KEY_READING_LEFT_MARGIN:  10,
+               cfg.KEY_READING_RIGHT_MARGIN: 10}
+    content_ids = ['%d' % book['id'] for book in device.books()]
+    with instrumented('reader fonts') as stats:
+        services.set_reader_fonts(device.database, content_ids, options, TIMESTAMP_FORMAT)
+    return stats
+
+def update_metadata(device):
+    metadata_query = services.metadata_query(device.supports_series, device.supports_ratings)
+    journal_dir    = tempfile.mkdtemp(prefix='sonyutilities_journal_')
+    try:
+        with instrumented('metadata') as stats:
+            with closing(HelperIndexes([device.database], HELPER_INDEXES)), \
+                 closing(connect_device_database(device.database)) as connection:
+                connection.row_factory = sqlite3.Row
+                cursor  = connection.cursor()
+                journal = ChangeJournal('update_metadata', 'benchmark', journal_dir)
+                content_ids = [row[0] for row in cursor.execute('SELECT ContentID FROM content WHERE BookID IS NULL')]
+                for content_id in content_ids:
+                    cursor.execute(metadata_query, (content_id,))
+                    result = cursor.fetchone()
+                    if result is not None:
+                        # Python 2's sqlite3.Row can't be indexed by the unicode literals used here
+                        result = dict(zip(result.keys(), result))
+                        journal.execute(METADATA_UPDATE_QUERY, (result['Title'] + ' (updated)', result['Series'],
+                                                                result['SeriesNumber'], content_id))
+                journal.apply(connection)
+    finally:
+        shutil.rmtree(journal_dir, ignore_errors=True)
+    return stats
+
+def order_shelves(device):
+    options = {cfg.KEY_SORT_DESCENDING:    False,
+               cfg.KEY_ORDER_SHELVES_BY:   cfg.KEY_ORDER_SHELVES_BY_SERIES,
+               cfg.KEY_SORT_UPDATE_CONFIG: False}
+    with instrumented('order shelves') as stats:
+        shelves = services.shelf_statistics(device.database)
+        services.order_series_shelves(device.database, shelves, options, TIMESTAMP_FORMAT)
+    return stats
+
+def backup_database(device):
+    backup_dir = tempfile.mkdtemp(prefix='sonyutilities_backup_')
+    backup_options = {'device_name':       'Sony Reader',
+                      'device_store_uuid': 'benchmark',
+                      'location_code':     'main',
+                      'dest':              backup_dir,
+                      'database_file':     device.database,
+                      'copies':            2}
+    try:
+        with instrumented('backup') as stats:
+            do_device_database_backup(backup_options)
+    finally:
+        shutil.rmtree(backup_dir, ignore_errors=True)
+    return stats
+
+def scan_covers(device):
+    with instrumented('cover scan') as stats:
+        image_ids = services.image_id_set(device.database)
+        missing   = [image_id for image_id in image_ids
+                     if not os.path.isdir(cover_directory(device.root, image_id))]
+        covers    = sum(len(files) for _root, _dirs, files in os.walk(os.path.join(device.root, IMAGES_PATH)))
+    assert not missing and covers == len(image_ids)
+    return stats
+
+# In the order they run: the later operations see the changes made by the earlier ones
+OPERATIONS = [('store', store_positions), ('restore', restore_positions), ('reader fonts', set_reader_fonts),
+              ('metadata', update_metadata), ('order shelves', order_shelves), ('backup', backup_database),
+              ('cover scan', scan_covers)]
+
+def run(counts, keep=None):
+    results = {'started': time.strftime(TIMESTAMP_FORMAT, time.gmtime()),
+               'python': platform.python_version(),
+               'sqlite': sqlite3.sqlite_version,
+               'scales': {}}
+    for count in counts:
+        root = tempfile.mkdtemp(prefix='sonyutilities_device_%d_' % count, dir=keep)
+        try:
+            start  = time.time()
+            device = build_fixture(root, count)
+            scale  = {'fixture': {'seconds': time.time() - start}}
+            for name, operation in OPERATIONS:
+                stats = operation(device)
+                scale[name] = {'seconds': stats.wall_time, 'statements': stats.statements,
+                               'statement_seconds': stats.statement_time, 'rows': stats.rows,
+                               'commits': stats.commits, 'bytes_copied': stats.bytes_copied}
+                print('%6d books  %-14s %8.3fs %9d statements' % (count, name, stats.wall_time, stats.statements))
+            results['scales'][str(count)] = scale
+        finally:
+            if keep is None:
+                shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def compare(results, baseline):
+    for count, scale in sorted(results['scales'].iteritems(), key=lambda item: int(item[0])):
+        for name, _operation in OPERATIONS:
+            previous = baseline.get('scales', {}).get(count, {}).get(name)
+            if previous and previous['seconds']:
+                change = (scale[name]['seconds'] - previous['seconds']) / previous['seconds']
+                print('%6s books  %-14s %8.3fs -> %8.3fs %+7.1f%%' % (count, name, previous['seconds'],
+                                                                     scale[name]['seconds'], change * 100))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the plugin device operations on a synthetic PRS-T1 device')
+    parser.add_argument('--books', default='1000,10000,50000', help='comma separated numbers of books on the device')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--keep', help='directory to generate the device trees in, and leave them for inspection')
+    args = parser.parse_args(sys.argv[1:])
+
+    results = run([int(count) for count in args.books.split(',')], args.keep)
+    if args.output:
+        with open(args.output, 'wb') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'rb') as baseline:
+            compare(results, json.load(baseline))
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Derek Broughton <auspex@pointerstop.ca>'
+__docformat__ = 'restructuredtext en'
+'''
+Time parsing a column of synthetic series numbers, comparing the shared parser in
+book.py with the try-float-then-re.findall code it replaced.
+
+Run with: calibre-debug tests/benchmark_series_numbers.py [count]
+'''
+import random
+import re
+import sys
+import timeit
+
+try:
+    import init_calibre # must be imported to be able to import sonyutilities
+except ImportError:
+    pass
+
+from calibre_plugins.sonyutilities.book import parse_series_numbers
+
+def old_parse_series_numbers(series_numbers):
+    results = []
+    for series_number in series_numbers:
+        series_index = None
+        series_format = None
+        if series_number is not None:
+            try:
+                series_index = float(series_number)
+            except ValueError:
+                numbers = re.findall(r"\d*\.?\d+", series_number)
+                if len(numbers) > 0:
+                    series_index  = float(numbers[0])
+                    series_format = series_number.replace(numbers[0], "%g", 1)
+        results.append((series_index, series_format, series_index is not None))
+    return results
+
+def synthetic_series_numbers(count):
+    random.seed(0)
+    templates = ['%d', '%d.5', 'Book %d', 'Part %d of 12', 'Volume %d', 'Omnibus']
+    values = []
+    for i in range(count):
+        template = random.choice(templates)
+        values.append(template % random.randint(1, 200) if '%d' in template else template)
+        if i % 50 == 0:
+            values[-1] = None
+    return values
+
+if __name__ == '__main__':
+    count  = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    values = synthetic_series_numbers(count)
+    assert old_parse_series_numbers(values) == parse_series_numbers(values)
+    for name, function in [('re.findall per row', old_parse_series_numbers),
+                           ('parse_series_numbers', parse_series_numbers)]:
+        seconds = min(timeit.repeat(lambda: function(values), number=1, repeat=5))
+        print('%-22s %d values: %.3fs' % (name, count, seconds))
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2014, Derek Broughton <auspex@pointerstop.ca>'
+__docformat__ = 'restructuredtext en'
+'''
+Time loading the plugin when calibre starts.
+
+The first part imports action.py in a fresh calibre-debug process, as calibre does when
+it loads the plugin, and again also importing the modules action.py now loads lazily.
+The second part starts the calibre GUI on an empty library with copies of the calibre
+configuration, with the plugin enabled and disabled, and reads the start up time calibre
+prints when CALIBRE_DEBUG is set. The calibre configuration itself isn't changed.
+
+Run with: calibre-debug tests/benchmark_startup.py [runs]
+'''
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+    import init_calibre # must be imported to be able to import sonyutilities
+except ImportError:
+    pass
+
+from calibre.utils.config import config_dir
+
+PLUGIN_NAME = 'Sony Utilities'
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+before = len(sys.modules)
+import calibre_plugins.sonyutilities.action
+%s
+print("%%f %%d" %% (time.time() - start, len(sys.modules) - before))
+'''
+EAGER_IMPORTS = 'import calibre_plugins.sonyutilities.dialogs, calibre_plugins.sonyutilities.book'
+
+def import_time(eager):
+    output = subprocess.check_output(['calibre-debug', '-c', IMPORT_SCRIPT % (EAGER_IMPORTS if eager else '')])
+    seconds, modules = output.split()[-2:]
+    return float(seconds), int(modules)
+
+def gui_startup_time(configuration, library):
+    env = dict(os.environ, CALIBRE_CONFIG_DIRECTORY=configuration, CALIBRE_DEBUG='1')
+    gui = subprocess.Popen(['calibre', '--with-library', library], env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    seconds = None
+    for line in iter(gui.stdout.readline, b''):
+        match = re.search(r'Started up in ([\d.]+) seconds', line)
+        if match:
+            seconds = float(match.group(1))
+            break
+    subprocess.call(['calibre', '--shutdown-running-calibre'], env=env)
+    gui.wait()
+    return seconds
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    for name, eager in [('lazy dialogs and book', False), ('eager dialogs and book', True)]:
+        results = [import_time(eager) for _i in range(runs)]
+        print('import action.py, %-22s %.3fs, %d modules' % (name, min(r[0] for r in results), results[0][1]))
+
+    work_dir = tempfile.mkdtemp(prefix='sonyutilities_startup_')
+    try:
+        library = os.path.join(work_dir, 'library')
+        os.mkdir(library)
+        configurations = []
+        for name, enabled in [('plugin enabled', True), ('plugin disabled', False)]:
+            configuration = os.path.join(work_dir, name.replace(' ', '_'))
+            shutil.copytree(config_dir, configuration)
+            if not enabled:
+                subprocess.check_call(['calibre-customize', '--disable-plugin', PLUGIN_NAME],
+                                      env=dict(os.environ, CALIBRE_CONFIG_DIRECTORY=configuration))
+            configurations.append((name, configuration))
+        for name, configuration in configurations:
+            results = [gui_startup_time(configuration, library) for _i in range(runs)]
+            results = [r for r in results if r is not None]
+            print('GUI start up, %-16s %s' % (name, '%.3fs' % min(results) if results else 'not measured'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)